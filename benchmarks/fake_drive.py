@@ -0,0 +1,515 @@
+#!/usr/bin/env python
+"""
+Local stand-in for the Google Drive v3 endpoints GDriveFTP uses.
+
+Keeps files in memory and answers files create/get/list/update/copy/delete,
+get_media with ranges, multipart and resumable uploads, permissions,
+changes, batch requests and the OAuth token endpoint, so the real client
+code can be exercised end to end. Latency, bandwidth, a server error
+rate and a per-second request quota can be injected.
+
+Point the app at it with GOOGLE_DRIVE_API_ROOT_URL=<root url> and a
+credentials file whose token_uri is <root url>token.
+
+Run standalone:
+    python benchmarks/fake_drive.py --port 8765 --latency 0.05 --bandwidth 20M
+"""
+
+import os
+import re
+import json
+import time
+import email
+import random
+import hashlib
+import argparse
+import itertools
+import threading
+from collections import Counter
+from email.policy import compat32
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+WRITE_BLOCK_SIZE = 64 * 1024
+
+
+def parse_size(value):
+    """'20M' -> 20971520; plain numbers are bytes."""
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)([KMG]?)', value.strip().upper())
+    if not match:
+        raise argparse.ArgumentTypeError(f"Not a size: {value}")
+    return int(float(match[1]) * 1024 ** ' KMG'.index(match[2] or ' '))
+
+
+def write_credentials(directory, root_url):
+    """Write a throwaway service account key whose tokens come from the fake server; returns its path."""
+    # Imported here so the server itself only needs the standard library
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    path = os.path.join(directory, 'credentials.json')
+    with open(path, 'w') as f:
+        json.dump({
+            'type': 'service_account',
+            'project_id': 'gdriveftp-benchmark',
+            'private_key_id': 'benchmark',
+            'private_key': key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption()
+            ).decode(),
+            'client_email': 'benchmark@gdriveftp-benchmark.iam.gserviceaccount.com',
+            'client_id': '0',
+            'token_uri': f'{root_url}token',
+        }, f)
+    return path
+
+
+class FakeDrive:
+    """In-memory Drive state and request routing, independent of the HTTP server."""
+
+    def __init__(self, root_url, latency=0.0, bandwidth=None, error_rate=0.0, quota=None, seed=0):
+        self.root_url = root_url
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        # API requests allowed per second; more are refused as userRateLimitExceeded
+        self.quota = quota
+        self._quota_window = (0, 0)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self.files = {}
+        self.sessions = {}
+        self.changes = []
+        self.calls = Counter()
+        self.http_requests = 0
+
+    # Accounting
+
+    def reset_counts(self):
+        with self._lock:
+            self.calls.clear()
+            self.http_requests = 0
+
+    def counts(self):
+        with self._lock:
+            return self.http_requests, dict(self.calls)
+
+    def _count(self, label):
+        with self._lock:
+            self.calls[label] += 1
+
+    def _new_id(self, prefix='F'):
+        with self._lock:
+            return f'{prefix}{next(self._ids)}'
+
+    def _over_quota(self):
+        if not self.quota:
+            return False
+        window = int(time.monotonic())
+        with self._lock:
+            start, used = self._quota_window
+            used = used + 1 if start == window else 1
+            self._quota_window = (window, used)
+            return used > self.quota
+
+    def _fail_now(self):
+        if not self.error_rate:
+            return False
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    # Resources
+
+    def add_file(self, name, data=b'', parents=None, mime_type='application/octet-stream'):
+        """Create a file directly, e.g. to seed downloads. Returns its ID."""
+        return self._store({'name': name, 'parents': parents or [], 'mimeType': mime_type}, data)['id']
+
+    def _store(self, metadata, data=None, md5_checksum=None):
+        file_id = self._new_id()
+        now = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())
+        item = {
+            'id': file_id,
+            'name': metadata.get('name', 'Untitled'),
+            'mimeType': metadata.get('mimeType') or 'application/octet-stream',
+            'parents': list(metadata.get('parents') or []),
+            'description': metadata.get('description', ''),
+            'createdTime': now,
+            'modifiedTime': now,
+            'trashed': False,
+            'version': '1',
+            'permissions': [],
+        }
+        if data is not None and item['mimeType'] != FOLDER_MIME_TYPE:
+            item['data'] = bytes(data)
+            item['size'] = str(len(data))
+            item['md5Checksum'] = md5_checksum or hashlib.md5(data).hexdigest()
+        with self._lock:
+            self.files[file_id] = item
+            self.changes.append((file_id, False))
+        return item
+
+    def _resource(self, item):
+        resource = {key: value for key, value in item.items() if key not in ('data', 'permissions')}
+        resource['kind'] = 'drive#file'
+        resource['webViewLink'] = f"https://drive.google.com/file/d/{item['id']}/view"
+        return resource
+
+    def _matches(self, item, query):
+        for clause in re.split(r'\s+and\s+', query.strip('() ')):
+            clause = clause.strip('() ')
+            in_parents = re.fullmatch(r"'([^']+)'\s+in\s+parents", clause)
+            if in_parents:
+                if in_parents[1] not in item['parents']:
+                    return False
+                continue
+            comparison = re.fullmatch(r"(\w+)\s*(!=|=)\s*'?([^']*)'?", clause)
+            if not comparison:
+                continue
+            field, operator, value = comparison.groups()
+            actual = str(item.get(field, '')).lower() if field == 'trashed' else item.get(field)
+            if (actual == value) != (operator == '='):
+                return False
+        return True
+
+    # Routing
+
+    def handle(self, method, target, headers, body):
+        """Answer one request; returns (status, headers, body)."""
+        url = urlsplit(target)
+        path, query = url.path, dict(parse_qsl(url.query))
+
+        if path == '/token' and method == 'POST':
+            self._count('oauth.token')
+            return self._json(200, {'access_token': 'fake-drive-token', 'expires_in': 3600, 'token_type': 'Bearer'})
+
+        if not headers.get('authorization', '').startswith('Bearer '):
+            return self._error(401, 'authError', 'Missing access token')
+        if self._over_quota():
+            self._count('rate_limited')
+            return self._error(403, 'userRateLimitExceeded', 'User rate limit exceeded')
+        if self._fail_now():
+            return self._error(503, 'backendError', 'Injected failure')
+
+        if path == '/batch/drive/v3' and method == 'POST':
+            self._count('batch')
+            return self._batch(headers, body)
+        if path == '/upload/drive/v3/files':
+            return self._upload(method, query, headers, body)
+        if path == '/drive/v3/files':
+            if method == 'GET':
+                self._count('files.list')
+                return self._list(query)
+            if method == 'POST':
+                self._count('files.create')
+                return self._json(200, self._resource(self._store(json.loads(body or b'{}'))))
+        if path == '/drive/v3/changes/startPageToken':
+            self._count('changes.getStartPageToken')
+            return self._json(200, {'startPageToken': str(len(self.changes) + 1)})
+        if path == '/drive/v3/changes':
+            self._count('changes.list')
+            return self._list_changes(query)
+
+        match = re.fullmatch(r'/drive/v3/files/([^/]+)(?:/(copy|permissions)(?:/([^/]+))?)?', path)
+        if match:
+            return self._file(method, query, headers, body, *match.groups())
+        return self._error(404, 'notFound', f'No route for {method} {path}')
+
+    def _file(self, method, query, headers, body, file_id, action, permission_id):
+        item = self.files.get(file_id)
+        if item is None:
+            self._count(f'files.{method.lower()}')
+            return self._error(404, 'notFound', f'File not found: {file_id}')
+
+        if action == 'copy':
+            self._count('files.copy')
+            metadata = {'mimeType': item['mimeType'], 'parents': item['parents'], **json.loads(body or b'{}')}
+            return self._json(200, self._resource(self._store(metadata, item.get('data'), item.get('md5Checksum'))))
+        if action == 'permissions':
+            return self._permissions(method, item, body, permission_id)
+
+        if method == 'DELETE':
+            self._count('files.delete')
+            with self._lock:
+                self.files.pop(file_id, None)
+                self.changes.append((file_id, True))
+            return 204, {}, b''
+        if method == 'PATCH':
+            self._count('files.update')
+            item.update(json.loads(body or b'{}'))
+            removed = query.get('removeParents', '').split(',')
+            item['parents'] = [parent for parent in item['parents'] if parent not in removed]
+            item['parents'] += [parent for parent in query.get('addParents', '').split(',') if parent]
+            with self._lock:
+                self.changes.append((file_id, False))
+            return self._json(200, self._resource(item))
+        if query.get('alt') == 'media':
+            self._count('files.get_media')
+            return self._media(item, headers)
+        self._count('files.get')
+        return self._json(200, self._resource(item))
+
+    def _media(self, item, headers):
+        data = item.get('data', b'')
+        range_header = headers.get('range')
+        if not range_header:
+            return 200, {'Content-Type': item['mimeType']}, data
+        start, _, end = range_header.removeprefix('bytes=').partition('-')
+        start = int(start)
+        end = min(int(end), len(data) - 1) if end else len(data) - 1
+        if start >= len(data):
+            return 416, {'Content-Range': f'bytes */{len(data)}'}, b''
+        return 206, {
+            'Content-Type': item['mimeType'],
+            'Content-Range': f'bytes {start}-{end}/{len(data)}'
+        }, data[start:end + 1]
+
+    def _list(self, query):
+        page_size = int(query.get('pageSize', 100))
+        offset = int(query.get('pageToken') or 0)
+        q = query.get('q', '')
+        items = [self._resource(item) for _, item in sorted(self.files.items(), key=lambda pair: int(pair[0][1:]))
+                 if self._matches(item, q)]
+        result = {'files': items[offset:offset + page_size]}
+        if offset + page_size < len(items):
+            result['nextPageToken'] = str(offset + page_size)
+        return self._json(200, result)
+
+    def _list_changes(self, query):
+        start = int(query.get('pageToken', 1)) - 1
+        page_size = int(query.get('pageSize', 100))
+        with self._lock:
+            page = self.changes[start:start + page_size]
+            next_token = str(start + len(page) + 1)
+            done = start + page_size >= len(self.changes)
+        changes = []
+        for file_id, removed in page:
+            item = self.files.get(file_id)
+            change = {'changeType': 'file', 'fileId': file_id, 'removed': removed or item is None}
+            if item is not None:
+                change['file'] = self._resource(item)
+            changes.append(change)
+        result = {'changes': changes}
+        result['newStartPageToken' if done else 'nextPageToken'] = next_token
+        return self._json(200, result)
+
+    def _permissions(self, method, item, body, permission_id):
+        if method == 'POST':
+            self._count('permissions.create')
+            permission = {'id': self._new_id('P'), 'kind': 'drive#permission', **json.loads(body or b'{}')}
+            item['permissions'].append(permission)
+            return self._json(200, permission)
+        if method == 'DELETE':
+            self._count('permissions.delete')
+            item['permissions'] = [p for p in item['permissions'] if p['id'] != permission_id]
+            return 204, {}, b''
+        self._count('permissions.list')
+        return self._json(200, {'permissions': item['permissions']})
+
+    # Uploads
+
+    def _upload(self, method, query, headers, body):
+        upload_type = query.get('uploadType')
+        if method == 'PUT' and 'upload_id' in query:
+            self._count('upload.resumable_chunk')
+            return self._session_chunk(query['upload_id'], headers, body)
+        if upload_type == 'multipart':
+            self._count('upload.multipart')
+            metadata, data = self._split_related(headers['content-type'], body)
+            return self._json(200, self._resource(self._store(metadata, data)))
+        if upload_type == 'resumable':
+            self._count('upload.resumable_start')
+            session_id = self._new_id('S')
+            with self._lock:
+                self.sessions[session_id] = {
+                    'metadata': json.loads(body or b'{}'),
+                    'mimeType': headers.get('x-upload-content-type'),
+                    'data': bytearray()
+                }
+            location = f"{self.root_url}upload/drive/v3/files?uploadType=resumable&upload_id={session_id}"
+            return 200, {'Location': location}, b''
+        if upload_type == 'media':
+            self._count('upload.media')
+            return self._json(200, self._resource(self._store({'mimeType': headers.get('content-type')}, body)))
+        return self._error(400, 'badRequest', f'Unsupported uploadType {upload_type}')
+
+    def _session_chunk(self, session_id, headers, body):
+        session = self.sessions.get(session_id)
+        if session is None:
+            return self._error(404, 'notFound', 'Upload session not found')
+        content_range = headers.get('content-range', f'bytes */{len(body)}')
+        match = re.fullmatch(r'bytes (?:(\d+)-(\d+)|\*)/(\d+|\*)', content_range)
+        if not match:
+            return self._error(400, 'badContentRange', content_range)
+        data = session['data']
+        if match[1] is not None:
+            start = int(match[1])
+            if start > len(data):
+                return self._error(400, 'badContentRange', f'Expected offset {len(data)}, got {start}')
+            del data[start:]
+            data.extend(body)
+        total = match[3]
+        if total != '*' and int(total) == len(data):
+            metadata = dict(session['metadata'])
+            metadata.setdefault('mimeType', session['mimeType'])
+            with self._lock:
+                self.sessions.pop(session_id, None)
+            return self._json(200, self._resource(self._store(metadata, bytes(data))))
+        return 308, ({'Range': f'bytes=0-{len(data) - 1}'} if data else {}), b''
+
+    def _split_related(self, content_type, body):
+        """Metadata and media from a multipart/related upload body."""
+        boundary = re.search(r'boundary="?([^";]+)"?', content_type)[1].encode()
+        parts = []
+        for part in body.split(b'--' + boundary)[1:]:
+            if part.startswith(b'--'):
+                break
+            # The client library separates with \n, httpx-built bodies with \r\n
+            match = re.search(rb'\r?\n\r?\n', part)
+            content = part[match.end():]
+            parts.append(content.removesuffix(b'\n').removesuffix(b'\r'))
+        return json.loads(parts[0]), parts[1]
+
+    # Batch
+
+    def _batch(self, headers, body):
+        message = email.message_from_bytes(
+            b'Content-Type: ' + headers['content-type'].encode() + b'\r\n\r\n' + body, policy=compat32
+        )
+        boundary = f'batch_{self._new_id("B")}'
+        out = []
+        for part in message.get_payload():
+            inner = part.get_payload(decode=False)
+            head, _, inner_body = inner.replace('\r\n', '\n').partition('\n\n')
+            request_line, *header_lines = head.split('\n')
+            inner_method, inner_target, _ = request_line.split(' ', 2)
+            inner_headers = dict(headers)
+            for line in header_lines:
+                name, _, value = line.partition(':')
+                inner_headers[name.strip().lower()] = value.strip()
+            status, response_headers, response_body = self.handle(inner_method, inner_target, inner_headers, inner_body.encode())
+            lines = [f'HTTP/1.1 {status} {"OK" if status < 400 else "Error"}']
+            lines += [f'{name}: {value}' for name, value in response_headers.items()]
+            # googleapiclient expects at least one header line in every part, as Drive sends
+            lines.append(f'Content-Length: {len(response_body)}')
+            content_id = part['Content-ID'].strip('<>')
+            out.append(
+                f'--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n'
+                + '\r\n'.join(lines) + '\r\n\r\n' + response_body.decode() + '\r\n'
+            )
+        out.append(f'--{boundary}--\r\n')
+        return 200, {'Content-Type': f'multipart/mixed; boundary={boundary}'}, ''.join(out).encode()
+
+    # Responses
+
+    def _json(self, status, payload):
+        return status, {'Content-Type': 'application/json; charset=UTF-8'}, json.dumps(payload).encode()
+
+    def _error(self, status, reason, message):
+        return self._json(status, {'error': {'code': status, 'message': message, 'errors': [{'reason': reason, 'message': message}]}})
+
+
+class FakeDriveRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if not size:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            return b''.join(chunks)
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def _throttle(self, nbytes):
+        bandwidth = self.server.drive.bandwidth
+        if bandwidth and nbytes:
+            time.sleep(nbytes / bandwidth)
+
+    def _handle(self):
+        drive = self.server.drive
+        body = self._read_body()
+        with drive._lock:
+            drive.http_requests += 1
+        if drive.latency:
+            time.sleep(drive.latency)
+        self._throttle(len(body))
+
+        headers = {name.lower(): value for name, value in self.headers.items()}
+        try:
+            status, response_headers, response_body = drive.handle(self.command, self.path, headers, body)
+        except Exception as e:
+            status, response_headers, response_body = drive._error(500, 'internalError', repr(e))
+
+        self.send_response(status)
+        for name, value in response_headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(response_body)))
+        self.end_headers()
+        for offset in range(0, len(response_body), WRITE_BLOCK_SIZE):
+            block = response_body[offset:offset + WRITE_BLOCK_SIZE]
+            self._throttle(len(block))
+            self.wfile.write(block)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _handle
+
+
+class FakeDriveServer(ThreadingHTTPServer):
+    """A FakeDrive served over HTTP from a background thread."""
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, host='127.0.0.1', port=0, **options):
+        super().__init__((host, port), FakeDriveRequestHandler)
+        self.drive = FakeDrive(self.root_url, **options)
+        self._thread = None
+
+    @property
+    def root_url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name='fake-drive', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    parser.add_argument('--bandwidth', type=parse_size, default=None, help='bytes per second per connection, e.g. 20M')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of API requests answered with 503')
+    parser.add_argument('--quota', type=int, default=None, help='API requests per second before answering userRateLimitExceeded')
+    args = parser.parse_args()
+
+    server = FakeDriveServer(
+        args.host, args.port,
+        latency=args.latency, bandwidth=args.bandwidth, error_rate=args.error_rate, quota=args.quota
+    )
+    print(f"Fake Drive listening on {server.root_url} (token_uri {server.root_url}token)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
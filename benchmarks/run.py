@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+"""
+GDriveFTP Benchmark Suite
+
+Runs GoogleDriveService operations and the transfer views against a local
+fake Drive server (benchmarks/fake_drive.py) with injected latency and
+bandwidth, and reports latency, throughput and Drive requests per
+operation. Results are compared with benchmarks/baseline.json; a slower
+median, lower throughput or any extra Drive request is a regression and
+makes the run exit with status 1.
+
+Usage:
+    python benchmarks/run.py
+    python benchmarks/run.py --only view. --repeat 10
+    python benchmarks/run.py --update-baseline
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import datetime
+import tempfile
+import statistics
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, PROJECT_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'gdriveftp.settings')
+
+import django
+django.setup()
+
+from django.conf import settings
+from django.test import Client
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from django.test.runner import DiscoverRunner
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+
+from fake_drive import FakeDriveServer, FOLDER_MIME_TYPE, parse_size, write_credentials
+from ftp.drive_pool import pool
+from ftp.gdrive import GoogleDriveService
+from ftp.models import FileEntry
+from ftp.sharing import share_items
+from ftp.tuning import tuner
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BASELINE = os.path.join(BENCHMARK_DIR, 'baseline.json')
+DEFAULT_LATENCY = 0.02
+DEFAULT_BANDWIDTH = '50M'
+DEFAULT_TOLERANCE = 0.25
+# Timing differences below this many milliseconds are never regressions
+NOISE_FLOOR_MS = 5.0
+
+SMALL_FILE = 256 * 1024
+LARGE_FILE = 16 * 1024 * 1024
+LISTED_ITEMS = 2500
+
+
+class Benchmark:
+    """One timed operation. setup() runs untimed before every repetition."""
+
+    def __init__(self, name, run, setup=None, description=''):
+        self.name = name
+        self.run = run
+        self.setup = setup
+        self.description = description
+
+
+class Context:
+    """Shared state for a run: the fake Drive, a Drive service, a logged-in client."""
+
+    def __init__(self, server):
+        self.server = server
+        self.drive = server.drive
+        self.service = GoogleDriveService()
+        self.user = User.objects.create_user('benchmark', password='benchmark')
+        self.root_folder = self.drive.add_file('gdriveftp_benchmark', mime_type=FOLDER_MIME_TYPE)
+        profile = self.user.profile
+        profile.is_approved = True
+        profile.drive_folder_id = self.root_folder
+        profile.save()
+        self.client = Client()
+        self.client.force_login(self.user)
+
+        self.listed_folder = self.drive.add_file('listed', mime_type=FOLDER_MIME_TYPE)
+        for i in range(LISTED_ITEMS):
+            self.drive.add_file(f'item-{i}.txt', b'x', parents=[self.listed_folder])
+        self.large_file = self.drive.add_file('large.bin', os.urandom(LARGE_FILE), parents=[self.root_folder])
+        self.large_entry = FileEntry.objects.create(
+            user=self.user, file_name='large.bin', file_size=LARGE_FILE,
+            file_type='application/octet-stream', drive_file_id=self.large_file
+        )
+        self.share_targets = [self.drive.add_file(f'shared-{i}.txt', b'x', parents=[self.root_folder]) for i in range(50)]
+
+    def new_entry(self, size=SMALL_FILE):
+        data = os.urandom(size)
+        drive_file_id = self.drive.add_file('victim.bin', data, parents=[self.root_folder])
+        return FileEntry.objects.create(
+            user=self.user, file_name='victim.bin', file_size=size,
+            file_type='application/octet-stream', drive_file_id=drive_file_id
+        )
+
+
+def _consume(response):
+    if response.streaming:
+        return sum(len(chunk) for chunk in response.streaming_content)
+    return len(response.content)
+
+
+def _check(result, what):
+    # Service methods log and return None on failure; a failed call must not pass as a fast one
+    if not result:
+        raise RuntimeError(f"{what} failed")
+    return result
+
+
+def upload_small(ctx, _):
+    _check(ctx.service.upload_fileobj(io.BytesIO(os.urandom(SMALL_FILE)), 'small.bin', ctx.root_folder), 'upload')
+    return SMALL_FILE
+
+
+def upload_large(ctx, data):
+    _check(ctx.service.upload_fileobj(io.BytesIO(data), 'large.bin', ctx.root_folder), 'upload')
+    return len(data)
+
+
+def download_stream(ctx, _):
+    download = _check(ctx.service.download_stream(ctx.large_file), 'download')
+    return sum(len(chunk) for chunk in download)
+
+
+def download_range(ctx, _):
+    download = _check(ctx.service.download_stream(ctx.large_file, 1024 * 1024, 2 * 1024 * 1024 - 1), 'download')
+    return sum(len(chunk) for chunk in download)
+
+
+def list_folder(ctx, _):
+    items = ctx.service.list_files_and_folders(ctx.listed_folder)
+    if len(items) != LISTED_ITEMS:
+        raise RuntimeError(f"listed {len(items)} of {LISTED_ITEMS} items")
+
+
+def create_subfolder(ctx, _):
+    _check(ctx.service.create_subfolder('sub', ctx.root_folder), 'create_subfolder')
+
+
+def copy_file(ctx, _):
+    _check(ctx.service.copy_file(ctx.large_file, 'copy.bin', ctx.root_folder), 'copy_file')
+
+
+def share_50(ctx, _):
+    shared = share_items(ctx.service, ctx.share_targets, 'reader@example.com')
+    if shared != len(ctx.share_targets):
+        raise RuntimeError(f"shared {shared} of {len(ctx.share_targets)} files")
+
+
+def delete_file(ctx, entry):
+    _check(ctx.service.delete_file(entry.drive_file_id), 'delete_file')
+
+
+def dashboard_view(ctx, _):
+    response = ctx.client.get('/dashboard/')
+    _check(response.status_code == 200, f'dashboard ({response.status_code})')
+
+
+def upload_view(ctx, files):
+    entries = FileEntry.objects.count()
+    response = ctx.client.post('/upload/', {'file': files})
+    _check(response.status_code == 302 and FileEntry.objects.count() == entries + len(files), 'upload view')
+    return sum(f.size for f in files)
+
+
+def download_view(ctx, _, headers=None):
+    response = ctx.client.get(f'/download/{ctx.large_entry.id}/', headers=headers or {})
+    _check(response.status_code in (200, 206), f'download view ({response.status_code})')
+    return _consume(response)
+
+
+def download_range_view(ctx, _):
+    return download_view(ctx, _, {'Range': 'bytes=0-1048575'})
+
+
+def delete_view(ctx, entry):
+    ctx.client.post(f'/delete/file/{entry.id}/')
+    _check(not FileEntry.objects.filter(id=entry.id).exists(), 'delete view')
+
+
+def new_files(count, size=SMALL_FILE):
+    return lambda ctx: [SimpleUploadedFile(f'up-{i}.bin', os.urandom(size)) for i in range(count)]
+
+
+BENCHMARKS = [
+    Benchmark('service.upload_small', upload_small, description='upload_fileobj of 256 KiB (multipart)'),
+    Benchmark('service.upload_large', upload_large, setup=lambda ctx: os.urandom(LARGE_FILE),
+              description='upload_fileobj of 16 MiB (resumable)'),
+    Benchmark('service.download_stream', download_stream, description='download_stream of 16 MiB'),
+    Benchmark('service.download_range', download_range, description='download_stream of a 1 MiB range'),
+    Benchmark('service.list_folder', list_folder, description=f'list_files_and_folders of {LISTED_ITEMS} items'),
+    Benchmark('service.create_subfolder', create_subfolder, description='create_subfolder in a known folder'),
+    Benchmark('service.copy_file', copy_file, description='copy_file (server-side copy used by deduplication)'),
+    Benchmark('service.share_50', share_50, description='share_items of 50 files (batch request)'),
+    Benchmark('service.delete_file', delete_file, setup=lambda ctx: ctx.new_entry(), description='delete_file'),
+    Benchmark('view.dashboard', dashboard_view, description='GET /dashboard/'),
+    Benchmark('view.upload_3_files', upload_view, setup=new_files(3),
+              description='POST /upload/ with three new 256 KiB files'),
+    Benchmark('view.upload_duplicate', upload_view,
+              setup=lambda ctx: [SimpleUploadedFile('dup.bin', b'duplicate content' * 1000)],
+              description='POST /upload/ of content already in Drive (copied, not uploaded)'),
+    Benchmark('view.download', download_view, description='GET /download/ of 16 MiB'),
+    Benchmark('view.download_range', download_range_view, description='GET /download/ with a 1 MiB Range'),
+    Benchmark('view.delete_file', delete_view, setup=lambda ctx: ctx.new_entry(), description='POST /delete/file/'),
+]
+
+
+def measure(ctx, benchmark, repeat):
+    """Run a benchmark repeat times after one warm-up; returns its result dict."""
+    tuner.reset()
+    timings = []
+    nbytes = 0
+    requests = 0
+    calls = {}
+    for iteration in range(repeat + 1):
+        state = benchmark.setup(ctx) if benchmark.setup else None
+        before_requests, before_calls = ctx.drive.counts()
+        started = time.perf_counter()
+        moved = benchmark.run(ctx, state) or 0
+        elapsed = time.perf_counter() - started
+        after_requests, after_calls = ctx.drive.counts()
+        if iteration == 0:
+            continue
+        timings.append(elapsed)
+        nbytes += moved
+        tokens = after_calls.get('oauth.token', 0) - before_calls.get('oauth.token', 0)
+        requests += after_requests - before_requests - tokens
+        for label, count in after_calls.items():
+            if label != 'oauth.token' and count - before_calls.get(label, 0):
+                calls[label] = calls.get(label, 0) + count - before_calls.get(label, 0)
+
+    timings.sort()
+    median = statistics.median(timings)
+    result = {
+        'description': benchmark.description,
+        'median_ms': round(median * 1000, 2),
+        'p95_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.95))] * 1000, 2),
+        'min_ms': round(timings[0] * 1000, 2),
+        'drive_requests': round(requests / repeat, 2),
+        'drive_calls': {label: round(count / repeat, 2) for label, count in sorted(calls.items())},
+    }
+    if nbytes:
+        result['throughput_mb_s'] = round(nbytes / repeat / median / (1024 * 1024), 2)
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """Regressions of results against a baseline, as human-readable strings."""
+    regressions = []
+    same_conditions = baseline.get('config') == results['config']
+    if not same_conditions:
+        logger.warning("Baseline was recorded with different latency/bandwidth; only Drive request counts are compared")
+
+    for name, result in results['benchmarks'].items():
+        expected = baseline.get('benchmarks', {}).get(name)
+        if expected is None:
+            continue
+        if result['drive_requests'] > expected['drive_requests']:
+            regressions.append(f"{name}: {result['drive_requests']} Drive requests per operation, baseline {expected['drive_requests']}")
+        if not same_conditions:
+            continue
+        slower = result['median_ms'] - expected['median_ms']
+        if slower > NOISE_FLOOR_MS and result['median_ms'] > expected['median_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: median {result['median_ms']}ms, baseline {expected['median_ms']}ms")
+        if 'throughput_mb_s' in expected and result.get('throughput_mb_s', 0) < expected['throughput_mb_s'] * (1 - tolerance):
+            regressions.append(f"{name}: {result.get('throughput_mb_s')} MB/s, baseline {expected['throughput_mb_s']} MB/s")
+    return regressions
+
+
+def print_table(results, baseline):
+    expected = baseline.get('benchmarks', {}) if baseline else {}
+    print(f"{'benchmark':<28}{'median ms':>11}{'p95 ms':>10}{'MB/s':>9}{'requests':>10}{'baseline ms':>13}")
+    for name, result in results['benchmarks'].items():
+        base = expected.get(name, {}).get('median_ms', '-')
+        throughput = result.get('throughput_mb_s', '-')
+        print(f"{name:<28}{result['median_ms']:>11}{result['p95_ms']:>10}{throughput:>9}{result['drive_requests']:>10}{base:>13}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark GDriveFTP against a local fake Drive server.')
+    parser.add_argument('--repeat', type=int, default=5, help='timed repetitions per benchmark (after one warm-up)')
+    parser.add_argument('--only', action='append', help='run benchmarks whose name starts with this (repeatable)')
+    parser.add_argument('--latency', type=float, default=DEFAULT_LATENCY, help='seconds the fake Drive adds to each request')
+    parser.add_argument('--bandwidth', default=DEFAULT_BANDWIDTH, help='fake Drive bandwidth per connection, e.g. 50M')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help='allowed fractional slowdown before flagging')
+    parser.add_argument('--update-baseline', action='store_true', help='write these results as the new baseline')
+    parser.add_argument('--output', help='also write the results to this JSON file')
+    parser.add_argument('--verbose', action='store_true', help='show application logging')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s %(message)s')
+    if not args.verbose:
+        logging.getLogger('ftp').setLevel(logging.WARNING)
+        logging.getLogger('googleapiclient').setLevel(logging.WARNING)
+        logging.getLogger('django').setLevel(logging.ERROR)
+
+    benchmarks = [b for b in BENCHMARKS if not args.only or any(b.name.startswith(prefix) for prefix in args.only)]
+    config = {'latency': args.latency, 'bandwidth': parse_size(args.bandwidth)}
+    server = FakeDriveServer(**config).start()
+    workdir = tempfile.mkdtemp(prefix='gdriveftp-bench-')
+
+    overrides = override_settings(
+        ALLOWED_HOSTS=['testserver'],
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        GOOGLE_DRIVE_API_ROOT_URL=server.root_url,
+        GOOGLE_DRIVE_STORAGE_JSON_KEY_FILE=write_credentials(workdir, server.root_url),
+        GOOGLE_DRIVE_DOWNLOAD_CACHE_BYTES=0,
+        GOOGLE_DRIVE_BACKGROUND_TRANSFERS=False,
+        GOOGLE_DRIVE_METRICS_DIR=None,
+        GOOGLE_DRIVE_RETRY_BASE_DELAY=0.05,
+        # Back-to-back repetitions would otherwise spend their time waiting for quota
+        GOOGLE_DRIVE_RATE_LIMIT=None,
+    )
+    setup_test_environment()
+    runner = DiscoverRunner(verbosity=0)
+    old_config = runner.setup_databases()
+    overrides.enable()
+    try:
+        pool.reset()
+        if not pool.warm_up():
+            sys.exit("Could not authenticate against the fake Drive server")
+        ctx = Context(server)
+        results = {
+            'config': config,
+            'recorded_at': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'benchmarks': {},
+        }
+        for benchmark in benchmarks:
+            logger.info(f"Running {benchmark.name}: {benchmark.description}")
+            results['benchmarks'][benchmark.name] = measure(ctx, benchmark, args.repeat)
+    finally:
+        overrides.disable()
+        pool.reset()
+        runner.teardown_databases(old_config)
+        teardown_test_environment()
+        server.stop()
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_table(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.update_baseline:
+        if baseline and args.only:
+            # Keep the entries of benchmarks that were not run
+            results['benchmarks'] = {**baseline.get('benchmarks', {}), **results['benchmarks']}
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    if baseline is None:
+        print("No baseline to compare with; record one with --update-baseline")
+        return 0
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if not regressions:
+        print("No regressions against the baseline")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,16 +4,30 @@ Google Drive API Test Report Generator
 
 This script performs a series of tests to diagnose Google Drive API integration issues
 and generates a comprehensive report.
+
+With --load it instead simulates concurrent users uploading, downloading, listing
+and deleting files through GoogleDriveService, and reports per-operation latency
+percentiles, throughput over time and rate-limit and error counts:
+
+    python drive_report.py --load --users 20 --duration 120 --mix upload=2,download=5,list=2,delete=1
+    python drive_report.py --load --compare drive_load_report_previous.json
+    python drive_report.py --load --fake-drive --quota 100   # against benchmarks/fake_drive.py
 """
 
+import io
 import os
 import sys
 import json
+import math
+import random
 import logging
+import argparse
 import tempfile
 import platform
+import time
 import datetime
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 # Set up logging
 logging.basicConfig(
@@ -26,6 +40,14 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(PROJECT_DIR, 'benchmarks'))
+from fake_drive import parse_size
+
+LOAD_OPERATIONS = ('upload', 'download', 'list', 'delete')
+DEFAULT_MIX = 'upload=3,download=4,list=2,delete=1'
+PERCENTILES = (50, 95, 99)
+
 def generate_system_info():
     """Generate system information for the report."""
     info = {
@@ -232,12 +254,335 @@ def generate_report(share_email=None):
     
     return report
 
+def parse_mix(value):
+    """'upload=3,download=4' -> {'upload': 3.0, 'download': 4.0}"""
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in LOAD_OPERATIONS:
+            raise argparse.ArgumentTypeError(f"Unknown operation '{name}'; choose from {', '.join(LOAD_OPERATIONS)}")
+        mix[name] = float(weight or 1)
+    if not any(mix.values()):
+        raise argparse.ArgumentTypeError("The operation mix needs at least one positive weight")
+    return mix
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    return sorted_values[max(1, math.ceil(p / 100 * len(sorted_values))) - 1]
+
+def _load_operation(drive_service, op, folder_id, rng, files, name, payloads):
+    """Run one load operation. Returns (succeeded, bytes moved)."""
+    if op == 'upload':
+        payload = payloads[rng.randrange(len(payloads))]
+        file_id = drive_service.upload_fileobj(io.BytesIO(payload), name, folder_id, mime_type='application/octet-stream')
+        if not file_id:
+            return False, 0
+        files.append(file_id)
+        return True, len(payload)
+    
+    if op == 'download':
+        download = drive_service.download_stream(rng.choice(files))
+        if download is None:
+            return False, 0
+        return True, sum(len(chunk) for chunk in download)
+    
+    if op == 'delete':
+        file_id = files.pop(rng.randrange(len(files)))
+        return bool(drive_service.delete_file(file_id)), 0
+    
+    # Listing errors are logged and return [], so they are detected from the trace
+    drive_service.list_files_and_folders(folder_id)
+    return True, 0
+
+def _simulate_user(index, folder_id, args, payloads, clock_start, deadline):
+    """One simulated user: runs operations from the mix until the deadline. Returns its samples."""
+    from ftp.gdrive import GoogleDriveService
+    from ftp.tracing import start_trace
+    
+    # Seeded per user, so runs with the same options issue the same sequence of operations
+    rng = random.Random(args.seed * 1000 + index)
+    operations, weights = zip(*args.mix.items())
+    drive_service = GoogleDriveService()
+    files = []
+    samples = []
+    
+    while time.monotonic() < deadline and not (args.operations and len(samples) >= args.operations):
+        op = rng.choices(operations, weights)[0]
+        if op in ('download', 'delete') and not files:
+            op = 'upload'
+        
+        with start_trace() as trace:
+            began = time.monotonic()
+            try:
+                ok, nbytes = _load_operation(drive_service, op, folder_id, rng, files, f"load_{index}_{len(samples)}.bin", payloads)
+            except Exception as e:
+                logger.warning(f"User {index} {op} failed: {e}")
+                ok, nbytes = False, 0
+            seconds = time.monotonic() - began
+        
+        samples.append({
+            'op': op,
+            'start': began - clock_start,
+            'seconds': seconds,
+            'bytes': nbytes,
+            'ok': ok and not trace.errors,
+            'drive_calls': len(trace),
+            'retries': trace.retries,
+            'rate_limited': trace.rate_limited,
+            'throttled': trace.throttled,
+        })
+        if args.think_time:
+            time.sleep(rng.expovariate(1 / args.think_time))
+    return samples
+
+def summarize_load(samples, duration, interval):
+    """Per-operation statistics and a throughput timeline from raw samples."""
+    operations = {}
+    for op in LOAD_OPERATIONS:
+        op_samples = [sample for sample in samples if sample['op'] == op]
+        if not op_samples:
+            continue
+        latencies = sorted(sample['seconds'] * 1000 for sample in op_samples)
+        errors = sum(1 for sample in op_samples if not sample['ok'])
+        nbytes = sum(sample['bytes'] for sample in op_samples)
+        operations[op] = {
+            'count': len(op_samples),
+            'errors': errors,
+            'error_rate': round(errors / len(op_samples), 4),
+            **{f'p{p}_ms': round(percentile(latencies, p), 1) for p in PERCENTILES},
+            'max_ms': round(latencies[-1], 1),
+            'mean_ms': round(sum(latencies) / len(latencies), 1),
+            'mb_per_s': round(nbytes / duration / (1024 * 1024), 3),
+            'drive_calls_per_op': round(sum(sample['drive_calls'] for sample in op_samples) / len(op_samples), 2),
+            'retries': sum(sample['retries'] for sample in op_samples),
+            'rate_limited': sum(sample['rate_limited'] for sample in op_samples),
+            'throttled_s': round(sum(sample['throttled'] for sample in op_samples), 2),
+        }
+    
+    # Samples are placed in the interval in which they finished; the last
+    # interval absorbs the remainder so a sliver at the end cannot skew rates
+    timeline = []
+    buckets = max(1, int(duration // interval))
+    for bucket in range(buckets):
+        start = bucket * interval
+        end = duration if bucket == buckets - 1 else start + interval
+        last = bucket == buckets - 1
+        finished = [sample for sample in samples if start <= sample['start'] + sample['seconds'] and (last or sample['start'] + sample['seconds'] < end)]
+        width = end - start
+        timeline.append({
+            'start_s': start,
+            'ops_per_s': round(len(finished) / width, 2),
+            'upload_mb_per_s': round(sum(s['bytes'] for s in finished if s['op'] == 'upload') / width / (1024 * 1024), 3),
+            'download_mb_per_s': round(sum(s['bytes'] for s in finished if s['op'] == 'download') / width / (1024 * 1024), 3),
+            'errors': sum(1 for s in finished if not s['ok']),
+            'rate_limited': sum(s['rate_limited'] for s in finished),
+        })
+    
+    errors = sum(1 for sample in samples if not sample['ok'])
+    totals = {
+        'operations': len(samples),
+        'ops_per_s': round(len(samples) / duration, 2),
+        'errors': errors,
+        'error_rate': round(errors / len(samples), 4) if samples else 0,
+        'drive_calls': sum(sample['drive_calls'] for sample in samples),
+        'retries': sum(sample['retries'] for sample in samples),
+        'rate_limited': sum(sample['rate_limited'] for sample in samples),
+        'throttled_s': round(sum(sample['throttled'] for sample in samples), 2),
+    }
+    return operations, timeline, totals
+
+def compare_load_reports(report, previous, tolerance):
+    """Lines describing how a load report differs from a previous one; worse results are flagged."""
+    lines = []
+    if report['config'] != previous.get('config'):
+        changed = sorted(key for key in set(report['config']) | set(previous.get('config', {}))
+                         if report['config'].get(key) != previous.get('config', {}).get(key))
+        lines.append(f"Note: the runs used different settings ({', '.join(changed)}); differences may not be meaningful")
+    
+    def delta(name, old, new, higher_is_worse=True):
+        if old is None or new is None:
+            return
+        change = (new - old) / old if old else (0.0 if new == old else math.inf)
+        worse = change > tolerance if higher_is_worse else change < -tolerance
+        lines.append(f"{'WORSE ' if worse else ''}{name}: {old} -> {new} ({change:+.0%})")
+    
+    delta('ops/s', previous['totals']['ops_per_s'], report['totals']['ops_per_s'], higher_is_worse=False)
+    delta('error rate', previous['totals']['error_rate'], report['totals']['error_rate'])
+    delta('rate-limited responses', previous['totals']['rate_limited'], report['totals']['rate_limited'])
+    for op, stats in report['operations'].items():
+        old = previous.get('operations', {}).get(op)
+        if not old:
+            continue
+        for p in PERCENTILES:
+            delta(f"{op} p{p} ms", old.get(f'p{p}_ms'), stats[f'p{p}_ms'])
+    return lines
+
+def log_load_report(report):
+    """Print a load report in the same log format as the API report."""
+    logger.info("=" * 60)
+    logger.info("GOOGLE DRIVE LOAD TEST REPORT")
+    logger.info("=" * 60)
+    config, totals = report['config'], report['totals']
+    logger.info(f"{config['users']} users for {report['duration_s']}s, mix {config['mix']}, file sizes {config['file_sizes']}")
+    logger.info(f"{totals['operations']} operations ({totals['ops_per_s']}/s), {totals['errors']} errors, "
+                f"{totals['rate_limited']} rate-limited responses, {totals['retries']} retries, "
+                f"{totals['throttled_s']}s waiting for the local rate limiter")
+    
+    logger.info(f"{'operation':<10}{'count':>7}{'errors':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}{'MB/s':>8}{'calls/op':>10}{'429/403':>9}")
+    for op, stats in report['operations'].items():
+        logger.info(f"{op:<10}{stats['count']:>7}{stats['errors']:>8}{stats['p50_ms']:>9}{stats['p95_ms']:>9}{stats['p99_ms']:>9}"
+                    f"{stats['max_ms']:>9}{stats['mb_per_s']:>8}{stats['drive_calls_per_op']:>10}{stats['rate_limited']:>9}")
+    
+    logger.info("Throughput over time:")
+    for point in report['timeline']:
+        logger.info(f"  {point['start_s']:>5}s  {point['ops_per_s']:>7} ops/s  up {point['upload_mb_per_s']:>7} MB/s  "
+                    f"down {point['download_mb_per_s']:>7} MB/s  errors {point['errors']:>3}  rate-limited {point['rate_limited']:>3}")
+
+def run_load_test(args):
+    """Run the load test described by args and write its report. Returns True if it ran."""
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'gdriveftp.settings')
+    import django
+    django.setup()
+    from django.test.utils import override_settings
+    from ftp.drive_pool import pool
+    from ftp.gdrive import GoogleDriveService
+    
+    if not args.verbose:
+        logging.getLogger('ftp').setLevel(logging.ERROR)
+        logging.getLogger('googleapiclient').setLevel(logging.WARNING)
+    
+    overrides = {}
+    server = None
+    if args.fake_drive:
+        from fake_drive import FakeDriveServer, write_credentials
+        server = FakeDriveServer(latency=args.latency, bandwidth=args.bandwidth, error_rate=args.error_rate, quota=args.quota).start()
+        overrides['GOOGLE_DRIVE_API_ROOT_URL'] = server.root_url
+        overrides['GOOGLE_DRIVE_STORAGE_JSON_KEY_FILE'] = write_credentials(tempfile.mkdtemp(prefix='drive_report_'), server.root_url)
+        logger.info(f"Running against the fake Drive server at {server.root_url}")
+    if args.drive_rate_limit is not None:
+        overrides['GOOGLE_DRIVE_RATE_LIMIT'] = args.drive_rate_limit or None
+    settings_override = override_settings(**overrides)
+    settings_override.enable()
+    
+    drive_service = None
+    run_folder = None
+    try:
+        pool.reset()
+        if not pool.warm_up():
+            logger.error("Could not initialize the Google Drive client")
+            return False
+        drive_service = GoogleDriveService()
+        run_folder = drive_service.create_user_folder(
+            f"gdriveftp_load_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}",
+            share_with_email=args.share_email
+        )
+        if not run_folder:
+            logger.error("Failed to create the load test folder")
+            return False
+        user_folders = [drive_service.create_subfolder(f"user_{index}", run_folder) for index in range(args.users)]
+        if not all(user_folders):
+            logger.error("Failed to create the per-user folders")
+            return False
+        
+        payload_rng = random.Random(args.seed)
+        payloads = [payload_rng.randbytes(size) for size in args.file_sizes]
+        
+        logger.info(f"Starting {args.users} users for {args.duration}s with mix {args.mix}")
+        clock_start = time.monotonic()
+        deadline = clock_start + args.duration
+        with ThreadPoolExecutor(max_workers=args.users, thread_name_prefix='load-user') as executor:
+            futures = [
+                executor.submit(_simulate_user, index, user_folders[index], args, payloads, clock_start, deadline)
+                for index in range(args.users)
+            ]
+            samples = [sample for future in futures for sample in future.result()]
+    finally:
+        if drive_service and run_folder and not args.keep_files:
+            drive_service.delete_folder(run_folder)
+        settings_override.disable()
+        pool.reset()
+        if server:
+            server.stop()
+    
+    duration = max((sample['start'] + sample['seconds'] for sample in samples), default=0) or 1
+    operations, timeline, totals = summarize_load(samples, duration, args.interval)
+    report = {
+        'timestamp': datetime.datetime.now().isoformat(),
+        'system_info': generate_system_info(),
+        'config': {
+            'users': args.users,
+            'mix': args.mix,
+            'file_sizes': args.file_sizes,
+            'duration': args.duration,
+            'operations_per_user': args.operations,
+            'think_time': args.think_time,
+            'seed': args.seed,
+            'drive_rate_limit': args.drive_rate_limit,
+            'fake_drive': {
+                'latency': args.latency, 'bandwidth': args.bandwidth, 'error_rate': args.error_rate, 'quota': args.quota
+            } if args.fake_drive else None,
+        },
+        'duration_s': round(duration, 2),
+        'totals': totals,
+        'operations': operations,
+        'timeline': timeline,
+    }
+    log_load_report(report)
+    
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        logger.info(f"Compared with {args.compare} ({previous.get('timestamp')}):")
+        for line in compare_load_reports(report, previous, args.tolerance):
+            logger.info(f"  {line}")
+    
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"\nLoad report saved to: {args.output}")
+    return True
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Check the Google Drive API integration, or load-test it with --load.")
+    parser.add_argument('share_email', nargs='?', help="email address to share the test folder with")
+    
+    load = parser.add_argument_group('load mode')
+    load.add_argument('--load', action='store_true', help="simulate concurrent users instead of running the API checks")
+    load.add_argument('--users', type=int, default=10, help="concurrent simulated users (default 10)")
+    load.add_argument('--duration', type=float, default=60, help="seconds to run (default 60)")
+    load.add_argument('--operations', type=int, default=None, help="stop each user after this many operations")
+    load.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f"operation weights (default {DEFAULT_MIX})")
+    load.add_argument('--file-sizes', type=lambda value: [parse_size(size) for size in value.split(',')], default=[256 * 1024, 4 * 1024 * 1024],
+                      help="upload sizes to pick from, e.g. 256K,4M (default)")
+    load.add_argument('--think-time', type=float, default=0.0, help="mean seconds a user pauses between operations")
+    load.add_argument('--interval', type=float, default=5.0, help="seconds per throughput timeline bucket (default 5)")
+    load.add_argument('--seed', type=int, default=1, help="random seed; equal seeds replay the same operations")
+    load.add_argument('--drive-rate-limit', type=int, default=None, help="override GOOGLE_DRIVE_RATE_LIMIT (0 disables it)")
+    load.add_argument('--output', default='drive_load_report.json')
+    load.add_argument('--compare', help="a previous load report to compare with")
+    load.add_argument('--tolerance', type=float, default=0.2, help="relative change flagged as WORSE in comparisons (default 0.2)")
+    load.add_argument('--keep-files', action='store_true', help="leave the uploaded files in Drive")
+    load.add_argument('--verbose', action='store_true', help="show the application's own logging")
+    
+    fake = parser.add_argument_group('fake Drive server (benchmarks/fake_drive.py)')
+    fake.add_argument('--fake-drive', action='store_true', help="run against a local fake Drive server instead of Google")
+    fake.add_argument('--latency', type=float, default=0.05, help="seconds added to each request (default 0.05)")
+    fake.add_argument('--bandwidth', type=parse_size, default=parse_size('20M'), help="bytes per second per connection (default 20M)")
+    fake.add_argument('--error-rate', type=float, default=0.0, help="fraction of requests answered with 503")
+    fake.add_argument('--quota', type=int, default=None, help="requests per second before answering userRateLimitExceeded")
+    return parser.parse_args(argv)
+
 if __name__ == "__main__":
+    args = parse_args()
+    if args.load:
+        sys.exit(0 if run_load_test(args) else 1)
+    
     # Check if email was provided
-    share_email = None
-    if len(sys.argv) > 1:
-        share_email = sys.argv[1]
+    share_email = args.share_email
+    if share_email:
         logger.info(f"Will share test files with: {share_email}")
     
     # Generate report
-    generate_report(share_email)
\ No newline at end of file
+    generate_report(share_email)
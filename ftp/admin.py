@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import UserProfile, FileEntry
+from .models import UserProfile, FileEntry, TransferJob
 
 @admin.register(UserProfile)
 class UserProfileAdmin(admin.ModelAdmin):
@@ -22,4 +22,10 @@ class UserProfileAdmin(admin.ModelAdmin):
 class FileEntryAdmin(admin.ModelAdmin):
     list_display = ('file_name', 'user', 'file_size', 'upload_date')
     list_filter = ('upload_date',)
-    search_fields = ('file_name', 'user__username')
\ No newline at end of file
+    search_fields = ('file_name', 'user__username')
+
+@admin.register(TransferJob)
+class TransferJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'kind', 'user', 'status', 'progress', 'attempts', 'lease_owner', 'created_at')
+    list_filter = ('status', 'kind')
+    search_fields = ('user__username',)
\ No newline at end of file
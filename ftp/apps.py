@@ -1,4 +1,5 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class FtpConfig(AppConfig):
@@ -6,4 +7,10 @@ class FtpConfig(AppConfig):
     name = 'ftp'
     
     def ready(self):
-        import ftp.signals
\ No newline at end of file
+        import ftp.signals
+        
+        # Optionally load credentials and build the Drive client before the
+        # first request instead of during it
+        if getattr(settings, 'GOOGLE_DRIVE_WARM_UP', False):
+            from .drive_pool import warm_up_in_background
+            warm_up_in_background(probe=getattr(settings, 'GOOGLE_DRIVE_WARM_UP_PROBE', False))
\ No newline at end of file
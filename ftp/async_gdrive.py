@@ -0,0 +1,750 @@
+import os
+import io
+import json
+import time
+import uuid
+import asyncio
+import logging
+import weakref
+import mimetypes
+import traceback
+from django.conf import settings
+from django.utils import timezone
+
+import httplib2
+import google_auth_httplib2
+from googleapiclient.errors import HttpError
+
+try:
+    import httpx
+except ImportError:  # the async client is optional; pip install httpx to use it
+    httpx = None
+
+from .drive_pool import pool
+from .tuning import tuner, UPLOAD, DOWNLOAD
+from .tracing import traced, add_bytes
+from .retry import acall_with_retries, backoff_delay, is_retryable, limiter, DEFAULT_MAX_RETRIES
+from .folder_cache import (
+    FALLBACK_ROOT_NAME, forget_folder, get_fallback_root, is_known_folder,
+    remember_folder, set_fallback_root,
+)
+from .gdrive import (
+    FOLDER_MIME_TYPE, LIST_FIELDS, LIST_PAGE_SIZE, MAX_LIST_PAGE_SIZE, RESUMABLE_FIELDS, STREAM_BLOCK_SIZE,
+    _parse_content_range,
+)
+
+logger = logging.getLogger(__name__)
+
+# Connections kept open to Drive by each event loop
+DEFAULT_MAX_CONNECTIONS = 100
+
+
+def available():
+    """True if httpx is installed, so the async client can be used."""
+    return httpx is not None
+
+
+def _http_error(response):
+    """Turn an httpx error response into the HttpError the retry helpers understand."""
+    resp = httplib2.Response({'status': response.status_code, **dict(response.headers.items())})
+    return HttpError(resp, response.content, uri=str(response.url))
+
+
+class AsyncDriveTransport:
+    """Pooled httpx.AsyncClient per event loop, authorised with the shared Drive credentials.
+
+    An AsyncClient belongs to the loop it was created on, so each loop
+    (normally one per ASGI worker process) gets its own connection pool.
+    Access tokens come from the same credentials as the sync client pool, so
+    they are shared with other processes through token_cache; refreshing one
+    may block, so it runs in a thread, once per loop at a time.
+    """
+
+    def __init__(self):
+        self._clients = weakref.WeakKeyDictionary()
+        self._refresh_locks = weakref.WeakKeyDictionary()
+
+    def client(self):
+        if httpx is None:
+            raise RuntimeError("The async Drive client needs the httpx package")
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None or client.is_closed:
+            max_connections = getattr(settings, 'GOOGLE_DRIVE_ASYNC_MAX_CONNECTIONS', DEFAULT_MAX_CONNECTIONS)
+            client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+                # Requests beyond the pool size wait for a connection rather than fail
+                timeout=httpx.Timeout(getattr(settings, 'GOOGLE_DRIVE_HTTP_TIMEOUT', 60), pool=None)
+            )
+            self._clients[loop] = client
+        return client
+
+    def root_url(self):
+        pool.get_credentials()
+        return pool.discovery_doc['rootUrl']
+
+    async def auth_headers(self):
+        credentials = pool.get_credentials()
+        if not credentials.valid:
+            lock = self._refresh_locks.setdefault(asyncio.get_running_loop(), asyncio.Lock())
+            async with lock:
+                if not credentials.valid:
+                    await asyncio.to_thread(credentials.refresh, google_auth_httplib2.Request(httplib2.Http()))
+        return {'Authorization': f'Bearer {credentials.token}'}
+
+    async def aclose(self):
+        """Close the calling loop's connection pool."""
+        client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+
+transport = AsyncDriveTransport()
+
+
+async def _aiter_chunks(chunks):
+    """Iterate an async or plain iterable of byte chunks asynchronously."""
+    if hasattr(chunks, '__aiter__'):
+        async for chunk in chunks:
+            yield chunk
+    else:
+        for chunk in chunks:
+            yield chunk
+
+
+class _UploadSource:
+    """Upload bytes by offset from a seekable file or a stream of chunks.
+
+    Files are read in a worker thread. For streams, only the bytes Drive has
+    not yet committed plus one byte of read-ahead are buffered; size is None
+    until the stream ends.
+    """
+
+    def __init__(self, source):
+        self._file = source if hasattr(source, 'read') and hasattr(source, 'seek') else None
+        self._chunks = None if self._file else _aiter_chunks(source)
+        self._buffer = bytearray()
+        self._buffer_start = 0
+        self.size = None
+        if self._file:
+            self._file.seek(0, os.SEEK_END)
+            self.size = self._file.tell()
+            self._file.seek(0)
+
+    async def read(self, offset, length):
+        if self._file:
+            def read():
+                self._file.seek(offset)
+                return self._file.read(length)
+            return await asyncio.to_thread(read)
+
+        # Drive has committed everything before offset
+        del self._buffer[:offset - self._buffer_start]
+        self._buffer_start = offset
+        while self.size is None and len(self._buffer) <= length:
+            chunk = await anext(self._chunks, None)
+            if chunk is None:
+                self.size = self._buffer_start + len(self._buffer)
+            else:
+                self._buffer.extend(chunk)
+        return bytes(self._buffer[:length])
+
+
+class AsyncDriveDownload:
+    """Async iterator over the bytes of a Drive file, fetched one ranged GET at a time.
+
+    The coroutine counterpart of gdrive.DriveDownload. A reply that ignores
+    the range is streamed as it arrives rather than read whole.
+    """
+
+    def __init__(self, uri, start, end, chunk_size, adaptive=False):
+        self.uri = uri
+        self.start = start
+        self.end = end
+        self.chunk_size = chunk_size
+        self.adaptive = adaptive
+        self.total_size = None
+        self._first_chunk = None
+        self._response = None
+        self._body = None
+        self._pending = bytearray()
+
+    @property
+    def length(self):
+        """Number of bytes this download will yield."""
+        if self.end is None:
+            return None
+        return self.end - self.start + 1
+
+    async def _read_body(self, size):
+        """The next size bytes of a whole-file reply; fewer at the end of the file."""
+        with tuner.timed(DOWNLOAD) as timing:
+            while len(self._pending) < size:
+                block = await anext(self._body, b'')
+                if not block:
+                    break
+                self._pending.extend(block)
+            chunk = bytes(self._pending[:size])
+            del self._pending[:size]
+            timing.nbytes = len(chunk)
+        return chunk
+
+    async def _stream_body(self, response, offset):
+        """Switch to reading a whole-file reply, skipping the bytes before offset."""
+        self._response = response
+        self._body = response.aiter_bytes(STREAM_BLOCK_SIZE)
+        length = response.headers.get('content-length')
+        if length and not response.headers.get('content-encoding'):
+            self.total_size = int(length)
+        skipped = 0
+        while skipped < offset:
+            block = await self._read_body(min(offset - skipped, self.chunk_size))
+            if not block:
+                break
+            skipped += len(block)
+
+    async def _fetch(self, offset):
+        if self.adaptive:
+            self.chunk_size = tuner.chunk_size(DOWNLOAD)
+        last = offset + self.chunk_size - 1
+        if self.end is not None:
+            last = min(last, self.end)
+        if self._body is not None:
+            # Drive is already sending the whole file; keep reading it
+            return await self._read_body(last - offset + 1)
+
+        async def fetch():
+            headers = {'Range': f'bytes={offset}-{last}', **await transport.auth_headers()}
+            client = transport.client()
+            with tuner.timed(DOWNLOAD) as timing:
+                response = await client.send(client.build_request('GET', self.uri, headers=headers), stream=True)
+                if response.status_code != 200:
+                    await response.aread()
+                    timing.nbytes = len(response.content) if response.status_code < 300 else 0
+            if response.status_code >= 300 and response.status_code != 416:
+                raise _http_error(response)
+            return response
+
+        response = await acall_with_retries(fetch, 'Drive ranged download')
+        if response.status_code == 416:
+            # Range starts past the end of the file (e.g. an empty file)
+            return b''
+
+        if response.status_code == 200:
+            # Server ignored the range and is sending the whole file; read on
+            # from this reply rather than asking again for every chunk
+            await self._stream_body(response, offset)
+            return await self._read_body(last - offset + 1)
+
+        content_range = _parse_content_range(response.headers.get('content-range'))
+        if content_range and content_range[2] is not None:
+            self.total_size = content_range[2]
+        return response.content
+
+    async def open(self):
+        """Fetch the first chunk so errors surface before streaming starts."""
+        self._first_chunk = await self._fetch(self.start)
+        if self.total_size is not None:
+            last_byte = self.total_size - 1
+            self.end = last_byte if self.end is None else min(self.end, last_byte)
+        elif self.end is None and len(self._first_chunk) < self.chunk_size:
+            self.end = self.start + len(self._first_chunk) - 1
+        return self
+
+    async def __aiter__(self):
+        chunk = self._first_chunk
+        self._first_chunk = None
+        offset = self.start
+        try:
+            while chunk:
+                offset += len(chunk)
+                yield chunk
+                if self.end is not None and offset > self.end:
+                    break
+                chunk = await self._fetch(offset)
+        finally:
+            await self.aclose()
+
+    async def aclose(self):
+        """Release a whole-file reply that is still open."""
+        if self._response is not None:
+            await self._response.aclose()
+            self._response = None
+
+
+class AsyncDriveService:
+    """asyncio counterpart of GoogleDriveService for async views.
+
+    Methods have the same names, arguments and return values as
+    GoogleDriveService but are coroutines on a pooled httpx connection, so
+    one event loop can keep many Drive transfers in flight without a thread
+    each. Credentials, the rate limiter, retries, the transfer tuner and
+    the folder cache are shared with the sync client.
+    """
+
+    def __init__(self):
+        self.service = transport if available() else None
+        if self.service is None:
+            logger.error("httpx is not installed; the async Drive client is unavailable")
+
+    def _url(self, path, upload=False):
+        return f"{transport.root_url()}{'upload/' if upload else ''}drive/v3/{path}"
+
+    async def _send(self, method, url, headers=None, **kwargs):
+        """One authorised request; error statuses are raised as HttpError."""
+        headers = {**(headers or {}), **await transport.auth_headers()}
+        response = await transport.client().request(method, url, headers=headers, **kwargs)
+        if response.status_code >= 400:
+            raise _http_error(response)
+        return response
+
+    async def _call(self, method, path, label, params=None, body=None):
+        """A rate-limited, retried Drive API call. Returns the decoded JSON response."""
+        url = self._url(path)
+        response = await acall_with_retries(
+            lambda: self._send(method, url, params=params, json=body),
+            f'Drive {label}'
+        )
+        return response.json() if response.content else {}
+
+    async def _ensure_parent(self, parent_folder_id):
+        """Return a parent folder ID that is known to exist, as GoogleDriveService._ensure_parent."""
+        if is_known_folder(parent_folder_id):
+            return parent_folder_id
+
+        try:
+            folder_check = await self._call('GET', f'files/{parent_folder_id}', 'files.get', params={'fields': 'id,name'})
+            logger.info(f"Parent folder verified: {folder_check.get('name')} ({parent_folder_id})")
+            remember_folder(parent_folder_id)
+            return parent_folder_id
+        except Exception as e:
+            logger.error(f"Parent folder validation failed: {str(e)}")
+            fallback_id = await self._fallback_root_folder()
+            logger.info(f"Using fallback root folder: {fallback_id}")
+            return fallback_id
+
+    async def _fallback_root_folder(self):
+        """Return the ID of the shared fallback root folder, creating it only once."""
+        folder_id = get_fallback_root()
+        if folder_id:
+            return folder_id
+
+        try:
+            results = await self._call('GET', 'files', 'files.list', params={
+                'q': f"name = '{FALLBACK_ROOT_NAME}' and mimeType = '{FOLDER_MIME_TYPE}' and trashed = false",
+                'fields': 'files(id)',
+                'pageSize': 1
+            })
+            existing = results.get('files', [])
+            if existing:
+                folder_id = existing[0]['id']
+        except Exception as e:
+            logger.error(f"Error looking up fallback root folder: {e}")
+
+        if not folder_id:
+            folder_id = await self.create_user_folder(FALLBACK_ROOT_NAME)
+            logger.info(f"Created fallback root folder: {folder_id}")
+        if folder_id:
+            set_fallback_root(folder_id)
+        return folder_id
+
+    async def upload_file(self, file_path, file_name, parent_folder_id, share_with_email=None, progress_callback=None):
+        """Upload a file on disk to Google Drive and return its ID. Optionally share with an email."""
+        if not os.path.exists(file_path):
+            logger.error(f"File not found at path: {file_path}")
+            return None
+        mime_type, _ = mimetypes.guess_type(file_path)
+        with open(file_path, 'rb') as source:
+            return await self.upload_fileobj(source, file_name, parent_folder_id, mime_type, share_with_email, progress_callback)
+
+    async def upload_fileobj(self, source, file_name, parent_folder_id, mime_type=None, share_with_email=None, progress_callback=None):
+        """Upload from a seekable file object or an (async) iterator of byte chunks and return the file ID.
+
+        Small files go in one multipart request, others through a resumable
+        session in tuned chunks. progress_callback(bytes_sent, total_bytes)
+        is called after each chunk.
+        """
+        if not self.service:
+            logger.error("Google Drive service not initialized")
+            return None
+
+        try:
+            if mime_type is None:
+                mime_type, _ = mimetypes.guess_type(file_name)
+            mime_type = mime_type or 'application/octet-stream'
+            upload_source = _UploadSource(source)
+
+            trusted_parent = is_known_folder(parent_folder_id)
+            parent_folder_id = await self._ensure_parent(parent_folder_id)
+            try:
+                resource = await self._create_with_media(upload_source, file_name, parent_folder_id, mime_type, progress_callback)
+            except HttpError as e:
+                if not (trusted_parent and e.resp.status == 404):
+                    raise
+                # The cached parent has gone away; check it properly and retry once
+                logger.warning(f"Cached parent folder {parent_folder_id} not found, revalidating")
+                forget_folder(parent_folder_id)
+                parent_folder_id = await self._ensure_parent(parent_folder_id)
+                resource = await self._create_with_media(upload_source, file_name, parent_folder_id, mime_type, progress_callback)
+
+            file_id = resource.get('id')
+            logger.info(f"Uploaded file {file_name} with ID {file_id} to folder {parent_folder_id}")
+            if share_with_email and file_id:
+                await self.share_file(file_id, share_with_email)
+            return file_id
+        except Exception as e:
+            logger.error(f"Error uploading file: {e}")
+            logger.error(traceback.format_exc())
+            return None
+
+    def _file_metadata(self, file_name, parent_folder_id):
+        return {
+            'name': file_name,
+            'parents': [parent_folder_id],
+            'description': f'Uploaded by GDriveFTP at {timezone.now().strftime("%Y-%m-%d %H:%M:%S")}'
+        }
+
+    async def _create_with_media(self, source, file_name, parent_folder_id, mime_type, progress_callback=None):
+        """Run an upload to completion and return the created file's resource."""
+        if source.size is None:
+            tuner.note_unknown_size()
+        elif not tuner.use_resumable(source.size):
+            return await self._upload_multipart(source, file_name, parent_folder_id, mime_type, progress_callback)
+        return await self._upload_resumable(source, file_name, parent_folder_id, mime_type, progress_callback)
+
+    async def _upload_multipart(self, source, file_name, parent_folder_id, mime_type, progress_callback=None):
+        """Metadata and content in a single request."""
+        data = await source.read(0, source.size)
+        boundary = uuid.uuid4().hex
+        body = b''.join([
+            f'--{boundary}\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n'.encode(),
+            json.dumps(self._file_metadata(file_name, parent_folder_id)).encode(),
+            f'\r\n--{boundary}\r\nContent-Type: {mime_type}\r\n\r\n'.encode(),
+            data,
+            f'\r\n--{boundary}--'.encode(),
+        ])
+
+        async def send():
+            with tuner.timed(UPLOAD) as timing:
+                response = await self._send(
+                    'POST',
+                    self._url('files', upload=True),
+                    params={'uploadType': 'multipart', 'fields': RESUMABLE_FIELDS},
+                    headers={'Content-Type': f'multipart/related; boundary={boundary}'},
+                    content=body
+                )
+                timing.nbytes = len(data)
+            return response
+
+        response = await acall_with_retries(send, 'Drive multipart upload')
+        if progress_callback:
+            progress_callback(len(data), len(data))
+        return response.json()
+
+    async def start_resumable_session(self, file_name, parent_folder_id, mime_type=None, size=None):
+        """Open a Drive resumable upload session and return its session URI."""
+        if mime_type is None:
+            mime_type, _ = mimetypes.guess_type(file_name)
+        headers = {
+            'Content-Type': 'application/json; charset=UTF-8',
+            'X-Upload-Content-Type': mime_type or 'application/octet-stream'
+        }
+        if size is not None:
+            headers['X-Upload-Content-Length'] = str(size)
+
+        async def open_session():
+            started = time.monotonic()
+            response = await self._send(
+                'POST',
+                self._url('files', upload=True),
+                params={'uploadType': 'resumable', 'fields': RESUMABLE_FIELDS},
+                headers=headers,
+                json=self._file_metadata(file_name, parent_folder_id)
+            )
+            # Opening a session carries no file data, so it measures round-trip time
+            tuner.record_rtt(time.monotonic() - started)
+            if 'location' not in response.headers:
+                raise _http_error(response)
+            return response.headers['location']
+
+        session_uri = await acall_with_retries(open_session, 'Drive resumable session')
+        logger.info(f"Opened resumable upload session for {file_name} in folder {parent_folder_id}")
+        return session_uri
+
+    async def upload_session_chunk(self, session_uri, data, offset, total_size=None):
+        """Send bytes starting at offset to a resumable session.
+
+        Returns (next_offset, file_resource) as GoogleDriveService.upload_session_chunk.
+        """
+        total = '*' if total_size is None else str(total_size)
+        if data:
+            content_range = f'bytes {offset}-{offset + len(data) - 1}/{total}'
+        else:
+            content_range = f'bytes */{total}'
+
+        # Not retried here: after a failure the caller asks for the committed offset first
+        await limiter.aacquire()
+        headers = {'Content-Range': content_range, **await transport.auth_headers()}
+        started = time.monotonic()
+        with traced('Drive upload chunk'):
+            response = await transport.client().put(session_uri, content=bytes(data), headers=headers)
+            add_bytes(len(data))
+        if data:
+            tuner.record_transfer(UPLOAD, len(data), time.monotonic() - started)
+        else:
+            tuner.record_rtt(time.monotonic() - started)
+        if response.status_code in (200, 201):
+            return offset + len(data), response.json()
+        if response.status_code == 308:
+            # Drive reports the bytes it has committed as 'bytes=0-N'
+            committed = response.headers.get('range')
+            return (int(committed.rsplit('-', 1)[1]) + 1 if committed else 0), None
+        raise _http_error(response)
+
+    async def query_session_offset(self, session_uri, total_size):
+        """Ask a resumable session how many bytes it has committed; None if it has expired."""
+        try:
+            return await acall_with_retries(lambda: self.upload_session_chunk(session_uri, b'', 0, total_size),
+                                            'Drive upload status query')
+        except HttpError as e:
+            if e.resp.status in (404, 410):
+                logger.info(f"Resumable session has expired: {session_uri}")
+                return None
+            raise
+
+    async def _upload_resumable(self, source, file_name, parent_folder_id, mime_type, progress_callback=None):
+        session_uri = await self.start_resumable_session(file_name, parent_folder_id, mime_type, source.size)
+        max_retries = getattr(settings, 'GOOGLE_DRIVE_MAX_RETRIES', DEFAULT_MAX_RETRIES)
+        offset, resource, failures = 0, None, 0
+        while resource is None:
+            # Re-tuned every chunk, so long uploads settle on the link's best size
+            data = await source.read(offset, tuner.chunk_size(UPLOAD))
+            try:
+                offset, resource = await self.upload_session_chunk(session_uri, data, offset, source.size)
+                failures = 0
+            except Exception as e:
+                failures += 1
+                if failures > max_retries or not is_retryable(e):
+                    raise
+                delay = backoff_delay(failures, e)
+                logger.warning(f"Chunk of {file_name} at byte {offset} failed ({e}); resuming in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                # Continue from whatever Drive actually committed
+                state = await self.query_session_offset(session_uri, source.size)
+                if state is None:
+                    raise
+                offset, resource = state
+                continue
+            if not data and resource is None:
+                raise IOError(f"Drive did not finish the upload of {file_name} after all bytes were sent")
+            if progress_callback:
+                progress_callback(offset, source.size)
+        return resource
+
+    async def share_file(self, file_id, email, role='writer'):
+        """Give an email address access to a file or folder. Returns True on success."""
+        try:
+            await self._call('POST', f'files/{file_id}/permissions', 'permissions.create',
+                             params={'fields': 'id', 'sendNotificationEmail': 'false'},
+                             body={'type': 'user', 'role': role, 'emailAddress': email})
+            logger.info(f"Shared {file_id} with {email}")
+            return True
+        except Exception as e:
+            logger.error(f"Error sharing file: {e}")
+            return False
+
+    async def move_file(self, file_id, new_parent_id, old_parent_id):
+        """Move a file to another folder. Returns True on success."""
+        try:
+            await self._call('PATCH', f'files/{file_id}', 'files.update', params={
+                'addParents': new_parent_id,
+                'removeParents': old_parent_id,
+                'fields': 'id,parents'
+            })
+            logger.info(f"Moved file {file_id} from {old_parent_id} to {new_parent_id}")
+            return True
+        except Exception as e:
+            logger.error(f"Error moving file: {e}")
+            return False
+
+    async def copy_file(self, file_id, file_name, parent_folder_id):
+        """Copy a file server-side into a folder under a new name. Returns the copy's ID or None."""
+        try:
+            copy = await self._call('POST', f'files/{file_id}/copy', 'files.copy', params={'fields': 'id'},
+                                    body=self._file_metadata(file_name, parent_folder_id))
+            logger.info(f"Copied {file_id} to {copy.get('id')} in folder {parent_folder_id}")
+            return copy.get('id')
+        except Exception as e:
+            logger.error(f"Error copying file {file_id}: {e}")
+            return None
+
+    async def _create_folder(self, folder_name, parent_folder_id=None):
+        body = {
+            'name': folder_name,
+            'mimeType': FOLDER_MIME_TYPE,
+            'description': f'Created by GDriveFTP at {timezone.now().strftime("%Y-%m-%d %H:%M:%S")}'
+        }
+        if parent_folder_id:
+            body['parents'] = [parent_folder_id]
+        folder = await self._call('POST', 'files', 'files.create', params={'fields': 'id,name,webViewLink'}, body=body)
+        folder_id = folder.get('id')
+        remember_folder(folder_id)
+        return folder_id
+
+    async def create_user_folder(self, folder_name, share_with_email=None):
+        """Create a folder in Google Drive for a user and return its ID."""
+        if not self.service:
+            logger.error("Google Drive service not initialized")
+            return None
+
+        try:
+            folder_id = await self._create_folder(folder_name)
+            logger.info(f"Created user folder {folder_name} with ID {folder_id}")
+            if share_with_email and folder_id:
+                await self.share_file(folder_id, share_with_email)
+            return folder_id
+        except Exception as e:
+            logger.error(f"Error creating folder: {e}")
+            logger.error(traceback.format_exc())
+            return None
+
+    async def create_subfolder(self, folder_name, parent_folder_id, share_with_email=None):
+        """Create a subfolder in Google Drive and return its ID."""
+        if not self.service:
+            logger.error("Google Drive service not initialized")
+            return None
+
+        try:
+            if not is_known_folder(parent_folder_id):
+                try:
+                    await self._call('GET', f'files/{parent_folder_id}', 'files.get', params={'fields': 'id,name'})
+                    remember_folder(parent_folder_id)
+                except Exception as e:
+                    logger.error(f"Parent folder validation failed: {str(e)}")
+                    return None
+            folder_id = await self._create_folder(folder_name, parent_folder_id)
+            logger.info(f"Created subfolder {folder_name} with ID {folder_id} in parent {parent_folder_id}")
+            if share_with_email and folder_id:
+                await self.share_file(folder_id, share_with_email)
+            return folder_id
+        except Exception as e:
+            logger.error(f"Error creating subfolder: {e}")
+            logger.error(traceback.format_exc())
+            return None
+
+    async def get_file_metadata(self, file_id, fields='id,name,mimeType,size,md5Checksum,version'):
+        """Return a file's metadata, or None on error."""
+        try:
+            return await self._call('GET', f'files/{file_id}', 'files.get', params={'fields': fields})
+        except Exception as e:
+            logger.error(f"Error fetching metadata for {file_id}: {e}")
+            return None
+
+    async def download_stream(self, file_id, start=0, end=None, chunk_size=None):
+        """Stream a file, or the byte range start..end, from Google Drive.
+
+        Returns an opened AsyncDriveDownload, or None if the download could not be started.
+        """
+        if not self.service:
+            logger.error("Google Drive service not initialized")
+            return None
+
+        # Without an explicit chunk size the tuner picks one per request
+        adaptive = chunk_size is None
+        chunk_size = chunk_size or tuner.chunk_size(DOWNLOAD)
+        try:
+            download = AsyncDriveDownload(f"{self._url(f'files/{file_id}')}?alt=media", start, end, chunk_size, adaptive=adaptive)
+            await download.open()
+            logger.info(f"Streaming file with ID {file_id} (bytes {download.start}-{download.end})")
+            return download
+        except Exception as e:
+            logger.error(f"Error downloading file: {e}")
+            return None
+
+    async def download_file(self, file_id):
+        """Download a whole file into memory."""
+        download = await self.download_stream(file_id)
+        if download is None:
+            return None
+        try:
+            file_content = io.BytesIO()
+            async for chunk in download:
+                file_content.write(chunk)
+            file_content.seek(0)
+            return file_content
+        except Exception as e:
+            logger.error(f"Error downloading file: {e}")
+            return None
+
+    async def delete_file(self, file_id):
+        """Delete a file from Google Drive."""
+        try:
+            await self._call('DELETE', f'files/{file_id}', 'files.delete')
+            logger.info(f"Deleted file with ID {file_id}")
+            return True
+        except Exception as e:
+            logger.error(f"Error deleting file: {e}")
+            return False
+
+    async def delete_folder(self, folder_id):
+        """Delete a folder from Google Drive."""
+        try:
+            await self._call('DELETE', f'files/{folder_id}', 'files.delete')
+            forget_folder(folder_id)
+            logger.info(f"Deleted folder with ID {folder_id}")
+            return True
+        except Exception as e:
+            logger.error(f"Error deleting folder: {e}")
+            return False
+
+    async def iter_items(self, q=None, page_size=None, fields=LIST_FIELDS, order_by=None):
+        """Yield every item matching a Drive query, following nextPageToken. Raises on API errors."""
+        page_size = min(page_size or getattr(settings, 'GOOGLE_DRIVE_LIST_PAGE_SIZE', LIST_PAGE_SIZE), MAX_LIST_PAGE_SIZE)
+        params = {
+            'pageSize': page_size,
+            'fields': f'nextPageToken, files({fields})'
+        }
+        if q:
+            params['q'] = q
+        if order_by:
+            params['orderBy'] = order_by
+
+        while True:
+            results = await self._call('GET', 'files', 'files.list', params=params)
+            for item in results.get('files', []):
+                yield item
+            if not results.get('nextPageToken'):
+                break
+            params['pageToken'] = results['nextPageToken']
+
+    def iter_children(self, folder_id, q=None, page_size=None, fields=LIST_FIELDS):
+        """Yield every item directly inside a folder, optionally narrowed by an extra query."""
+        query = f"'{folder_id}' in parents and trashed = false"
+        if q:
+            query = f"{query} and ({q})"
+        return self.iter_items(query, page_size=page_size, fields=fields)
+
+    async def list_files_and_folders(self, folder_id, q=None, page_size=None, fields=LIST_FIELDS):
+        """List all files and folders in a folder."""
+        try:
+            items = [item async for item in self.iter_children(folder_id, q=q, page_size=page_size, fields=fields)]
+            logger.info(f"Listed {len(items)} items in folder {folder_id}")
+            return items
+        except Exception as e:
+            logger.error(f"Error listing files and folders: {e}")
+            return []
+
+    async def list_files_and_folders_split(self, folder_id, page_size=None, fields=LIST_FIELDS):
+        """List a folder once and return (files, folders)."""
+        files, folders = [], []
+        for item in await self.list_files_and_folders(folder_id, page_size=page_size, fields=fields):
+            (folders if item.get('mimeType') == FOLDER_MIME_TYPE else files).append(item)
+        return files, folders
+
+    async def list_files(self, folder_id):
+        """List all files in a folder."""
+        return await self.list_files_and_folders(folder_id, q=f"mimeType != '{FOLDER_MIME_TYPE}'")
+
+    async def list_folders(self, folder_id):
+        """List all subfolders in a folder."""
+        return await self.list_files_and_folders(folder_id, q=f"mimeType = '{FOLDER_MIME_TYPE}'")
@@ -0,0 +1,344 @@
+import uuid
+import asyncio
+import logging
+from asgiref.sync import sync_to_async
+from django.shortcuts import render, redirect, aget_object_or_404
+from django.contrib.auth.decorators import login_required
+from django.contrib import messages
+from django.http import HttpResponse, StreamingHttpResponse
+from django.conf import settings
+
+from .forms import FileUploadForm
+from .models import UserProfile, FileEntry, FolderEntry, TransferJob
+from .gdrive import GoogleDriveService
+from .async_gdrive import AsyncDriveService
+from .pagination import FILE_SORT_FIELDS, DEFAULT_PAGE_SIZE, keyset_paginate
+from .jobs import background_transfers_enabled, enqueue_upload
+from .dedup import content_key, find_copies
+from .sharing import share_items
+from .tracing import drive_call_budget
+from .views import _cached_download_response
+from . import download_cache
+from . import ranges as ranges_util
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_UPLOAD_CONCURRENCY = 4
+
+
+@login_required
+@drive_call_budget(0)
+async def dashboard(request, folder_id=None):
+    """User dashboard view."""
+    user = await request.auser()
+    user_profile = await UserProfile.objects.aget(user=user)
+
+    if not user_profile.is_approved:
+        messages.warning(request, 'Your account is pending approval by an administrator.')
+        return await sync_to_async(render)(request, 'ftp/pending_approval.html')
+
+    current_folder = None
+    breadcrumbs = []
+
+    if folder_id:
+        try:
+            current_folder = await FolderEntry.objects.aget(id=folder_id, user=user)
+            breadcrumbs = [folder async for folder in current_folder.get_ancestors()] + [current_folder]
+        except FolderEntry.DoesNotExist:
+            messages.error(request, 'Folder not found.')
+            return redirect('dashboard')
+
+    sort = request.GET.get('sort', 'date')
+    if sort not in FILE_SORT_FIELDS:
+        sort = 'date'
+    order = request.GET.get('order', 'desc' if sort == 'date' else 'asc')
+    after = request.GET.get('after')
+    before = request.GET.get('before')
+
+    files = await sync_to_async(keyset_paginate)(
+        FileEntry.objects.filter(user=user, folder=current_folder),
+        FILE_SORT_FIELDS[sort],
+        descending=(order == 'desc'),
+        after=after,
+        before=before,
+        page_size=getattr(settings, 'DASHBOARD_PAGE_SIZE', DEFAULT_PAGE_SIZE)
+    )
+
+    folders = []
+    if not (after or before):
+        folders = [folder async for folder in FolderEntry.objects.filter(user=user, parent_folder=current_folder)]
+
+    active_jobs = [job async for job in TransferJob.objects.filter(
+        user=user,
+        status__in=[TransferJob.QUEUED, TransferJob.RUNNING]
+    ).order_by('created_at')[:100]]
+
+    # Templates may touch lazy relations, so they are rendered off the event loop
+    return await sync_to_async(render)(request, 'ftp/dashboard.html', {
+        'files': files,
+        'folders': folders,
+        'current_folder': current_folder,
+        'breadcrumbs': breadcrumbs,
+        'sort': sort,
+        'order': order,
+        'active_jobs': active_jobs,
+    })
+
+
+async def _send_to_drive(drive_service, uploaded_file, folder_id, semaphore, copy_from=None):
+    """Upload (or copy) one file; returns its Drive ID or None."""
+    async with semaphore:
+        if copy_from:
+            file_id = await drive_service.copy_file(copy_from, uploaded_file.name, folder_id)
+            if file_id:
+                return file_id
+        return await drive_service.upload_fileobj(
+            uploaded_file,
+            uploaded_file.name,
+            folder_id,
+            mime_type=uploaded_file.content_type
+        )
+
+
+@login_required
+async def upload_file(request):
+    """File upload view; all files in a post are sent to Drive concurrently.
+
+    Like the sync view it has no Drive call budget, as the number of calls
+    grows with the number and size of the files. The streaming upload
+    handler does not apply: under ASGI the whole body has been received
+    before any view runs.
+    """
+    user = await request.auser()
+    user_profile = await UserProfile.objects.aget(user=user)
+
+    if not user_profile.is_approved:
+        messages.warning(request, 'Your account is pending approval by an administrator.')
+        return redirect('dashboard')
+
+    user_folders = await sync_to_async(FolderEntry.display_paths)(user)
+
+    if request.method != 'POST':
+        form = FileUploadForm(user_folders=user_folders)
+        return await sync_to_async(render)(request, 'ftp/upload_file.html', {'form': form})
+
+    # The body was already read and parsed by the CSRF middleware
+    form = FileUploadForm(request.POST, request.FILES, user_folders=user_folders)
+    if not form.is_valid():
+        return await sync_to_async(render)(request, 'ftp/upload_file.html', {'form': form})
+
+    drive_service = AsyncDriveService()
+    share_email = user_profile.share_email or None
+
+    if not user_profile.drive_folder_id:
+        folder_id = await drive_service.create_user_folder(f"gdriveftp_{user.username}", share_with_email=share_email)
+        if not folder_id:
+            messages.error(request, 'Error creating user folder in Google Drive.')
+            return redirect('dashboard')
+        user_profile.drive_folder_id = folder_id
+        await user_profile.asave()
+
+    folder_name = form.cleaned_data.get('folder_name')
+    parent_folder_id = form.cleaned_data.get('parent_folder')
+    db_folder = None
+    if parent_folder_id:
+        db_folder = await FolderEntry.objects.filter(id=parent_folder_id, user=user).afirst()
+        if db_folder is None:
+            messages.warning(request, 'Selected folder does not exist. Using the root folder.')
+    target_folder_id = db_folder.drive_folder_id if db_folder else user_profile.drive_folder_id
+
+    if folder_name:
+        drive_folder_id = await drive_service.create_subfolder(folder_name, target_folder_id, share_with_email=share_email)
+        if drive_folder_id:
+            folder_entry = FolderEntry(user=user, folder_name=folder_name, drive_folder_id=drive_folder_id, parent_folder=db_folder)
+            # save() also maintains the materialized path
+            await sync_to_async(folder_entry.save)()
+            messages.success(request, f'Folder {folder_name} created successfully!')
+        else:
+            messages.error(request, 'Error creating folder in Google Drive.')
+
+    files = request.FILES.getlist('file')
+    description = form.cleaned_data.get('description', '')
+    if files and background_transfers_enabled():
+        for uploaded_file in files:
+            await sync_to_async(enqueue_upload)(user, uploaded_file, db_folder, description)
+        messages.info(request, f'Queued {len(files)} file(s) for upload.')
+        files = []
+
+    if files:
+        copies = await sync_to_async(find_copies)(user, [content_key(f) for f in files])
+        semaphore = asyncio.Semaphore(getattr(settings, 'GOOGLE_DRIVE_UPLOAD_CONCURRENCY', DEFAULT_UPLOAD_CONCURRENCY))
+        file_ids = await asyncio.gather(*[
+            _send_to_drive(drive_service, uploaded_file, target_folder_id, semaphore, copies.get(content_key(uploaded_file)))
+            for uploaded_file in files
+        ])
+        # Share every new file in one batch request rather than one call each.
+        # The files are in Drive either way, so their entries are still saved.
+        if share_email:
+            try:
+                await sync_to_async(_share_uploads, thread_sensitive=False)(
+                    [file_id for file_id in file_ids if file_id], share_email
+                )
+            except Exception as e:
+                logger.error(f"Error sharing uploaded files with {share_email}: {e}")
+                messages.warning(request, f'Uploaded files could not be shared with {share_email}.')
+
+        await FileEntry.objects.abulk_create([
+            FileEntry(
+                user=user,
+                file_name=uploaded_file.name,
+                file_size=uploaded_file.size,
+                file_type=uploaded_file.content_type,
+                drive_file_id=file_id,
+                description=description,
+                folder=db_folder,
+                md5_checksum=getattr(uploaded_file, 'md5_checksum', '')
+            )
+            for uploaded_file, file_id in zip(files, file_ids) if file_id
+        ], update_conflicts=True, unique_fields=['drive_file_id'], update_fields=FileEntry.UPLOAD_FIELDS)
+
+        success_count = sum(1 for file_id in file_ids if file_id)
+        if success_count:
+            messages.success(request, f'Successfully uploaded {success_count} file(s).')
+        if success_count < len(files):
+            messages.error(request, f'Failed to upload {len(files) - success_count} file(s).')
+
+    return redirect('dashboard')
+
+
+def _share_uploads(file_ids, email):
+    return share_items(GoogleDriveService(), file_ids, email)
+
+
+async def _multipart_byteranges(ranges, boundary, content_type, size, read_part):
+    """Async views._multipart_byteranges; read_part returns an async iterator per range."""
+    for index, (start, end) in enumerate(ranges):
+        yield ranges_util.multipart_part_header(boundary, content_type, start, end, size)
+        async for chunk in await read_part(index, start, end):
+            yield chunk
+    yield ranges_util.multipart_trailer(boundary)
+
+
+async def _drive_download_response(drive_service, drive_file_id, ranges, content_type, size, download=None):
+    """Stream a download from Google Drive, or return None if it cannot be started."""
+    if download is None and ranges:
+        download = await drive_service.download_stream(drive_file_id, ranges[0][0], ranges[0][1])
+    elif download is None:
+        download = await drive_service.download_stream(drive_file_id)
+    if not download:
+        return None
+
+    async def read_part(index, start, end):
+        part = download if index == 0 else await drive_service.download_stream(drive_file_id, start, end)
+        if part is None:
+            raise IOError(f"Could not fetch bytes {start}-{end} of {drive_file_id} from Google Drive")
+        return part
+
+    if ranges and len(ranges) > 1:
+        boundary = uuid.uuid4().hex
+        response = StreamingHttpResponse(
+            _multipart_byteranges(ranges, boundary, content_type, size, read_part),
+            status=206,
+            content_type=f'multipart/byteranges; boundary={boundary}'
+        )
+        response['Content-Length'] = ranges_util.multipart_length(boundary, content_type, ranges, size)
+    elif ranges:
+        response = StreamingHttpResponse(download, status=206, content_type=content_type)
+        response['Content-Range'] = ranges_util.content_range(ranges[0][0], ranges[0][1], size)
+        response['Content-Length'] = download.length
+    else:
+        response = StreamingHttpResponse(download, content_type=content_type)
+        if download.length is not None:
+            response['Content-Length'] = download.length
+    return response
+
+
+class _AsyncCacheFill:
+    """Async iterator over a download_cache.CacheFill, which reads from Drive off the event loop."""
+
+    def __init__(self, fill):
+        self.fill = fill
+        self.length = fill.length
+
+    async def _chunks(self):
+        chunks = iter(self.fill)
+        # Each read may wait on Drive; run them on a worker thread of their
+        # own rather than queueing behind the one shared sync thread
+        read = sync_to_async(next, thread_sensitive=False)
+        while True:
+            chunk = await read(chunks, None)
+            if chunk is None:
+                break
+            yield chunk
+
+    def __aiter__(self):
+        return self._chunks()
+
+    def close(self):
+        self.fill.close()
+
+
+class _AsyncCacheFollower(_AsyncCacheFill):
+    """Async iterator over a download_cache.CacheFollower that waits for the fill on the event loop."""
+
+    async def _chunks(self):
+        read = sync_to_async(self.fill.read_available, thread_sensitive=False)
+        while (chunk := await read()) is not None:
+            if chunk:
+                yield chunk
+            else:
+                await asyncio.sleep(download_cache.FOLLOW_POLL_INTERVAL)
+
+
+def _open_cached(drive_file_id, size):
+    return download_cache.open_cached(GoogleDriveService(), drive_file_id, size)
+
+
+def _stream_to_cache(drive_file_id, size):
+    return download_cache.stream_to_cache(GoogleDriveService(), drive_file_id, size)
+
+
+@login_required
+async def download_file(request, file_id):
+    """File download view. Supports Range and If-Range requests."""
+    user = await request.auser()
+    file_entry = await aget_object_or_404(FileEntry, id=file_id, user=user)
+    content_type = file_entry.file_type or 'application/octet-stream'
+    size = file_entry.file_size
+    etag = f'"{file_entry.drive_file_id}-{size}"'
+
+    ranges = None
+    if ranges_util.if_range_matches(request.headers.get('If-Range'), etag, file_entry.upload_date):
+        try:
+            ranges = ranges_util.parse_range_header(request.headers.get('Range'), size)
+        except ranges_util.RangeNotSatisfiable:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+
+    cached = None
+    if download_cache.enabled():
+        # No database work, so these need not wait for the shared sync thread
+        cached = await sync_to_async(_open_cached, thread_sensitive=False)(file_entry.drive_file_id, size)
+    if cached is not None:
+        response = _cached_download_response(cached, ranges, content_type, size)
+    else:
+        download = None
+        if download_cache.enabled() and (not ranges or ranges == [(0, size - 1)]):
+            # The whole file goes out anyway, so the cache keeps a copy on the way through
+            fill = await sync_to_async(_stream_to_cache, thread_sensitive=False)(file_entry.drive_file_id, size)
+            if isinstance(fill, download_cache.CacheFollower):
+                download = _AsyncCacheFollower(fill)
+            else:
+                download = _AsyncCacheFill(fill) if fill else None
+        response = await _drive_download_response(AsyncDriveService(), file_entry.drive_file_id, ranges, content_type, size, download)
+
+    if response is None:
+        messages.error(request, 'Error downloading file from Google Drive.')
+        return redirect('dashboard')
+
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = ranges_util.last_modified_header(file_entry.upload_date)
+    response['Content-Disposition'] = f'attachment; filename="{file_entry.file_name}"'
+    return response
@@ -0,0 +1,46 @@
+import logging
+from django.conf import settings
+
+from .models import FileEntry
+
+logger = logging.getLogger(__name__)
+
+
+def enabled():
+    return getattr(settings, 'GOOGLE_DRIVE_DEDUPLICATE_UPLOADS', True)
+
+
+def content_key(uploaded_file):
+    """(md5, size) for an uploaded file hashed on arrival, or None."""
+    md5_checksum = getattr(uploaded_file, 'md5_checksum', '')
+    return (md5_checksum, uploaded_file.size) if md5_checksum else None
+
+
+def find_copies(user, keys):
+    """Map (md5, size) keys to the Drive ID of a file that already holds that content.
+
+    Only the user's own files are considered unless
+    GOOGLE_DRIVE_DEDUP_ACROSS_USERS is set; every file belongs to the
+    service account, so any of them can be copied.
+    """
+    keys = {key for key in keys if key}
+    if not keys or not enabled():
+        return {}
+    entries = FileEntry.objects.filter(md5_checksum__in={md5 for md5, _ in keys})
+    if not getattr(settings, 'GOOGLE_DRIVE_DEDUP_ACROSS_USERS', False):
+        entries = entries.filter(user=user)
+
+    copies = {}
+    # Newest first: the most recent copy is the least likely to have been removed from Drive
+    for md5_checksum, file_size, drive_file_id in entries.order_by('-upload_date').values_list('md5_checksum', 'file_size', 'drive_file_id'):
+        if (md5_checksum, file_size) in keys:
+            copies.setdefault((md5_checksum, file_size), drive_file_id)
+    if copies:
+        logger.info(f"Found existing Drive content for {len(copies)} of {len(keys)} uploads by {user.username}")
+    return copies
+
+
+def find_copy(user, md5_checksum, file_size):
+    """Drive ID of a file with this content, or None."""
+    key = (md5_checksum, file_size) if md5_checksum else None
+    return find_copies(user, [key]).get(key)
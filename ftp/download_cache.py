@@ -0,0 +1,417 @@
+import os
+import time
+import hashlib
+import logging
+import traceback
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+META_KEY_PREFIX = 'gdrive:meta:'
+META_FIELDS = 'id,size,md5Checksum,version'
+DEFAULT_CHECK_TTL = 60
+READ_BLOCK_SIZE = 1024 * 1024
+
+# Running total of cached bytes, so fills only walk the directory when over budget
+TOTAL_KEY = 'gdrive:download-cache-bytes'
+
+# A fill whose temp file has not been written to for this long belongs to a dead process
+STALE_TEMP_SECONDS = 60 * 60
+
+# Requests following another request's fill go to Drive after this long without new bytes
+DEFAULT_FOLLOW_TIMEOUT = 30
+# How often a follower looks for bytes the fill has not written yet
+FOLLOW_POLL_INTERVAL = 0.05
+
+
+def _budget():
+    return getattr(settings, 'GOOGLE_DRIVE_DOWNLOAD_CACHE_BYTES', 0)
+
+
+def _cache_dir():
+    return getattr(settings, 'GOOGLE_DRIVE_DOWNLOAD_CACHE_DIR', os.path.join(settings.BASE_DIR, 'download_cache'))
+
+
+def _follow_timeout():
+    return getattr(settings, 'GOOGLE_DRIVE_DOWNLOAD_CACHE_FOLLOW_TIMEOUT', DEFAULT_FOLLOW_TIMEOUT)
+
+
+def _max_file_size():
+    # One file may use at most a quarter of the budget by default
+    return getattr(settings, 'GOOGLE_DRIVE_DOWNLOAD_CACHE_MAX_FILE', _budget() // 4)
+
+
+def enabled():
+    return _budget() > 0
+
+
+def _entry_path(file_id, tag):
+    return os.path.join(_cache_dir(), file_id[:2], f'{file_id}-{tag}')
+
+
+def _temp_path(path):
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f'.tmp-{name}')
+
+
+def _file_metadata(drive_service, file_id):
+    """Drive size/md5/version for a file, remembered for a short while."""
+    key = f'{META_KEY_PREFIX}{file_id}'
+    metadata = cache.get(key)
+    if metadata is None:
+        metadata = drive_service.get_file_metadata(file_id, fields=META_FIELDS)
+        if metadata is None:
+            return None
+        cache.set(key, metadata, getattr(settings, 'GOOGLE_DRIVE_DOWNLOAD_CACHE_CHECK_TTL', DEFAULT_CHECK_TTL))
+    return metadata
+
+
+def _lookup(drive_service, file_id, size):
+    """(path, metadata) of the cache entry for a file's current content, or None if it can't be cached."""
+    if not enabled() or (size is not None and size > _max_file_size()):
+        return None
+    metadata = _file_metadata(drive_service, file_id)
+    if metadata is None or int(metadata.get('size') or 0) > _max_file_size():
+        return None
+    # The md5 changes with the content; Google Docs have no md5 but do have a version
+    tag = metadata.get('md5Checksum') or f"v{metadata.get('version', 0)}"
+    return _entry_path(file_id, tag), metadata
+
+
+def _touch(path):
+    # mtime doubles as the last-used time for LRU eviction
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def _claim_fill(path):
+    """Create the temp file for a fill and return its descriptor, or None if another fill is running.
+
+    O_EXCL makes the temp file a lock that works across processes.
+    """
+    temp_path = _temp_path(path)
+    for _ in range(2):
+        try:
+            return os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            try:
+                idle = time.time() - os.stat(temp_path).st_mtime
+            except FileNotFoundError:
+                continue
+            if idle < STALE_TEMP_SECONDS:
+                return None
+            logger.warning(f"Removing abandoned download cache fill {temp_path}")
+            _remove(temp_path)
+    return None
+
+
+class CacheFill:
+    """Iterator that sends a Drive download to the client and into the cache at once.
+
+    The bytes go to a temp file that is renamed into place once the whole
+    file has arrived and matches Drive's size and md5. If the stream stops
+    early, because the client went away or Drive failed, the temp file is
+    removed instead. Quacks like a DriveDownload for the download views.
+    """
+
+    def __init__(self, download, fd, path, metadata):
+        self.download = download
+        self.start = download.start
+        self.end = download.end
+        self.path = path
+        self.metadata = metadata
+        self._file = os.fdopen(fd, 'wb')
+        self._temp_path = _temp_path(path)
+
+    @property
+    def length(self):
+        return self.download.length
+
+    def __iter__(self):
+        md5 = hashlib.md5() if self.metadata.get('md5Checksum') else None
+        written = 0
+        try:
+            for chunk in self.download:
+                self._file.write(chunk)
+                # Requests following this fill read the temp file as it grows
+                self._file.flush()
+                written += len(chunk)
+                if md5:
+                    md5.update(chunk)
+                yield chunk
+            self._finish(written, md5)
+        finally:
+            self.close()
+
+    def _finish(self, written, md5):
+        """Move a complete download into place; the client already has the bytes, so errors are only logged."""
+        try:
+            self._file.close()
+            if self.metadata.get('size') is not None and written != int(self.metadata['size']):
+                raise IOError(f"got {written} bytes, expected {self.metadata['size']}")
+            if md5 and md5.hexdigest() != self.metadata['md5Checksum']:
+                raise IOError("checksum mismatch")
+            os.replace(self._temp_path, self.path)
+            self._temp_path = None
+        except Exception as e:
+            logger.error(f"Not caching {self.path}: {e}")
+            return
+        logger.info(f"Cached {os.path.basename(self.path)} ({written} bytes)")
+        _record_fill(written)
+
+    def close(self):
+        """Drop an unfinished fill. Called by the response when the client goes away."""
+        if self._temp_path is None:
+            return
+        self._file.close()
+        _remove(self._temp_path)
+        self._temp_path = None
+
+
+class CacheFollower:
+    """Iterator over a file that another request is filling into the cache.
+
+    Reads the bytes already in the fill's temp file and waits for more
+    until the fill is renamed into place, so concurrent misses for one file
+    cost a single Drive download. If the fill is abandoned, or writes
+    nothing for GOOGLE_DRIVE_DOWNLOAD_CACHE_FOLLOW_TIMEOUT seconds, the rest
+    of the file is fetched from Drive. Quacks like a DriveDownload.
+    """
+
+    def __init__(self, drive_service, file_id, path, metadata):
+        self.drive_service = drive_service
+        self.file_id = file_id
+        self.path = path
+        size = metadata.get('size')
+        self.length = int(size) if size is not None else None
+        self.start = 0
+        self.end = None if self.length is None else self.length - 1
+        self.offset = 0
+        self._temp_path = _temp_path(path)
+        self._source = self._open()
+        self._download = None
+        self._chunks = None
+
+    def _open(self):
+        # The fill may have finished or given up since it was found running
+        for path in (self._temp_path, self.path):
+            try:
+                return open(path, 'rb')
+            except FileNotFoundError:
+                continue
+        return None
+
+    def _is(self, path):
+        try:
+            return os.path.samestat(os.fstat(self._source.fileno()), os.stat(path))
+        except FileNotFoundError:
+            return False
+
+    def _read(self):
+        block = self._source.read(READ_BLOCK_SIZE)
+        self.offset += len(block)
+        return block
+
+    def read_available(self):
+        """The next bytes of the file, b'' if the fill has not written them yet, or None at the end."""
+        if self._chunks is not None:
+            return next(self._chunks, None)
+        if self._source is not None:
+            block = self._read()
+            if block:
+                return block
+            if self.length is not None and self.offset >= self.length:
+                return None
+            if self._is(self.path):
+                # Renamed into place; anything written before the rename is still to come
+                return self._read() or None
+            idle = time.time() - os.fstat(self._source.fileno()).st_mtime
+            if self._is(self._temp_path) and idle < _follow_timeout():
+                return b''
+            self._source.close()
+            self._source = None
+        logger.info(f"Download cache fill of {self.file_id} stopped at byte {self.offset}; reading the rest from Drive")
+        download = self.drive_service.download_stream(self.file_id, self.offset, self.end)
+        if download is None:
+            raise IOError(f"Could not fetch {self.file_id} from byte {self.offset} from Google Drive")
+        self._download = download
+        self._chunks = iter(download)
+        return next(self._chunks, None)
+
+    def __iter__(self):
+        try:
+            while (chunk := self.read_available()) is not None:
+                if chunk:
+                    yield chunk
+                else:
+                    time.sleep(FOLLOW_POLL_INTERVAL)
+        finally:
+            self.close()
+
+    def close(self):
+        if self._source is not None:
+            self._source.close()
+            self._source = None
+        if self._download is not None:
+            self._download.close()
+            self._download = None
+
+
+def open_cached(drive_service, file_id, size=None):
+    """Return an open local file with the current content of a Drive file, or None.
+
+    Returns None on a miss, when the cache is disabled, the file is too
+    large to cache, or anything goes wrong, so callers can fall back to
+    stream_to_cache() or to streaming from Drive.
+    """
+    try:
+        entry = _lookup(drive_service, file_id, size)
+        if entry is None:
+            return None
+        path = entry[0]
+        # Once open, the file stays readable even if it is evicted
+        cached = open(path, 'rb')
+        _touch(path)
+        return cached
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.error(f"Download cache error for {file_id}: {e}")
+        logger.error(traceback.format_exc())
+        return None
+
+
+def stream_to_cache(drive_service, file_id, size=None):
+    """Start streaming a whole Drive file while saving it to the cache.
+
+    Returns a CacheFill, or a CacheFollower when another request is already
+    filling the entry. Returns None when the file can't be cached or the
+    download can't be started; callers then stream from Drive as usual.
+    The client gets each chunk as soon as it arrives instead of waiting
+    for the whole file to be cached.
+    """
+    fd = None
+    try:
+        entry = _lookup(drive_service, file_id, size)
+        if entry is None:
+            return None
+        path, metadata = entry
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = _claim_fill(path)
+        # Someone else is filling it, or finished since the caller looked
+        if fd is None or os.path.exists(path):
+            return CacheFollower(drive_service, file_id, path, metadata)
+        download = drive_service.download_stream(file_id)
+        if download is None:
+            return None
+        fill = CacheFill(download, fd, path, metadata)
+        fd = None
+        return fill
+    except Exception as e:
+        logger.error(f"Download cache error for {file_id}: {e}")
+        logger.error(traceback.format_exc())
+        return None
+    finally:
+        if fd is not None:
+            os.close(fd)
+            _remove(_temp_path(path))
+
+
+def _record_fill(nbytes):
+    """Add a new entry to the running total and evict once the cache is over budget."""
+    try:
+        total = cache.incr(TOTAL_KEY, nbytes)
+    except Exception:
+        # ValueError when nothing is counted yet; evict() counts what is on disk
+        total = None
+    if total is None or total > _budget():
+        evict()
+
+
+def _entries():
+    """(mtime, size, path) for every cached file, plus stale temp files to remove."""
+    entries, stale = [], []
+    now = time.time()
+    for root, _, names in os.walk(_cache_dir()):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if name.startswith('.tmp-'):
+                if now - stat.st_mtime > STALE_TEMP_SECONDS:
+                    stale.append(path)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, path))
+    return entries, stale
+
+
+def evict(budget=None):
+    """Delete least recently used entries until the cache fits the byte budget.
+
+    Walks the whole cache directory, so fills only call it once the running
+    total says the budget is exceeded. The walk also resets that total.
+    """
+    budget = _budget() if budget is None else budget
+    entries, stale = _entries()
+    for path in stale:
+        _remove(path)
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= budget:
+            break
+        _remove(path)
+        total -= size
+        removed += 1
+    try:
+        cache.set(TOTAL_KEY, total, None)
+    except Exception as e:
+        logger.warning(f"Could not store the download cache size: {e}")
+    if removed:
+        logger.info(f"Evicted {removed} files from the download cache ({total} bytes kept)")
+    return removed
+
+
+def discard(file_id):
+    """Drop every cached version of a file, e.g. after it is deleted."""
+    directory = os.path.join(_cache_dir(), file_id[:2])
+    cache.delete(f'{META_KEY_PREFIX}{file_id}')
+    if not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        if name.startswith(f'{file_id}-'):
+            path = os.path.join(directory, name)
+            try:
+                size = os.path.getsize(path)
+            except FileNotFoundError:
+                continue
+            _remove(path)
+            try:
+                cache.decr(TOTAL_KEY, size)
+            except Exception:
+                # Not counted yet; the next evict() counts what is on disk
+                pass
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def iter_file_range(source, start, end):
+    """Yield bytes start..end (inclusive) of an open file in blocks."""
+    source.seek(start)
+    remaining = end - start + 1
+    while remaining > 0:
+        block = source.read(min(READ_BLOCK_SIZE, remaining))
+        if not block:
+            break
+        remaining -= len(block)
+        yield block
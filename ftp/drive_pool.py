@@ -0,0 +1,159 @@
+import os
+import json
+import logging
+import threading
+import traceback
+from django.conf import settings
+
+import httplib2
+import google_auth_httplib2
+from google.auth.transport.requests import AuthorizedSession
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build_from_document
+
+from .token_cache import SharedTokenCredentials
+
+logger = logging.getLogger(__name__)
+
+DRIVE_SCOPES = ['https://www.googleapis.com/auth/drive']
+
+
+class DriveClientPool:
+    """Process-wide cache of Drive credentials and per-thread API clients.
+
+    Credentials and the discovery document are loaded once per process and
+    shared. httplib2 is not thread-safe, so each thread gets its own HTTP
+    transport and its own service object built on top of it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._pid = None
+        self._generation = 0
+        self.credentials = None
+        self.discovery_doc = None
+
+    def _reset_if_forked(self):
+        # A pre-forking server (gunicorn --preload) copies the pool into each
+        # worker; sockets must not be shared between processes.
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._local = threading.local()
+            self._generation += 1
+
+    def _load_credentials(self):
+        credentials_path = settings.GOOGLE_DRIVE_STORAGE_JSON_KEY_FILE
+
+        if not os.path.exists(credentials_path):
+            logger.error(f"Credentials file not found at {credentials_path}")
+            raise FileNotFoundError(f"Credentials file not found at {credentials_path}")
+
+        try:
+            with open(credentials_path, 'r') as f:
+                cred_data = json.load(f)
+                if 'client_email' in cred_data:
+                    logger.info(f"Using service account: {cred_data['client_email']}")
+        except Exception as e:
+            logger.warning(f"Could not parse credentials file for debugging: {e}")
+
+        return SharedTokenCredentials.from_service_account_file(
+            credentials_path,
+            scopes=DRIVE_SCOPES
+        )
+
+    def _load_discovery_doc(self):
+        doc = json.loads(discovery_cache.get_static_doc('drive', 'v3'))
+        root_url = getattr(settings, 'GOOGLE_DRIVE_API_ROOT_URL', None)
+        if root_url:
+            # Point every endpoint (API, uploads, batch) at a stand-in such as benchmarks/fake_drive.py
+            doc['rootUrl'] = root_url.rstrip('/') + '/'
+            doc['baseUrl'] = doc['rootUrl'] + doc['servicePath']
+            logger.info(f"Using Drive API root URL {doc['rootUrl']}")
+        return doc
+
+    def get_credentials(self):
+        """Return the shared credentials, loading them on first use."""
+        with self._lock:
+            self._reset_if_forked()
+            if self.credentials is None:
+                self.credentials = self._load_credentials()
+                self.discovery_doc = self._load_discovery_doc()
+                logger.info("Loaded Google Drive credentials for this process")
+            return self.credentials
+
+    def get_http(self):
+        """Return the authorized HTTP transport owned by the calling thread."""
+        credentials = self.get_credentials()
+        local = self._local
+        if getattr(local, 'generation', None) != self._generation or getattr(local, 'http', None) is None:
+            timeout = getattr(settings, 'GOOGLE_DRIVE_HTTP_TIMEOUT', 60)
+            http = httplib2.Http(timeout=timeout)
+            # Resumable uploads answer 308 without a Location; it is not a redirect
+            # (googleapiclient's own build_http() does the same)
+            http.redirect_codes = http.redirect_codes - {308}
+            local.http = google_auth_httplib2.AuthorizedHttp(credentials, http=http)
+            local.service = None
+            local.generation = self._generation
+        return local.http
+
+    def get_session(self):
+        """Return the authorized requests session owned by the calling thread.
+
+        Downloads use it instead of httplib2, which always reads a whole
+        response body into memory before returning.
+        """
+        credentials = self.get_credentials()
+        local = self._local
+        if getattr(local, 'session', None) is None:
+            local.session = AuthorizedSession(credentials)
+        return local.session
+
+    def get_service(self):
+        """Return the Drive v3 service object owned by the calling thread."""
+        http = self.get_http()
+        local = self._local
+        if local.service is None:
+            local.service = build_from_document(self.discovery_doc, http=http)
+            logger.debug(f"Built Drive service for thread {threading.current_thread().name}")
+        return local.service
+
+    def warm_up(self, probe=False):
+        """Load credentials, mint an access token and build a client ahead of traffic."""
+        try:
+            service = self.get_service()
+            credentials = self.credentials
+            if not credentials.valid:
+                credentials.refresh(google_auth_httplib2.Request(self.get_http().http))
+            if probe:
+                results = service.files().list(pageSize=1, fields='files(id)').execute()
+                logger.info(f"Drive API connection successful. Found {len(results.get('files', []))} files.")
+            logger.info("Google Drive client pool warmed up")
+            return True
+        except Exception as e:
+            logger.error(f"Error warming up Google Drive client pool: {e}")
+            logger.error(traceback.format_exc())
+            return False
+
+    def reset(self):
+        """Drop cached credentials and clients, e.g. after rotating the key file."""
+        with self._lock:
+            self.credentials = None
+            self.discovery_doc = None
+            self._local = threading.local()
+            self._generation += 1
+
+
+pool = DriveClientPool()
+
+
+def warm_up_in_background(probe=False):
+    """Warm up the shared pool without blocking process start-up."""
+    thread = threading.Thread(
+        target=pool.warm_up,
+        kwargs={'probe': probe},
+        name='gdrive-warm-up',
+        daemon=True
+    )
+    thread.start()
+    return thread
@@ -0,0 +1,42 @@
+from django.conf import settings
+from django.core.cache import cache
+
+KNOWN_FOLDER_PREFIX = 'gdrive:folder:'
+FALLBACK_ROOT_KEY = 'gdrive:fallback-root-folder'
+
+# Name of the folder uploads go to when their parent folder is missing
+FALLBACK_ROOT_NAME = 'gdriveftp_root_folder'
+
+DEFAULT_TTL = 60 * 60
+
+
+def _ttl():
+    return getattr(settings, 'GOOGLE_DRIVE_FOLDER_CACHE_TTL', DEFAULT_TTL)
+
+
+def remember_folder(folder_id):
+    """Record that a Drive folder is known to exist."""
+    if folder_id:
+        cache.set(f'{KNOWN_FOLDER_PREFIX}{folder_id}', True, _ttl())
+
+
+def is_known_folder(folder_id):
+    """Return True if the folder was created or verified recently."""
+    return bool(folder_id) and cache.get(f'{KNOWN_FOLDER_PREFIX}{folder_id}', False)
+
+
+def forget_folder(folder_id):
+    """Drop a folder from the cache, e.g. after deleting it or finding it gone."""
+    cache.delete(f'{KNOWN_FOLDER_PREFIX}{folder_id}')
+    if cache.get(FALLBACK_ROOT_KEY) == folder_id:
+        cache.delete(FALLBACK_ROOT_KEY)
+
+
+def get_fallback_root():
+    """Return the cached ID of the shared fallback root folder, if any."""
+    return cache.get(FALLBACK_ROOT_KEY)
+
+
+def set_fallback_root(folder_id):
+    cache.set(FALLBACK_ROOT_KEY, folder_id, None)
+    remember_folder(folder_id)
@@ -2,22 +2,201 @@ import os
 import io
 import logging
 import json
+import time
 import mimetypes
 import traceback
+import httplib2
 from django.conf import settings
 from django.utils import timezone
 
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload, MediaIoBaseUpload
 from google.oauth2 import service_account
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 
+from .drive_pool import pool
+from .media import IterableMediaUpload
+from .tuning import tuner, UPLOAD, DOWNLOAD
+from .retry import call_with_retries, execute, limiter
+from .tracing import traced, add_bytes
+from .folder_cache import (
+    FALLBACK_ROOT_NAME, forget_folder, get_fallback_root, is_known_folder,
+    remember_folder, set_fallback_root,
+)
+
 # Set up logging
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# Default number of bytes fetched per ranged GET when streaming downloads
+DOWNLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Bytes read at a time from a download reply that ignored the range
+STREAM_BLOCK_SIZE = 64 * 1024
+
+# Default resumable upload chunk size for file objects and chunk streams
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+# files().list paging; Drive caps pageSize at 1000
+LIST_PAGE_SIZE = 1000
+MAX_LIST_PAGE_SIZE = 1000
+LIST_FIELDS = 'id, name, mimeType, size, createdTime'
+CHANGE_FIELDS = 'changeType, removed, fileId, file(id, name, mimeType, size, md5Checksum, parents, trashed, createdTime)'
+
+# Fields returned when a resumable upload session completes
+RESUMABLE_FIELDS = 'id,name,mimeType,size,webViewLink'
+
+
+def _http_error(response):
+    """Turn a requests error response into the HttpError the retry helpers understand."""
+    resp = httplib2.Response({'status': response.status_code, **dict(response.headers.items())})
+    return HttpError(resp, response.content, uri=response.url)
+
+
+def _parse_content_range(value):
+    """Return (start, end, total) from a 'bytes a-b/total' header; total may be None."""
+    try:
+        unit, _, spec = value.partition(' ')
+        span, _, total = spec.partition('/')
+        start, _, end = span.partition('-')
+        return int(start), int(end), (None if total == '*' else int(total))
+    except (AttributeError, ValueError):
+        return None
+
+
+class DriveDownload:
+    """Iterator over the bytes of a Drive file, fetched one ranged GET at a time.
+    
+    Only one chunk is held in memory at a time, so memory use is bounded by
+    the chunk size rather than the file size. With adaptive=True the chunk
+    size is re-read from the transfer tuner before every request. session
+    is a streaming requests session (see DriveClientPool.get_session), so a
+    reply that ignores the range is read as it arrives rather than whole.
+    """
+    
+    def __init__(self, session, uri, start, end, chunk_size, adaptive=False):
+        self.session = session
+        self.uri = uri
+        self.start = start
+        self.end = end
+        self.chunk_size = chunk_size
+        self.adaptive = adaptive
+        self.total_size = None
+        self._first_chunk = None
+        self._response = None
+        self._body = None
+        self._pending = bytearray()
+    
+    @property
+    def length(self):
+        """Number of bytes this download will yield."""
+        if self.end is None:
+            return None
+        return self.end - self.start + 1
+    
+    def _read_body(self, size):
+        """The next size bytes of a whole-file reply; fewer at the end of the file."""
+        with tuner.timed(DOWNLOAD) as timing:
+            while len(self._pending) < size:
+                block = next(self._body, b'')
+                if not block:
+                    break
+                self._pending.extend(block)
+            chunk = bytes(self._pending[:size])
+            del self._pending[:size]
+            timing.nbytes = len(chunk)
+        return chunk
+    
+    def _stream_body(self, response, offset):
+        """Switch to reading a whole-file reply, skipping the bytes before offset."""
+        self._response = response
+        self._body = response.iter_content(STREAM_BLOCK_SIZE)
+        length = response.headers.get('content-length')
+        if length and not response.headers.get('content-encoding'):
+            self.total_size = int(length)
+        skipped = 0
+        while skipped < offset:
+            block = self._read_body(min(offset - skipped, self.chunk_size))
+            if not block:
+                break
+            skipped += len(block)
+    
+    def _fetch(self, offset):
+        if self.adaptive:
+            self.chunk_size = tuner.chunk_size(DOWNLOAD)
+        last = offset + self.chunk_size - 1
+        if self.end is not None:
+            last = min(last, self.end)
+        if self._body is not None:
+            # Drive is already sending the whole file; keep reading it
+            return self._read_body(last - offset + 1)
+    
+        def fetch():
+            with tuner.timed(DOWNLOAD) as timing:
+                response = self.session.get(
+                    self.uri,
+                    headers={'Range': f'bytes={offset}-{last}'},
+                    stream=True,
+                    timeout=getattr(settings, 'GOOGLE_DRIVE_HTTP_TIMEOUT', 60)
+                )
+                if response.status_code != 200:
+                    timing.nbytes = len(response.content) if response.status_code < 300 else 0
+            if response.status_code >= 300 and response.status_code != 416:
+                raise _http_error(response)
+            return response
+        
+        response = call_with_retries(fetch, 'Drive ranged download')
+        if response.status_code == 416:
+            # Range starts past the end of the file (e.g. an empty file)
+            return b''
+        
+        if response.status_code == 200:
+            # Server ignored the range and is sending the whole file; read on
+            # from this reply rather than asking again for every chunk
+            self._stream_body(response, offset)
+            return self._read_body(last - offset + 1)
+        
+        content_range = _parse_content_range(response.headers.get('content-range'))
+        if content_range and content_range[2] is not None:
+            self.total_size = content_range[2]
+        return response.content
+    
+    def open(self):
+        """Fetch the first chunk so errors surface before streaming starts."""
+        self._first_chunk = self._fetch(self.start)
+        if self.total_size is not None:
+            last_byte = self.total_size - 1
+            self.end = last_byte if self.end is None else min(self.end, last_byte)
+        elif self.end is None and len(self._first_chunk) < self.chunk_size:
+            self.end = self.start + len(self._first_chunk) - 1
+        return self
+    
+    def __iter__(self):
+        chunk = self._first_chunk
+        self._first_chunk = None
+        offset = self.start
+        try:
+            while chunk:
+                offset += len(chunk)
+                yield chunk
+                if self.end is not None and offset > self.end:
+                    break
+                chunk = self._fetch(offset)
+        finally:
+            self.close()
+    
+    def close(self):
+        """Release a whole-file reply that is still open."""
+        if self._response is not None:
+            self._response.close()
+            self._response = None
+
+
 class GoogleDriveService:
     def __init__(self):
         self.credentials = None
@@ -25,203 +204,391 @@ class GoogleDriveService:
         self.initialize_service()
     
     def initialize_service(self):
-        """Initialize the Google Drive API service."""
+        """Initialize the Google Drive API service from the shared client pool."""
         try:
-            credentials_path = settings.GOOGLE_DRIVE_STORAGE_JSON_KEY_FILE
-            
-            if not os.path.exists(credentials_path):
-                logger.error(f"Credentials file not found at {credentials_path}")
-                raise FileNotFoundError(f"Credentials file not found at {credentials_path}")
-                
-            # Log the content of credentials file (with sensitive data redacted)
-            try:
-                with open(credentials_path, 'r') as f:
-                    cred_data = json.load(f)
-                    # Redact sensitive information for logging
-                    if 'private_key' in cred_data:
-                        cred_data['private_key'] = 'REDACTED'
-                    if 'client_email' in cred_data:
-                        logger.info(f"Using service account: {cred_data['client_email']}")
-                    logger.debug(f"Credentials data structure: {json.dumps(cred_data, indent=2)}")
-            except Exception as e:
-                logger.warning(f"Could not parse credentials file for debugging: {e}")
-            
-            # Create credentials from service account file
-            self.credentials = service_account.Credentials.from_service_account_file(
-                credentials_path,
-                scopes=['https://www.googleapis.com/auth/drive']
-            )
-            
-            # Build the service
-            self.service = build('drive', 'v3', credentials=self.credentials)
-            
-            # Test if service is working by listing files
-            try:
-                results = self.service.files().list(pageSize=5).execute()
-                files = results.get('files', [])
-                logger.info(f"Drive API connection successful. Found {len(files)} files.")
-            except Exception as e:
-                logger.error(f"Drive API connection test failed: {e}")
-                logger.error(traceback.format_exc())
-            
-            logger.info("Google Drive service initialized successfully")
-            
+            self.credentials = pool.get_credentials()
+            self.service = pool.get_service()
+            logger.debug("Google Drive service initialized from client pool")
         except Exception as e:
             logger.error(f"Error initializing Google Drive service: {e}")
             logger.error(traceback.format_exc())
             self.service = None
     
-    def create_user_folder(self, folder_name):
-        """Create a folder in Google Drive for a user and return its ID."""
+    def upload_file(self, file_path, file_name, parent_folder_id, share_with_email=None, progress_callback=None):
+        """Upload a file to Google Drive and return its ID. Optionally share with an email."""
         if not self.service:
             logger.error("Google Drive service not initialized")
             return None
         
         try:
-            file_metadata = {
-                'name': folder_name,
-                'mimeType': 'application/vnd.google-apps.folder'
-            }
+            # Verify file exists
+            if not os.path.exists(file_path):
+                logger.error(f"File not found at path: {file_path}")
+                return None
+                
+            # Log file details
+            file_size = os.path.getsize(file_path)
+            logger.info(f"Uploading file: {file_name} ({file_size} bytes) from {file_path}")
             
-            folder = self.service.files().create(
-                body=file_metadata,
-                fields='id'
-            ).execute()
+            # Determine MIME type
+            mime_type, _ = mimetypes.guess_type(file_path)
+            if mime_type is None:
+                mime_type = 'application/octet-stream'
+            logger.info(f"Using MIME type: {mime_type}")
+            
+            # Small files go in one multipart request; large ones in tuned resumable chunks
+            resumable = tuner.use_resumable(file_size)
+            chunk_size = tuner.chunk_size(UPLOAD)
+            logger.info(f"Upload mode: {'resumable' if resumable else 'multipart'}, chunk size {chunk_size}")
+            media = MediaFileUpload(
+                file_path,
+                mimetype=mime_type,
+                chunksize=chunk_size,
+                resumable=resumable
+            )
+            return self._upload_media(media, file_name, parent_folder_id, share_with_email, progress_callback)
             
-            folder_id = folder.get('id')
-            logger.info(f"Created user folder {folder_name} with ID {folder_id}")
-            return folder_id
         except Exception as e:
-            logger.error(f"Error creating folder: {e}")
+            logger.error(f"Error uploading file: {e}")
+            logger.error(traceback.format_exc())
             return None
     
-    def create_subfolder(self, folder_name, parent_folder_id):
-        """Create a subfolder in Google Drive and return its ID."""
+    def upload_fileobj(self, source, file_name, parent_folder_id, mime_type=None, share_with_email=None, progress_callback=None):
+        """Upload from a file-like object or an iterator of byte chunks and return the file ID.
+        
+        Seekable file objects such as Django's InMemoryUploadedFile and
+        TemporaryUploadedFile are read in place, so no temporary copy is made.
+        progress_callback(bytes_sent, total_bytes) is called after each chunk.
+        """
         if not self.service:
             logger.error("Google Drive service not initialized")
             return None
         
         try:
-            file_metadata = {
-                'name': folder_name,
-                'mimeType': 'application/vnd.google-apps.folder',
-                'parents': [parent_folder_id]
-            }
-            
-            folder = self.service.files().create(
-                body=file_metadata,
-                fields='id'
-            ).execute()
+            if mime_type is None:
+                mime_type, _ = mimetypes.guess_type(file_name)
+            if mime_type is None:
+                mime_type = 'application/octet-stream'
             
-            folder_id = folder.get('id')
-            logger.info(f"Created subfolder {folder_name} with ID {folder_id} in parent {parent_folder_id}")
+            chunk_size = tuner.chunk_size(UPLOAD)
+            if hasattr(source, 'read') and hasattr(source, 'seek'):
+                source.seek(0, os.SEEK_END)
+                file_size = source.tell()
+                source.seek(0)
+                resumable = tuner.use_resumable(file_size)
+                media = MediaIoBaseUpload(source, mimetype=mime_type, chunksize=chunk_size, resumable=resumable)
+                logger.info(f"Uploading file: {file_name} ({file_size} bytes) from file object, "
+                            f"{'resumable with ' + str(chunk_size) + '-byte chunks' if resumable else 'multipart'}")
+            else:
+                tuner.note_unknown_size()
+                media = IterableMediaUpload(source, mimetype=mime_type, chunksize=chunk_size)
+                logger.info(f"Uploading file: {file_name} from chunk stream, {chunk_size}-byte chunks")
+            
+            return self._upload_media(media, file_name, parent_folder_id, share_with_email, progress_callback)
+        
+        except Exception as e:
+            logger.error(f"Error uploading file: {e}")
+            logger.error(traceback.format_exc())
+            return None
+    
+    def _upload_media(self, media, file_name, parent_folder_id, share_with_email=None, progress_callback=None):
+        """Send prepared media to Drive, optionally share it, and return the new file ID."""
+        trusted_parent = is_known_folder(parent_folder_id)
+        parent_folder_id = self._ensure_parent(parent_folder_id)
+        
+        try:
+            response = self._create_with_media(media, file_name, parent_folder_id, progress_callback)
+        except HttpError as e:
+            if not (trusted_parent and e.resp.status == 404):
+                raise
+            # The cached parent has gone away; check it properly and retry once
+            logger.warning(f"Cached parent folder {parent_folder_id} not found, revalidating")
+            forget_folder(parent_folder_id)
+            parent_folder_id = self._ensure_parent(parent_folder_id)
+            response = self._create_with_media(media, file_name, parent_folder_id, progress_callback)
+        
+        # Log complete response
+        logger.info(f"Upload complete: {response}")
+        file_id = response.get('id')
+        web_link = response.get('webViewLink', 'No web link available')
+        logger.info(f"Uploaded file {file_name} with ID {file_id} to folder {parent_folder_id}")
+        logger.info(f"File can be viewed at: {web_link}")
+        
+        # Share the file if an email is provided
+        if share_with_email and file_id:
+            self.share_file(file_id, share_with_email)
+        
+        if self._verify_writes():
+            self._verify(file_id, "File upload")
+        
+        return file_id
+    
+    def _create_with_media(self, media, file_name, parent_folder_id, progress_callback=None):
+        """Run a files().create upload to completion and return the response."""
+        file_metadata = {
+            'name': file_name,
+            'parents': [parent_folder_id],
+            'description': f'Uploaded by GDriveFTP at {timezone.now().strftime("%Y-%m-%d %H:%M:%S")}'
+        }
+        logger.debug(f"File metadata: {file_metadata}")
+        
+        # Execute the upload with progress reporting
+        logger.info("Starting file upload...")
+        request = self.service.files().create(
+            body=file_metadata,
+            media_body=media,
+            fields='id,name,mimeType,size,webViewLink'
+        )
+        
+        if not media.resumable():
+            # Multipart upload: metadata and content in a single request
+            with tuner.timed(UPLOAD) as timing:
+                response = execute(request, 'Drive multipart upload')
+                timing.nbytes = media.size()
+            if progress_callback:
+                progress_callback(media.size(), media.size())
+            return response
+        
+        response = None
+        sent = 0
+        while response is None:
+            with tuner.timed(UPLOAD) as timing:
+                # After a failed chunk, next_chunk() asks Drive for the committed offset first
+                status, response = call_with_retries(request.next_chunk, 'Drive upload chunk')
+                progress = status.resumable_progress if status else (media.size() or sent)
+                timing.nbytes = progress - sent
+            sent = progress
+            if status:
+                logger.info(f"Upload progress: {int(status.progress() * 100)}%")
+                if progress_callback:
+                    progress_callback(status.resumable_progress, status.total_size)
+        
+        return response
+    
+    def _verify_writes(self):
+        return getattr(settings, 'GOOGLE_DRIVE_VERIFY_WRITES', False)
+    
+    def _verify(self, item_id, label):
+        """Debug check that an item we just created can be read back."""
+        try:
+            verification = execute(self.service.files().get(fileId=item_id, fields="id,name"))
+            logger.info(f"{label} verified: {verification.get('name')} ({item_id})")
+        except Exception as e:
+            logger.error(f"{label} verification failed: {str(e)}")
+    
+    def _ensure_parent(self, parent_folder_id):
+        """Return a parent folder ID that is known to exist.
+        
+        Folders seen recently skip the files().get check. A missing parent
+        is replaced by the shared fallback root folder.
+        """
+        if is_known_folder(parent_folder_id):
+            return parent_folder_id
+        
+        try:
+            folder_check = execute(self.service.files().get(fileId=parent_folder_id, fields="id,name"))
+            logger.info(f"Parent folder verified: {folder_check.get('name')} ({parent_folder_id})")
+            remember_folder(parent_folder_id)
+            return parent_folder_id
+        except Exception as e:
+            logger.error(f"Parent folder validation failed: {str(e)}")
+            fallback_id = self._fallback_root_folder()
+            logger.info(f"Using fallback root folder: {fallback_id}")
+            return fallback_id
+    
+    def _fallback_root_folder(self):
+        """Return the ID of the shared fallback root folder, creating it only once."""
+        folder_id = get_fallback_root()
+        if folder_id:
             return folder_id
+        
+        try:
+            results = execute(self.service.files().list(
+                q=f"name = '{FALLBACK_ROOT_NAME}' and mimeType = '{FOLDER_MIME_TYPE}' and trashed = false",
+                fields='files(id)',
+                pageSize=1
+            ))
+            existing = results.get('files', [])
+            if existing:
+                folder_id = existing[0]['id']
         except Exception as e:
-            logger.error(f"Error creating subfolder: {e}")
+            logger.error(f"Error looking up fallback root folder: {e}")
+        
+        if not folder_id:
+            folder_id = self.create_user_folder(FALLBACK_ROOT_NAME)
+            logger.info(f"Created fallback root folder: {folder_id}")
+        if folder_id:
+            set_fallback_root(folder_id)
+        return folder_id
+    
+    def share_file(self, file_id, email, role='writer'):
+        """Give an email address access to a file or folder. Returns True on success."""
+        if not self.service:
+            logger.error("Google Drive service not initialized")
+            return False
+        
+        try:
+            logger.info(f"Sharing {file_id} with: {email}")
+            permission = {
+                'type': 'user',
+                'role': role,
+                'emailAddress': email
+            }
+            share_result = execute(self.service.permissions().create(
+                fileId=file_id,
+                body=permission,
+                fields='id',
+                sendNotificationEmail=False
+            ))
+            logger.info(f"Shared {file_id} with {email}: {share_result}")
+            return True
+        except Exception as e:
+            logger.error(f"Error sharing file: {e}")
+            logger.error(traceback.format_exc())
+            return False
+    
+    def move_file(self, file_id, new_parent_id, old_parent_id):
+        """Move a file to another folder. Returns True on success."""
+        if not self.service:
+            logger.error("Google Drive service not initialized")
+            return False
+        
+        try:
+            execute(self.service.files().update(
+                fileId=file_id,
+                addParents=new_parent_id,
+                removeParents=old_parent_id,
+                fields='id,parents'
+            ))
+            logger.info(f"Moved file {file_id} from {old_parent_id} to {new_parent_id}")
+            return True
+        except Exception as e:
+            logger.error(f"Error moving file: {e}")
+            return False
+    
+    def copy_file(self, file_id, file_name, parent_folder_id):
+        """Copy a file server-side into a folder under a new name. Returns the copy's ID or None."""
+        if not self.service:
+            logger.error("Google Drive service not initialized")
+            return None
+        
+        try:
+            copy = execute(self.service.files().copy(
+                fileId=file_id,
+                body={
+                    'name': file_name,
+                    'parents': [parent_folder_id],
+                    'description': f'Uploaded by GDriveFTP at {timezone.now().strftime("%Y-%m-%d %H:%M:%S")}'
+                },
+                fields='id'
+            ))
+            logger.info(f"Copied {file_id} to {copy.get('id')} in folder {parent_folder_id}")
+            return copy.get('id')
+        except Exception as e:
+            logger.error(f"Error copying file {file_id}: {e}")
             return None
     
-    def upload_file(self, file_path, file_name, parent_folder_id, share_with_email=None):
-        """Upload a file to Google Drive and return its ID. Optionally share with an email."""
+    def start_resumable_session(self, file_name, parent_folder_id, mime_type=None, size=None):
+        """Open a Drive resumable upload session and return its session URI."""
         if not self.service:
             logger.error("Google Drive service not initialized")
             return None
         
         try:
-            # Verify file exists
-            if not os.path.exists(file_path):
-                logger.error(f"File not found at path: {file_path}")
-                return None
-                
-            # Log file details
-            file_size = os.path.getsize(file_path)
-            logger.info(f"Uploading file: {file_name} ({file_size} bytes) from {file_path}")
-            
-            # Determine MIME type
-            mime_type, _ = mimetypes.guess_type(file_path)
             if mime_type is None:
-                mime_type = 'application/octet-stream'
-            logger.info(f"Using MIME type: {mime_type}")
+                mime_type, _ = mimetypes.guess_type(file_name)
+            mime_type = mime_type or 'application/octet-stream'
             
-            # Verify parent folder exists
-            try:
-                folder_check = self.service.files().get(fileId=parent_folder_id, fields="id,name").execute()
-                logger.info(f"Parent folder verified: {folder_check.get('name')} ({parent_folder_id})")
-            except Exception as e:
-                logger.error(f"Parent folder validation failed: {str(e)}")
-                # Create a root folder as fallback
-                parent_folder_id = self.create_user_folder("gdriveftp_root_folder")
-                logger.info(f"Created fallback root folder: {parent_folder_id}")
-            
-            # Create file metadata
             file_metadata = {
                 'name': file_name,
                 'parents': [parent_folder_id],
                 'description': f'Uploaded by GDriveFTP at {timezone.now().strftime("%Y-%m-%d %H:%M:%S")}'
             }
-            logger.debug(f"File metadata: {file_metadata}")
-            
-            # Create media
-            media = MediaFileUpload(
-                file_path,
-                mimetype=mime_type,
-                resumable=True
-            )
-            
-            # Execute the upload with progress reporting
-            logger.info("Starting file upload...")
-            request = self.service.files().create(
-                body=file_metadata,
-                media_body=media,
-                fields='id,name,mimeType,size,webViewLink'
-            )
-            
-            response = None
-            while response is None:
-                status, response = request.next_chunk()
-                if status:
-                    logger.info(f"Upload progress: {int(status.progress() * 100)}%")
-            
-            # Log complete response
-            logger.info(f"Upload complete: {response}")
-            file_id = response.get('id')
-            web_link = response.get('webViewLink', 'No web link available')
-            logger.info(f"Uploaded file {file_name} with ID {file_id} to folder {parent_folder_id}")
-            logger.info(f"File can be viewed at: {web_link}")
-            
-            # Share the file if an email is provided
-            if share_with_email and file_id:
-                try:
-                    logger.info(f"Sharing file with: {share_with_email}")
-                    permission = {
-                        'type': 'user',
-                        'role': 'writer',
-                        'emailAddress': share_with_email
-                    }
-                    share_result = self.service.permissions().create(
-                        fileId=file_id,
-                        body=permission,
-                        fields='id',
-                        sendNotificationEmail=False
-                    ).execute()
-                    logger.info(f"Shared file {file_name} with {share_with_email}: {share_result}")
-                except Exception as e:
-                    logger.error(f"Error sharing file: {e}")
-                    logger.error(traceback.format_exc())
-            
-            # Final verification - check if file exists
-            try:
-                verification = self.service.files().get(fileId=file_id, fields="id,name").execute()
-                logger.info(f"File upload verified: {verification.get('name')} ({file_id})")
-            except Exception as e:
-                logger.error(f"File verification failed: {str(e)}")
-            
-            return file_id
-            
+            headers = {
+                'Content-Type': 'application/json; charset=UTF-8',
+                'X-Upload-Content-Type': mime_type
+            }
+            if size is not None:
+                headers['X-Upload-Content-Length'] = str(size)
+            
+            upload_url = f"{self.service._rootDesc['rootUrl']}upload/drive/v3/files?uploadType=resumable&fields={RESUMABLE_FIELDS}"
+            def open_session():
+                started = time.monotonic()
+                resp, content = self.service._http.request(
+                    upload_url,
+                    method='POST',
+                    body=json.dumps(file_metadata),
+                    headers=headers
+                )
+                # Opening a session carries no file data, so it measures round-trip time
+                tuner.record_rtt(time.monotonic() - started)
+                if resp.status != 200 or 'location' not in resp:
+                    raise HttpError(resp, content, uri=upload_url)
+                return resp
+            
+            resp = call_with_retries(open_session, 'Drive resumable session')
+            
+            logger.info(f"Opened resumable upload session for {file_name} in folder {parent_folder_id}")
+            return resp['location']
         except Exception as e:
-            logger.error(f"Error uploading file: {e}")
+            logger.error(f"Error starting resumable upload: {e}")
             logger.error(traceback.format_exc())
             return None
-            
+    
+    def upload_session_chunk(self, session_uri, data, offset, total_size=None):
+        """Send bytes starting at offset to a resumable session.
+        
+        Returns (next_offset, file_resource). file_resource is the created
+        file's metadata once the last chunk has been accepted, otherwise None.
+        Raises HttpError if Drive rejects the chunk.
+        """
+        total = '*' if total_size is None else str(total_size)
+        if data:
+            content_range = f'bytes {offset}-{offset + len(data) - 1}/{total}'
+        else:
+            content_range = f'bytes */{total}'
+        
+        # Not retried here: after a failure the caller must ask Drive for the
+        # committed offset (query_session_offset) before sending more
+        limiter.acquire()
+        started = time.monotonic()
+        with traced('Drive upload chunk'):
+            resp, content = self.service._http.request(
+                session_uri,
+                method='PUT',
+                body=bytes(data),
+                headers={'Content-Range': content_range, 'Content-Length': str(len(data))}
+            )
+            add_bytes(len(data))
+        if data:
+            tuner.record_transfer(UPLOAD, len(data), time.monotonic() - started)
+        else:
+            tuner.record_rtt(time.monotonic() - started)
+        if resp.status in (200, 201):
+            return offset + len(data), json.loads(content.decode('utf-8'))
+        if resp.status == 308:
+            # Drive reports the bytes it has committed as 'bytes=0-N'
+            committed = resp.get('range')
+            next_offset = int(committed.rsplit('-', 1)[1]) + 1 if committed else 0
+            return next_offset, None
+        raise HttpError(resp, content, uri=session_uri)
+    
+    def query_session_offset(self, session_uri, total_size):
+        """Ask a resumable session how many bytes it has committed.
+        
+        Returns (offset, file_resource) like upload_session_chunk, or None if
+        the session has expired or is unknown to Drive.
+        """
+        try:
+            # A status query changes nothing, so it is safe to retry
+            return call_with_retries(lambda: self.upload_session_chunk(session_uri, b'', 0, total_size),
+                                     'Drive upload status query')
+        except HttpError as e:
+            if e.resp.status in (404, 410):
+                logger.info(f"Resumable session has expired: {session_uri}")
+                return None
+            raise
+    
     def create_user_folder(self, folder_name, share_with_email=None):
         """Create a folder in Google Drive for a user and return its ID."""
         if not self.service:
@@ -239,42 +606,24 @@ class GoogleDriveService:
             
             logger.debug(f"Folder metadata: {file_metadata}")
             
-            folder = self.service.files().create(
+            folder = execute(self.service.files().create(
                 body=file_metadata,
                 fields='id,name,webViewLink'
-            ).execute()
+            ))
             
             folder_id = folder.get('id')
             web_link = folder.get('webViewLink', 'No web link available')
             logger.info(f"Created user folder {folder_name} with ID {folder_id}")
             logger.info(f"Folder can be viewed at: {web_link}")
             
+            remember_folder(folder_id)
+            
             # Share the folder if an email is provided
             if share_with_email and folder_id:
-                try:
-                    logger.info(f"Sharing folder with: {share_with_email}")
-                    permission = {
-                        'type': 'user',
-                        'role': 'writer',
-                        'emailAddress': share_with_email
-                    }
-                    share_result = self.service.permissions().create(
-                        fileId=folder_id,
-                        body=permission,
-                        fields='id',
-                        sendNotificationEmail=False
-                    ).execute()
-                    logger.info(f"Shared folder {folder_name} with {share_with_email}: {share_result}")
-                except Exception as e:
-                    logger.error(f"Error sharing folder: {e}")
-                    logger.error(traceback.format_exc())
+                self.share_file(folder_id, share_with_email)
             
-            # Verify folder was created
-            try:
-                verification = self.service.files().get(fileId=folder_id, fields="id,name").execute()
-                logger.info(f"Folder creation verified: {verification.get('name')} ({folder_id})")
-            except Exception as e:
-                logger.error(f"Folder verification failed: {str(e)}")
+            if self._verify_writes():
+                self._verify(folder_id, "Folder creation")
             
             return folder_id
         except Exception as e:
@@ -291,13 +640,15 @@ class GoogleDriveService:
         try:
             logger.info(f"Creating subfolder: {folder_name} in parent folder: {parent_folder_id}")
             
-            # Verify parent folder exists
-            try:
-                parent_check = self.service.files().get(fileId=parent_folder_id, fields="id,name").execute()
-                logger.info(f"Parent folder verified: {parent_check.get('name')} ({parent_folder_id})")
-            except Exception as e:
-                logger.error(f"Parent folder validation failed: {str(e)}")
-                return None
+            # Verify parent folder exists, unless we have seen it recently
+            if not is_known_folder(parent_folder_id):
+                try:
+                    parent_check = execute(self.service.files().get(fileId=parent_folder_id, fields="id,name"))
+                    logger.info(f"Parent folder verified: {parent_check.get('name')} ({parent_folder_id})")
+                    remember_folder(parent_folder_id)
+                except Exception as e:
+                    logger.error(f"Parent folder validation failed: {str(e)}")
+                    return None
             
             file_metadata = {
                 'name': folder_name,
@@ -308,42 +659,24 @@ class GoogleDriveService:
             
             logger.debug(f"Subfolder metadata: {file_metadata}")
             
-            folder = self.service.files().create(
+            folder = execute(self.service.files().create(
                 body=file_metadata,
                 fields='id,name,webViewLink'
-            ).execute()
+            ))
             
             folder_id = folder.get('id')
             web_link = folder.get('webViewLink', 'No web link available')
             logger.info(f"Created subfolder {folder_name} with ID {folder_id} in parent {parent_folder_id}")
             logger.info(f"Subfolder can be viewed at: {web_link}")
             
+            remember_folder(folder_id)
+            
             # Share the folder if an email is provided
             if share_with_email and folder_id:
-                try:
-                    logger.info(f"Sharing subfolder with: {share_with_email}")
-                    permission = {
-                        'type': 'user',
-                        'role': 'writer',
-                        'emailAddress': share_with_email
-                    }
-                    share_result = self.service.permissions().create(
-                        fileId=folder_id,
-                        body=permission,
-                        fields='id',
-                        sendNotificationEmail=False
-                    ).execute()
-                    logger.info(f"Shared subfolder {folder_name} with {share_with_email}: {share_result}")
-                except Exception as e:
-                    logger.error(f"Error sharing subfolder: {e}")
-                    logger.error(traceback.format_exc())
+                self.share_file(folder_id, share_with_email)
             
-            # Verify subfolder was created
-            try:
-                verification = self.service.files().get(fileId=folder_id, fields="id,name").execute()
-                logger.info(f"Subfolder creation verified: {verification.get('name')} ({folder_id})")
-            except Exception as e:
-                logger.error(f"Subfolder verification failed: {str(e)}")
+            if self._verify_writes():
+                self._verify(folder_id, "Subfolder creation")
             
             return folder_id
         except Exception as e:
@@ -351,6 +684,18 @@ class GoogleDriveService:
             logger.error(traceback.format_exc())
             return None
     
+    def get_file_metadata(self, file_id, fields='id,name,mimeType,size,md5Checksum,version'):
+        """Return a file's metadata, or None on error."""
+        if not self.service:
+            logger.error("Google Drive service not initialized")
+            return None
+        
+        try:
+            return execute(self.service.files().get(fileId=file_id, fields=fields))
+        except Exception as e:
+            logger.error(f"Error fetching metadata for {file_id}: {e}")
+            return None
+    
     def download_file(self, file_id):
         """Download a file from Google Drive."""
         if not self.service:
@@ -360,11 +705,11 @@ class GoogleDriveService:
         try:
             request = self.service.files().get_media(fileId=file_id)
             file_content = io.BytesIO()
-            downloader = MediaIoBaseDownload(file_content, request)
+            downloader = MediaIoBaseDownload(file_content, request, chunksize=tuner.chunk_size(DOWNLOAD))
             
             done = False
             while not done:
-                status, done = downloader.next_chunk()
+                status, done = call_with_retries(downloader.next_chunk, 'Drive download chunk')
                 logger.debug(f"Download progress: {int(status.progress() * 100)}%")
             
             file_content.seek(0)
@@ -374,6 +719,29 @@ class GoogleDriveService:
             logger.error(f"Error downloading file: {e}")
             return None
     
+    def download_stream(self, file_id, start=0, end=None, chunk_size=None):
+        """Stream a file, or the byte range start..end, from Google Drive.
+        
+        Returns an opened DriveDownload that yields chunks as they arrive, or
+        None if the download could not be started.
+        """
+        if not self.service:
+            logger.error("Google Drive service not initialized")
+            return None
+        
+        # Without an explicit chunk size the tuner picks one per request
+        adaptive = chunk_size is None
+        chunk_size = chunk_size or tuner.chunk_size(DOWNLOAD)
+        
+        try:
+            request = self.service.files().get_media(fileId=file_id)
+            download = DriveDownload(pool.get_session(), request.uri, start, end, chunk_size, adaptive=adaptive).open()
+            logger.info(f"Streaming file with ID {file_id} (bytes {download.start}-{download.end})")
+            return download
+        except Exception as e:
+            logger.error(f"Error downloading file: {e}")
+            return None
+    
     def delete_file(self, file_id):
         """Delete a file from Google Drive."""
         if not self.service:
@@ -381,7 +749,7 @@ class GoogleDriveService:
             return False
         
         try:
-            self.service.files().delete(fileId=file_id).execute()
+            execute(self.service.files().delete(fileId=file_id))
             logger.info(f"Deleted file with ID {file_id}")
             return True
         except Exception as e:
@@ -395,38 +763,106 @@ class GoogleDriveService:
             return False
         
         try:
-            self.service.files().delete(fileId=folder_id).execute()
+            execute(self.service.files().delete(fileId=folder_id))
+            forget_folder(folder_id)
             logger.info(f"Deleted folder with ID {folder_id}")
             return True
         except Exception as e:
             logger.error(f"Error deleting folder: {e}")
             return False
     
-    def list_files_and_folders(self, folder_id):
+    def get_start_page_token(self):
+        """Return the current Changes API start page token, or None on error."""
+        if not self.service:
+            logger.error("Google Drive service not initialized")
+            return None
+        
+        try:
+            return execute(self.service.changes().getStartPageToken()).get('startPageToken')
+        except Exception as e:
+            logger.error(f"Error fetching start page token: {e}")
+            return None
+    
+    def list_changes(self, page_token, page_size=None):
+        """Return (changes, new_start_page_token) for everything after page_token.
+        
+        Follows nextPageToken until Drive hands back a newStartPageToken.
+        Raises on API errors so callers keep their old token.
+        """
+        page_size = min(page_size or getattr(settings, 'GOOGLE_DRIVE_LIST_PAGE_SIZE', LIST_PAGE_SIZE), MAX_LIST_PAGE_SIZE)
+        changes = []
+        while True:
+            results = execute(self.service.changes().list(
+                pageToken=page_token,
+                pageSize=page_size,
+                includeRemoved=True,
+                spaces='drive',
+                fields=f'nextPageToken, newStartPageToken, changes({CHANGE_FIELDS})'
+            ))
+            changes.extend(results.get('changes', []))
+            if 'newStartPageToken' in results:
+                logger.info(f"Fetched {len(changes)} Drive changes")
+                return changes, results['newStartPageToken']
+            page_token = results['nextPageToken']
+    
+    def iter_items(self, q=None, page_size=None, fields=LIST_FIELDS, order_by=None):
+        """Yield every item matching a Drive query, following nextPageToken.
+        
+        Only the listed item fields are requested. Raises on API errors.
+        """
+        page_size = min(page_size or getattr(settings, 'GOOGLE_DRIVE_LIST_PAGE_SIZE', LIST_PAGE_SIZE), MAX_LIST_PAGE_SIZE)
+        params = {
+            'pageSize': page_size,
+            'fields': f'nextPageToken, files({fields})'
+        }
+        if q:
+            params['q'] = q
+        if order_by:
+            params['orderBy'] = order_by
+        
+        page_token = None
+        while True:
+            results = execute(self.service.files().list(pageToken=page_token, **params))
+            yield from results.get('files', [])
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+    
+    def iter_children(self, folder_id, q=None, page_size=None, fields=LIST_FIELDS):
+        """Yield every item directly inside a folder, optionally narrowed by an extra query."""
+        query = f"'{folder_id}' in parents and trashed = false"
+        if q:
+            query = f"{query} and ({q})"
+        return self.iter_items(query, page_size=page_size, fields=fields)
+    
+    def list_files_and_folders(self, folder_id, q=None, page_size=None, fields=LIST_FIELDS):
         """List all files and folders in a folder."""
         if not self.service:
             logger.error("Google Drive service not initialized")
             return []
         
         try:
-            results = self.service.files().list(
-                q=f"'{folder_id}' in parents",
-                fields="files(id, name, mimeType, size, createdTime)"
-            ).execute()
-            
-            items = results.get('files', [])
+            items = list(self.iter_children(folder_id, q=q, page_size=page_size, fields=fields))
             logger.info(f"Listed {len(items)} items in folder {folder_id}")
             return items
         except Exception as e:
             logger.error(f"Error listing files and folders: {e}")
             return []
     
+    def list_files_and_folders_split(self, folder_id, page_size=None, fields=LIST_FIELDS):
+        """List a folder once and return (files, folders)."""
+        files, folders = [], []
+        for item in self.list_files_and_folders(folder_id, page_size=page_size, fields=fields):
+            if item.get('mimeType') == FOLDER_MIME_TYPE:
+                folders.append(item)
+            else:
+                files.append(item)
+        return files, folders
+    
     def list_files(self, folder_id):
         """List all files in a folder."""
-        items = self.list_files_and_folders(folder_id)
-        return [item for item in items if item.get('mimeType') != 'application/vnd.google-apps.folder']
+        return self.list_files_and_folders(folder_id, q=f"mimeType != '{FOLDER_MIME_TYPE}'")
     
     def list_folders(self, folder_id):
         """List all subfolders in a folder."""
-        items = self.list_files_and_folders(folder_id)
-        return [item for item in items if item.get('mimeType') == 'application/vnd.google-apps.folder']
\ No newline at end of file
+        return self.list_files_and_folders(folder_id, q=f"mimeType = '{FOLDER_MIME_TYPE}'")
\ No newline at end of file
@@ -0,0 +1,140 @@
+import logging
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .gdrive import GoogleDriveService, FOLDER_MIME_TYPE
+from .models import DriveSyncState, FileEntry, FolderEntry
+from .transfers import run_drive_tasks
+
+logger = logging.getLogger(__name__)
+
+# Listing is I/O bound, so this can be wider than the upload pool
+DEFAULT_IMPORT_CONCURRENCY = 8
+BULK_BATCH_SIZE = 1000
+
+IMPORT_FIELDS = 'id, name, mimeType, size, md5Checksum, createdTime'
+
+
+def _list_folder(folder_id):
+    """Task that lists one folder; raises so failed folders are not mistaken for empty ones."""
+    def task(drive_service):
+        return list(drive_service.iter_children(folder_id, fields=IMPORT_FIELDS))
+    return task
+
+
+def import_drive_tree(profile, max_workers=None, batch_size=BULK_BATCH_SIZE, drive_service=None):
+    """Index everything under a user's Drive root folder into FolderEntry/FileEntry.
+
+    Items that are already indexed are left alone, so the import can be
+    re-run after a partial failure. Returns a dict of counts.
+    """
+    user = profile.user
+    drive_service = drive_service or GoogleDriveService()
+
+    # Start change tracking before walking so edits made during the import
+    # are picked up by the next sync_drive run.
+    if not DriveSyncState.objects.filter(profile=profile, root_folder_id=profile.drive_folder_id).exists():
+        token = drive_service.get_start_page_token()
+        if token:
+            DriveSyncState.objects.update_or_create(
+                profile=profile,
+                defaults={'root_folder_id': profile.drive_folder_id, 'page_token': token}
+            )
+
+    stats = import_subtrees(user, [(profile.drive_folder_id, None)], max_workers=max_workers,
+                            batch_size=batch_size, drive_service=drive_service)
+    logger.info(f"Drive import for {user.username} finished: {stats}")
+    return stats
+
+
+def import_subtrees(user, roots, max_workers=None, batch_size=BULK_BATCH_SIZE, drive_service=None):
+    """Index the contents of Drive folders already known to the database.
+
+    roots are (drive folder id, FolderEntry or None for the user's root)
+    pairs. The trees are walked one level at a time. Every folder in a
+    level is listed concurrently, then the level's new folders and files
+    are inserted with bulk_create. Returns a dict of counts.
+    """
+    drive_service = drive_service or GoogleDriveService()
+    if max_workers is None:
+        max_workers = getattr(settings, 'GOOGLE_DRIVE_IMPORT_CONCURRENCY', DEFAULT_IMPORT_CONCURRENCY)
+    stats = {'folders': 0, 'files': 0, 'skipped': 0, 'failed_folders': 0}
+
+    known_folders = {folder.drive_folder_id: folder for folder in FolderEntry.objects.filter(user=user)}
+    known_files = set(FileEntry.objects.filter(user=user).values_list('drive_file_id', flat=True))
+
+    level = list(roots)
+    while level:
+        listings = run_drive_tasks([_list_folder(folder_id) for folder_id, _ in level],
+                                   max_workers=max_workers, drive_service=drive_service)
+
+        new_folders = []
+        new_files = []
+        next_level = []
+        for (folder_id, parent), items in zip(level, listings):
+            if items is None:
+                logger.error(f"Skipping subtree of Drive folder {folder_id} after a listing error")
+                stats['failed_folders'] += 1
+                continue
+            for item in items:
+                if item.get('mimeType') == FOLDER_MIME_TYPE:
+                    existing = known_folders.get(item['id'])
+                    if existing is None:
+                        new_folders.append(FolderEntry(
+                            user=user,
+                            folder_name=item['name'],
+                            drive_folder_id=item['id'],
+                            parent_folder=parent,
+                            depth=parent.depth + 1 if parent else 0
+                        ))
+                    else:
+                        stats['skipped'] += 1
+                        next_level.append((item['id'], existing))
+                elif item['id'] in known_files:
+                    stats['skipped'] += 1
+                else:
+                    known_files.add(item['id'])
+                    new_files.append(FileEntry(
+                        user=user,
+                        file_name=item['name'],
+                        file_size=int(item.get('size') or 0),
+                        file_type=item.get('mimeType') or 'application/octet-stream',
+                        drive_file_id=item['id'],
+                        upload_date=parse_datetime(item['createdTime']) if item.get('createdTime') else timezone.now(),
+                        folder=parent,
+                        md5_checksum=item.get('md5Checksum', '')
+                    ))
+
+        with transaction.atomic():
+            if new_folders:
+                # bulk_create skips save(), so paths are filled in here
+                FolderEntry.objects.bulk_create(new_folders, batch_size=batch_size)
+                if any(folder.pk is None for folder in new_folders):
+                    _load_pks(user, new_folders, batch_size)
+                for folder in new_folders:
+                    prefix = folder.parent_folder.path if folder.parent_folder else '/'
+                    folder.path = f"{prefix}{folder.pk}/"
+                    known_folders[folder.drive_folder_id] = folder
+                    next_level.append((folder.drive_folder_id, folder))
+                FolderEntry.objects.bulk_update(new_folders, ['path'], batch_size=batch_size)
+            FileEntry.objects.bulk_create(new_files, batch_size=batch_size, ignore_conflicts=True)
+
+        stats['folders'] += len(new_folders)
+        stats['files'] += len(new_files)
+        logger.info(f"Imported a level for {user.username}: {len(level)} folders listed, "
+                    f"{len(new_folders)} folders and {len(new_files)} files added")
+        level = next_level
+
+    return stats
+
+
+def _load_pks(user, folders, batch_size):
+    """Fill in primary keys on backends where bulk_create does not return them."""
+    by_drive_id = {folder.drive_folder_id: folder for folder in folders}
+    drive_ids = list(by_drive_id)
+    for start in range(0, len(drive_ids), batch_size):
+        for pk, drive_id in FolderEntry.objects.filter(
+                user=user, drive_folder_id__in=drive_ids[start:start + batch_size]).values_list('pk', 'drive_folder_id'):
+            by_drive_id[drive_id].pk = pk
@@ -0,0 +1,316 @@
+import os
+import time
+import uuid
+import shutil
+import socket
+import logging
+import tempfile
+import traceback
+from django.conf import settings
+from django.db import connection
+
+from .gdrive import GoogleDriveService
+from .dedup import find_copy
+from .metrics import record_job
+from .models import FileEntry, FolderEntry, TransferJob, UploadSession, UserProfile
+from .resumable import upload_path_resumable, discard_sessions
+from .sharing import update_user_sharing
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LEASE_SECONDS = 300
+DEFAULT_POLL_INTERVAL = 2
+DEFAULT_RETRY_DELAY = 30
+
+# Minimum seconds between progress writes for one job
+HEARTBEAT_INTERVAL = 1.0
+
+
+class LeaseLost(Exception):
+    """Another worker took over the job, so this one must stop."""
+
+
+def background_transfers_enabled():
+    return getattr(settings, 'GOOGLE_DRIVE_BACKGROUND_TRANSFERS', False)
+
+
+def _lease_seconds():
+    return getattr(settings, 'TRANSFER_LEASE_SECONDS', DEFAULT_LEASE_SECONDS)
+
+
+def _spool_dir():
+    path = getattr(settings, 'TRANSFER_SPOOL_DIR', os.path.join(settings.BASE_DIR, 'spool'))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def spool_upload(uploaded_file):
+    """Keep an uploaded file on disk for a worker and return its path.
+
+    Files Django already wrote to a temporary file are moved rather than copied.
+    """
+    fd, path = tempfile.mkstemp(prefix='upload-', dir=_spool_dir())
+    os.close(fd)
+    if hasattr(uploaded_file, 'temporary_file_path'):
+        shutil.move(uploaded_file.temporary_file_path(), path)
+    else:
+        with open(path, 'wb') as destination:
+            for chunk in uploaded_file.chunks():
+                destination.write(chunk)
+    return path
+
+
+def enqueue_upload(user, uploaded_file, folder=None, description=''):
+    """Spool an uploaded file and queue a job to send it to Drive."""
+    return TransferJob.objects.create(
+        user=user,
+        kind=TransferJob.KIND_UPLOAD,
+        bytes_total=uploaded_file.size,
+        payload={
+            'spool_path': spool_upload(uploaded_file),
+            'file_name': uploaded_file.name,
+            'content_type': uploaded_file.content_type,
+            'size': uploaded_file.size,
+            'folder_id': folder.pk if folder else None,
+            'description': description or '',
+            'md5_checksum': getattr(uploaded_file, 'md5_checksum', ''),
+        }
+    )
+
+
+def enqueue_delete_folder(folder):
+    return TransferJob.objects.create(
+        user=folder.user,
+        kind=TransferJob.KIND_DELETE_FOLDER,
+        payload={'folder_id': folder.pk, 'folder_name': folder.folder_name}
+    )
+
+
+def enqueue_create_user_folder(user_profile):
+    return TransferJob.objects.create(
+        user=user_profile.user,
+        kind=TransferJob.KIND_CREATE_USER_FOLDER,
+        payload={'profile_id': user_profile.pk, 'folder_name': f"gdriveftp_{user_profile.user.username}"}
+    )
+
+
+def enqueue_update_sharing(user, old_email, new_email):
+    return TransferJob.objects.create(
+        user=user,
+        kind=TransferJob.KIND_UPDATE_SHARING,
+        payload={'old_email': old_email or '', 'new_email': new_email or ''}
+    )
+
+
+def _progress_reporter(job, lease_seconds):
+    """Callback that renews the job's lease, and records progress when given bytes.
+
+    Used as an upload's progress_callback and as a heartbeat between steps
+    of other jobs. Raises LeaseLost once another worker owns the job.
+    """
+    last = [0.0]
+
+    def report(bytes_done=None, bytes_total=None):
+        now = time.monotonic()
+        if now - last[0] < HEARTBEAT_INTERVAL:
+            return
+        last[0] = now
+        if not job.heartbeat(lease_seconds, bytes_done, bytes_total):
+            raise LeaseLost(f"Lease on job {job.pk} was lost")
+    return report
+
+
+def run_upload(job, drive_service, lease_seconds):
+    payload = job.payload
+    user_profile = UserProfile.objects.get(user=job.user)
+    folder = FolderEntry.objects.filter(id=payload.get('folder_id'), user=job.user).first() if payload.get('folder_id') else None
+    parent_id = folder.drive_folder_id if folder else user_profile.drive_folder_id
+    if not parent_id:
+        raise RuntimeError(f"{job.user.username} has no Google Drive folder")
+
+    md5_checksum = payload.get('md5_checksum', '')
+    file_id = None
+    copy_from = find_copy(job.user, md5_checksum, payload['size'])
+    if copy_from:
+        # Same content is already in Drive; copy it instead of sending the bytes
+        file_id = drive_service.copy_file(copy_from, payload['file_name'], parent_id)
+    copied = bool(file_id)
+
+    if not copied:
+        # The session is saved, so a retry after a crash picks up at the committed offset
+        resource = upload_path_resumable(
+            drive_service,
+            payload['spool_path'],
+            payload['file_name'],
+            parent_id,
+            mime_type=payload.get('content_type'),
+            progress_callback=_progress_reporter(job, lease_seconds)
+        )
+        if not resource:
+            raise RuntimeError(f"Upload of {payload['file_name']} to Google Drive failed")
+        file_id = resource['id']
+
+    if user_profile.share_email:
+        drive_service.share_file(file_id, user_profile.share_email)
+
+    # The Drive changes sync may already have recorded the new file
+    file_entry, _ = FileEntry.objects.update_or_create(
+        drive_file_id=file_id,
+        defaults={
+            'user': job.user,
+            'file_name': payload['file_name'],
+            'file_size': payload['size'],
+            'file_type': payload.get('content_type') or 'application/octet-stream',
+            'description': payload.get('description', ''),
+            'folder': folder,
+            'md5_checksum': md5_checksum,
+        }
+    )
+    _discard_spool(job)
+    return {'file_entry_id': file_entry.pk, 'drive_file_id': file_id, 'copied_from': copy_from if copied else None}
+
+
+def run_delete_folder(job, drive_service, lease_seconds):
+    folder = FolderEntry.objects.filter(id=job.payload['folder_id'], user=job.user).first()
+    if folder is None:
+        return {'deleted': False}
+    # Renew the lease, and make sure this worker still owns the job, before
+    # deleting anything; Drive removes the folder's contents in one call
+    _progress_reporter(job, lease_seconds)()
+    if not drive_service.delete_folder(folder.drive_folder_id):
+        raise RuntimeError(f"Error deleting folder {folder.folder_name} from Google Drive")
+    folder.delete()
+    return {'deleted': True}
+
+
+def run_create_user_folder(job, drive_service, lease_seconds):
+    user_profile = UserProfile.objects.get(pk=job.payload['profile_id'])
+    if user_profile.drive_folder_id:
+        return {'drive_folder_id': user_profile.drive_folder_id}
+    folder_id = drive_service.create_user_folder(
+        job.payload['folder_name'],
+        share_with_email=user_profile.share_email or None
+    )
+    if not folder_id:
+        raise RuntimeError("Error creating Google Drive folder")
+    user_profile.drive_folder_id = folder_id
+    user_profile.save()
+    return {'drive_folder_id': folder_id}
+
+
+def run_update_sharing(job, drive_service, lease_seconds):
+    unshared, shared = update_user_sharing(
+        job.user,
+        job.payload.get('old_email') or None,
+        job.payload.get('new_email') or None,
+        drive_service=drive_service,
+        heartbeat=_progress_reporter(job, lease_seconds)
+    )
+    return {'unshared': unshared, 'shared': shared}
+
+
+HANDLERS = {
+    TransferJob.KIND_UPLOAD: run_upload,
+    TransferJob.KIND_DELETE_FOLDER: run_delete_folder,
+    TransferJob.KIND_CREATE_USER_FOLDER: run_create_user_folder,
+    TransferJob.KIND_UPDATE_SHARING: run_update_sharing,
+}
+
+
+def _discard_spool(job):
+    path = job.payload.get('spool_path')
+    if path:
+        discard_sessions(path)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def discard_abandoned_spools():
+    """Remove spool files of uploads that failed without cleaning up after themselves.
+
+    TransferJob.claim fails jobs whose worker died on their last attempt, and
+    no handler runs for those. Returns the number of jobs cleaned up.
+    """
+    abandoned = TransferJob.objects.filter(
+        status=TransferJob.FAILED,
+        kind=TransferJob.KIND_UPLOAD,
+        payload__has_key='spool_path'
+    )
+    count = 0
+    for job in abandoned:
+        try:
+            _discard_spool(job)
+        except OSError as e:
+            logger.error(f"Error removing the spool file of {job}: {e}")
+            continue
+        payload = {key: value for key, value in job.payload.items() if key != 'spool_path'}
+        TransferJob.objects.filter(pk=job.pk).update(payload=payload)
+        count += 1
+    return count
+
+
+def run_job(job, drive_service, lease_seconds=None):
+    """Run one claimed job and record the outcome. Returns True on success."""
+    lease_seconds = lease_seconds or _lease_seconds()
+    logger.info(f"Running {job} (attempt {job.attempts}/{job.max_attempts})")
+    try:
+        result = HANDLERS[job.kind](job, drive_service, lease_seconds)
+    except LeaseLost as e:
+        logger.warning(str(e))
+        record_job(job.kind, 'lease_lost')
+        return False
+    except Exception as e:
+        logger.error(f"{job} failed: {e}")
+        logger.error(traceback.format_exc())
+        retry_delay = getattr(settings, 'TRANSFER_RETRY_DELAY', DEFAULT_RETRY_DELAY) * 2 ** (job.attempts - 1)
+        job.fail(e, retry_delay)
+        if job.attempts >= job.max_attempts and job.kind == TransferJob.KIND_UPLOAD:
+            _discard_spool(job)
+        record_job(job.kind, 'failed')
+        return False
+
+    if not job.succeed(result):
+        logger.warning(f"{job} finished after its lease was lost")
+    logger.info(f"{job} succeeded: {result}")
+    record_job(job.kind, 'succeeded')
+    return True
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def run_worker(once=False, poll_interval=None, lease_seconds=None, max_jobs=None, kinds=None, should_stop=None):
+    """Claim and run jobs until stopped. Safe to run in many processes at once.
+
+    With once=True the worker exits as soon as the queue is empty.
+    Returns the number of jobs run.
+    """
+    owner = worker_name()
+    poll_interval = poll_interval or getattr(settings, 'TRANSFER_POLL_INTERVAL', DEFAULT_POLL_INTERVAL)
+    lease_seconds = lease_seconds or _lease_seconds()
+    drive_service = GoogleDriveService()
+    processed = 0
+    logger.info(f"Transfer worker {owner} started")
+    UploadSession.purge_expired()
+    discard_abandoned_spools()
+
+    while not (should_stop and should_stop()):
+        job = TransferJob.claim(owner, lease_seconds, kinds=kinds)
+        if job is None:
+            discard_abandoned_spools()
+            if once:
+                break
+            UploadSession.purge_expired()
+            # Don't hold a connection open while idle
+            connection.close()
+            time.sleep(poll_interval)
+            continue
+
+        run_job(job, drive_service, lease_seconds)
+        processed += 1
+        if max_jobs and processed >= max_jobs:
+            break
+
+    logger.info(f"Transfer worker {owner} stopped after {processed} jobs")
+    return processed
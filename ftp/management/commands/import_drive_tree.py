@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ftp.importer import import_drive_tree, BULK_BATCH_SIZE
+from ftp.models import UserProfile
+
+
+class Command(BaseCommand):
+    help = "Index files and folders already in users' Google Drive folders into the database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('usernames', nargs='*', help='Users to import (default: every approved user).')
+        parser.add_argument('--workers', type=int, help='Concurrent folder listings (default: GOOGLE_DRIVE_IMPORT_CONCURRENCY).')
+        parser.add_argument('--batch-size', type=int, default=BULK_BATCH_SIZE, help='Rows per bulk insert.')
+
+    def handle(self, *args, **options):
+        profiles = UserProfile.objects.select_related('user').exclude(drive_folder_id__isnull=True).exclude(drive_folder_id='')
+        if options['usernames']:
+            profiles = profiles.filter(user__username__in=options['usernames'])
+            missing = set(options['usernames']) - set(profiles.values_list('user__username', flat=True))
+            if missing:
+                raise CommandError(f"No Drive folder for: {', '.join(sorted(missing))}")
+        else:
+            profiles = profiles.filter(is_approved=True)
+
+        for profile in profiles:
+            stats = import_drive_tree(profile, max_workers=options['workers'], batch_size=options['batch_size'])
+            self.stdout.write(
+                f"{profile.user.username}: {stats['folders']} folders, {stats['files']} files imported, "
+                f"{stats['skipped']} already indexed, {stats['failed_folders']} folders failed"
+            )
@@ -0,0 +1,37 @@
+import signal
+from django.core.management.base import BaseCommand
+
+from ftp.jobs import run_worker
+from ftp.models import TransferJob
+
+
+class Command(BaseCommand):
+    help = 'Run queued Google Drive transfer jobs. Start as many workers as needed; each job runs once.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Exit when the queue is empty.')
+        parser.add_argument('--max-jobs', type=int, help='Exit after running this many jobs.')
+        parser.add_argument('--poll-interval', type=float, help='Seconds to wait when the queue is empty.')
+        parser.add_argument('--lease-seconds', type=int, help='How long a claimed job is reserved between progress updates.')
+        parser.add_argument('--kind', action='append', dest='kinds',
+                            choices=[kind for kind, _ in TransferJob.KIND_CHOICES], help='Only run jobs of this kind (repeatable).')
+
+    def handle(self, *args, **options):
+        stopping = []
+
+        def stop(signum, frame):
+            # Finish the current job, then exit
+            stopping.append(signum)
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        processed = run_worker(
+            once=options['once'],
+            poll_interval=options['poll_interval'],
+            lease_seconds=options['lease_seconds'],
+            max_jobs=options['max_jobs'],
+            kinds=options['kinds'],
+            should_stop=lambda: bool(stopping)
+        )
+        self.stdout.write(f"Ran {processed} transfer jobs")
@@ -0,0 +1,25 @@
+import time
+from django.core.management.base import BaseCommand
+
+from ftp.models import UserProfile
+from ftp.sync import sync_users
+
+
+class Command(BaseCommand):
+    help = 'Apply Google Drive changes to the file and folder tables using the Changes API.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', action='append', dest='usernames', help='Only sync this user (repeatable).')
+        parser.add_argument('--loop', action='store_true', help='Keep polling for changes.')
+        parser.add_argument('--interval', type=int, default=60, help='Seconds between polls with --loop.')
+
+    def handle(self, *args, **options):
+        while True:
+            profiles = UserProfile.objects.filter(is_approved=True).exclude(drive_folder_id__isnull=True).exclude(drive_folder_id='')
+            if options['usernames']:
+                profiles = profiles.filter(user__username__in=options['usernames'])
+            applied = sync_users(profiles)
+            self.stdout.write(f"Applied {applied} changes for {profiles.count()} users")
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
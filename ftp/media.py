@@ -0,0 +1,68 @@
+from googleapiclient.http import MediaUpload
+
+# Resumable upload chunks must be a multiple of 256 KiB
+CHUNK_ALIGNMENT = 256 * 1024
+
+
+def align_chunk_size(size):
+    """Round a chunk size up to the nearest multiple of 256 KiB."""
+    return max(CHUNK_ALIGNMENT, -(-size // CHUNK_ALIGNMENT) * CHUNK_ALIGNMENT)
+
+
+class IterableMediaUpload(MediaUpload):
+    """Resumable MediaUpload fed from an iterator of byte chunks.
+
+    The total size does not need to be known up front. Only the bytes not yet
+    acknowledged by Drive, plus one chunk of read-ahead, are kept in memory.
+    """
+
+    def __init__(self, chunks, mimetype='application/octet-stream', chunksize=8 * 1024 * 1024):
+        super().__init__()
+        self._chunks = iter(chunks)
+        self._mimetype = mimetype
+        self._chunksize = align_chunk_size(chunksize)
+        self._buffer = bytearray()
+        self._buffer_start = 0
+        self._high_water = 0
+        self._size = None
+
+    def chunksize(self):
+        return self._chunksize
+
+    def mimetype(self):
+        return self._mimetype
+
+    def resumable(self):
+        return True
+
+    def _fill(self, end):
+        """Read from the iterator until the buffer reaches offset end or EOF."""
+        while self._size is None and self._buffer_start + len(self._buffer) < end:
+            try:
+                chunk = next(self._chunks)
+            except StopIteration:
+                self._size = self._buffer_start + len(self._buffer)
+                break
+            self._buffer.extend(chunk)
+
+    def size(self):
+        # Read one byte past the next chunk so that the request carrying the
+        # final bytes can already announce the total size.
+        self._fill(self._high_water + self._chunksize + 1)
+        return self._size
+
+    def getbytes(self, begin, length):
+        if begin < self._buffer_start:
+            raise ValueError(f"Bytes before offset {self._buffer_start} are no longer buffered")
+        # Everything before begin has been acknowledged by Drive
+        del self._buffer[:begin - self._buffer_start]
+        self._buffer_start = begin
+        self._fill(begin + length)
+        self._high_water = max(self._high_water, begin + length)
+        return bytes(self._buffer[:length])
+
+    def has_stream(self):
+        return False
+
+    def to_json(self):
+        raise NotImplementedError('IterableMediaUpload cannot be serialized.')
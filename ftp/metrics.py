@@ -0,0 +1,233 @@
+import os
+import json
+import glob
+import time
+import logging
+import tempfile
+import threading
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Bytes per second, 64 KiB/s to 256 MiB/s
+THROUGHPUT_BUCKETS = tuple(64 * 1024 * 4 ** i for i in range(7))
+
+COUNTER = 'counter'
+HISTOGRAM = 'histogram'
+GAUGE = 'gauge'
+
+# name: (type, help, histogram buckets)
+METRICS = {
+    'gdriveftp_drive_call_seconds': (HISTOGRAM, 'Drive API call latency, retries included', LATENCY_BUCKETS),
+    'gdriveftp_drive_calls_total': (COUNTER, 'Drive API calls by outcome', None),
+    'gdriveftp_drive_retries_total': (COUNTER, 'Drive API call retries', None),
+    'gdriveftp_drive_rate_limited_total': (COUNTER, 'Drive API attempts refused for quota reasons', None),
+    'gdriveftp_drive_throttle_seconds_total': (COUNTER, 'Time Drive calls waited for the local rate limiter', None),
+    'gdriveftp_drive_token_refreshes_total': (COUNTER, 'Access token refreshes, minted here or taken from the shared cache', None),
+    'gdriveftp_drive_transfer_bytes_total': (COUNTER, 'Bytes moved to or from Drive', None),
+    'gdriveftp_drive_transfer_seconds_total': (COUNTER, 'Time spent moving bytes to or from Drive', None),
+    'gdriveftp_drive_throughput_bytes_per_second': (HISTOGRAM, 'Throughput of individual Drive transfers', THROUGHPUT_BUCKETS),
+    'gdriveftp_http_request_seconds': (HISTOGRAM, 'Time to produce a response, by view', LATENCY_BUCKETS),
+    'gdriveftp_http_requests_total': (COUNTER, 'Responses by view and status class', None),
+    'gdriveftp_transfer_jobs_total': (COUNTER, 'Finished background transfer jobs by outcome', None),
+}
+
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+
+def _metrics_dir():
+    return getattr(settings, 'GOOGLE_DRIVE_METRICS_DIR', None)
+
+
+class MetricsRegistry:
+    """Thread-safe counters and histograms for this process.
+
+    With GOOGLE_DRIVE_METRICS_DIR set, each process (gunicorn worker, transfer
+    worker) writes a snapshot of its values there at most once per
+    GOOGLE_DRIVE_METRICS_FLUSH_INTERVAL, and collect() sums the snapshots of
+    every process. Snapshots of exited processes are kept so counters never
+    go backwards; empty the directory when deploying.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pid = None
+        self._values = {}
+        self._last_flush = 0.0
+
+    def _reset_if_forked(self):
+        # A pre-forking server copies the registry into each worker; the
+        # parent's values must not be reported again by every child.
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._values = {}
+            self._last_flush = 0.0
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._reset_if_forked()
+            self._values[key] = self._values.get(key, 0) + amount
+        self.flush()
+
+    def observe(self, name, value, **labels):
+        buckets = METRICS[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._reset_if_forked()
+            counts = self._values.get(key)
+            if counts is None:
+                # One count per bucket plus +Inf, then the sum
+                counts = self._values[key] = [0] * (len(buckets) + 1) + [0.0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[len(buckets)] += 1
+            counts[-1] += value
+        self.flush()
+
+    def snapshot(self):
+        """This process's values as [[name, labels, value], ...]."""
+        with self._lock:
+            self._reset_if_forked()
+            return [
+                [name, dict(labels), list(value) if isinstance(value, list) else value]
+                for (name, labels), value in self._values.items()
+            ]
+
+    def flush(self, force=False):
+        """Write this process's snapshot to GOOGLE_DRIVE_METRICS_DIR, if set."""
+        directory = _metrics_dir()
+        if not directory:
+            return
+        interval = getattr(settings, 'GOOGLE_DRIVE_METRICS_FLUSH_INTERVAL', DEFAULT_FLUSH_INTERVAL)
+        if not force and time.monotonic() - self._last_flush < interval:
+            return
+        if not self._flush_lock.acquire(blocking=force):
+            return
+        try:
+            self._last_flush = time.monotonic()
+            os.makedirs(directory, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(temp_path, os.path.join(directory, f'{os.getpid()}.json'))
+        except Exception as e:
+            logger.warning(f"Could not write metrics snapshot to {directory}: {e}")
+        finally:
+            self._flush_lock.release()
+
+    def collect(self):
+        """Values summed over every process sharing GOOGLE_DRIVE_METRICS_DIR: {(name, labels): value}."""
+        directory = _metrics_dir()
+        if not directory:
+            snapshots = [self.snapshot()]
+        else:
+            self.flush(force=True)
+            snapshots = []
+            for path in glob.glob(os.path.join(directory, '*.json')):
+                try:
+                    with open(path) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError) as e:
+                    logger.warning(f"Skipping unreadable metrics snapshot {path}: {e}")
+
+        totals = {}
+        for snapshot in snapshots:
+            for name, labels, value in snapshot:
+                if name not in METRICS:
+                    continue
+                key = (name, tuple(sorted(labels.items())))
+                if isinstance(value, list):
+                    total = totals.setdefault(key, [0] * len(value))
+                    for i, v in enumerate(value):
+                        total[i] += v
+                else:
+                    totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def render(self, gauges=()):
+        """Prometheus text exposition of the collected values.
+
+        gauges: extra (name, help, {labels tuple: value}) computed at scrape time.
+        """
+        by_name = {}
+        for (name, labels), value in self.collect().items():
+            by_name.setdefault(name, []).append((labels, value))
+
+        lines = []
+        for name, (kind, help_text, buckets) in METRICS.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in sorted(by_name.get(name, [])):
+                if kind == HISTOGRAM:
+                    cumulative = 0
+                    for bound, count in zip(buckets + ('+Inf',), value):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{_labels(labels + (("le", _number(bound)),))} {cumulative}')
+                    lines.append(f'{name}_sum{_labels(labels)} {_number(value[-1])}')
+                    lines.append(f'{name}_count{_labels(labels)} {cumulative}')
+                else:
+                    lines.append(f'{name}{_labels(labels)} {_number(value)}')
+        for name, help_text, values in gauges:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {GAUGE}')
+            for labels, value in sorted(values.items()):
+                lines.append(f'{name}{_labels(labels)} {_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def _number(value):
+    if isinstance(value, str):
+        return value
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels) + '}'
+
+
+registry = MetricsRegistry()
+
+
+def record_drive_call(call):
+    """Record a finished tracing.DriveCall."""
+    method = call.label.removeprefix('Drive ')
+    registry.observe('gdriveftp_drive_call_seconds', call.seconds, method=method)
+    registry.inc('gdriveftp_drive_calls_total', method=method, outcome='error' if call.error is not None else 'ok')
+    if call.retries:
+        registry.inc('gdriveftp_drive_retries_total', call.retries, method=method)
+    if call.rate_limited:
+        registry.inc('gdriveftp_drive_rate_limited_total', call.rate_limited, method=method)
+    if call.throttled:
+        registry.inc('gdriveftp_drive_throttle_seconds_total', call.throttled, method=method)
+
+
+def record_transfer(direction, nbytes, seconds):
+    registry.inc('gdriveftp_drive_transfer_bytes_total', nbytes, direction=direction)
+    registry.inc('gdriveftp_drive_transfer_seconds_total', seconds, direction=direction)
+    if nbytes and seconds > 0:
+        registry.observe('gdriveftp_drive_throughput_bytes_per_second', nbytes / seconds, direction=direction)
+
+
+def record_request(view, status, seconds):
+    registry.observe('gdriveftp_http_request_seconds', seconds, view=view)
+    registry.inc('gdriveftp_http_requests_total', view=view, status=f'{status // 100}xx')
+
+
+def record_token_refresh(source):
+    registry.inc('gdriveftp_drive_token_refreshes_total', source=source)
+
+
+def record_job(kind, outcome):
+    registry.inc('gdriveftp_transfer_jobs_total', kind=kind, outcome=outcome)
@@ -0,0 +1,57 @@
+import time
+import logging
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+from .tracing import start_trace
+from .metrics import record_request
+
+logger = logging.getLogger(__name__)
+
+
+class DriveTraceMiddleware:
+    """Trace the Drive calls each request makes.
+
+    Adds a Server-Timing header (total Drive time, then time per call type)
+    and logs one summary line per request that called Drive. Also records
+    each view's response time in the metrics. Works under WSGI and ASGI.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        started = time.monotonic()
+        with start_trace() as trace:
+            response = self.get_response(request)
+        return self._report(request, response, trace, started)
+
+    async def __acall__(self, request):
+        started = time.monotonic()
+        with start_trace() as trace:
+            response = await self.get_response(request)
+        return self._report(request, response, trace, started)
+
+    def _report(self, request, response, trace, started):
+        match = request.resolver_match
+        record_request(match.url_name if match and match.url_name else 'unmatched', response.status_code, time.monotonic() - started)
+        if not trace.calls:
+            return response
+        if getattr(settings, 'GOOGLE_DRIVE_SERVER_TIMING', True):
+            response['Server-Timing'] = trace.server_timing()
+        breakdown = ', '.join(
+            f"{label} x{count} {seconds * 1000:.0f}ms" + (f" ({retries} retries)" if retries else '')
+            for label, count, seconds, nbytes, retries in trace.summary()
+        )
+        logger.info(
+            f"{request.method} {request.path}: {len(trace)} Drive calls, {trace.seconds * 1000:.0f}ms, "
+            f"{trace.nbytes} bytes, {trace.retries} retries [{breakdown}]"
+        )
+        return response
@@ -0,0 +1,46 @@
+# Generated by Django 5.2 on 2026-10-17 09:12
+
+from django.db import migrations, models
+
+
+def build_paths(apps, schema_editor):
+    FolderEntry = apps.get_model('ftp', 'FolderEntry')
+    by_id = {folder.pk: folder for folder in FolderEntry.objects.all()}
+    paths = {}
+
+    for folder in by_id.values():
+        chain = []
+        current = folder
+        while current is not None and current.pk not in paths:
+            chain.append(current)
+            current = by_id.get(current.parent_folder_id)
+        prefix = paths[current.pk] if current is not None else '/'
+        for item in reversed(chain):
+            prefix = f"{prefix}{item.pk}/"
+            paths[item.pk] = prefix
+
+    for folder in by_id.values():
+        folder.path = paths[folder.pk]
+        folder.depth = folder.path.count('/') - 2
+    FolderEntry.objects.bulk_update(by_id.values(), ['path', 'depth'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ftp', '0003_userprofile_share_email'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='folderentry',
+            name='depth',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='folderentry',
+            name='path',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=1024),
+        ),
+        migrations.RunPython(build_paths, migrations.RunPython.noop),
+    ]
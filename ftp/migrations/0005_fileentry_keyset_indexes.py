@@ -0,0 +1,31 @@
+# Generated by Django 5.2 on 2026-10-17 01:43
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ftp', '0004_folderentry_path'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='fileentry',
+            index=models.Index(fields=['user', 'folder', 'upload_date', 'id'], name='ftp_file_user_folder_date'),
+        ),
+        migrations.AddIndex(
+            model_name='fileentry',
+            index=models.Index(fields=['user', 'folder', 'file_name', 'id'], name='ftp_file_user_folder_name'),
+        ),
+        migrations.AddIndex(
+            model_name='fileentry',
+            index=models.Index(fields=['user', 'folder', 'file_size', 'id'], name='ftp_file_user_folder_size'),
+        ),
+        migrations.AddIndex(
+            model_name='folderentry',
+            index=models.Index(fields=['user', 'parent_folder', 'folder_name'], name='ftp_folder_user_parent_name'),
+        ),
+    ]
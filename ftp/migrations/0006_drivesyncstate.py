@@ -0,0 +1,36 @@
+# Generated by Django 5.2 on 2026-10-17 01:44
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ftp', '0005_fileentry_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='fileentry',
+            name='drive_file_id',
+            field=models.CharField(db_index=True, max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='folderentry',
+            name='drive_folder_id',
+            field=models.CharField(db_index=True, max_length=255),
+        ),
+        migrations.CreateModel(
+            name='DriveSyncState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('root_folder_id', models.CharField(max_length=255)),
+                ('page_token', models.CharField(max_length=255)),
+                ('last_synced_at', models.DateTimeField(blank=True, null=True)),
+                ('changes_applied', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('profile', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='sync_state', to='ftp.userprofile')),
+            ],
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2 on 2026-10-17 01:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ftp', '0007_transferjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('session_uri', models.TextField()),
+                ('source_path', models.CharField(db_index=True, max_length=1024)),
+                ('file_name', models.CharField(max_length=255)),
+                ('parent_folder_id', models.CharField(max_length=255)),
+                ('mime_type', models.CharField(max_length=255)),
+                ('total_size', models.BigIntegerField()),
+                ('bytes_confirmed', models.BigIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('expires_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2 on 2026-10-17 01:57
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ftp', '0008_uploadsession'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fileentry',
+            name='md5_checksum',
+            field=models.CharField(blank=True, default='', editable=False, max_length=32),
+        ),
+        migrations.AddIndex(
+            model_name='fileentry',
+            index=models.Index(fields=['md5_checksum', 'file_size'], name='ftp_file_md5_size'),
+        ),
+    ]
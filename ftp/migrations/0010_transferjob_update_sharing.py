@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-17 02:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ftp', '0009_fileentry_md5_checksum'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='transferjob',
+            name='kind',
+            field=models.CharField(choices=[('upload', 'Upload file'), ('delete_folder', 'Delete folder'), ('create_user_folder', 'Create user folder'), ('update_sharing', 'Update sharing')], max_length=32),
+        ),
+    ]
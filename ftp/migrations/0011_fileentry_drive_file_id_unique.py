@@ -0,0 +1,51 @@
+import logging
+
+from django.db import migrations, models
+from django.db.models import Count
+
+logger = logging.getLogger(__name__)
+
+# Fields copied onto the kept row when it has none of its own
+MERGED_FIELDS = ['description', 'md5_checksum', 'folder_id']
+
+
+def merge_duplicate_file_entries(apps, schema_editor):
+    # Keep the first row recorded for each Drive file; later ones were
+    # inserted by the changes sync racing an upload. Metadata the kept row
+    # lacks is taken from the others before they are removed.
+    FileEntry = apps.get_model('ftp', 'FileEntry')
+    duplicates = (FileEntry.objects.values_list('drive_file_id', flat=True)
+                  .annotate(count=Count('id'))
+                  .filter(count__gt=1))
+    for drive_file_id in duplicates:
+        kept, *others = FileEntry.objects.filter(drive_file_id=drive_file_id).order_by('upload_date', 'id')
+        changed = []
+        for field in MERGED_FIELDS:
+            if not getattr(kept, field):
+                value = next((getattr(other, field) for other in others if getattr(other, field)), None)
+                if value:
+                    setattr(kept, field, value)
+                    changed.append(field)
+        if changed:
+            kept.save(update_fields=changed)
+        logger.warning(
+            f"Merged {len(others)} duplicate FileEntry rows for Drive file {drive_file_id} into row {kept.pk}: "
+            f"removed rows {[other.pk for other in others]}, copied {changed or 'no fields'}"
+        )
+        FileEntry.objects.filter(pk__in=[other.pk for other in others]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ftp', '0010_transferjob_update_sharing'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_file_entries, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='fileentry',
+            name='drive_file_id',
+            field=models.CharField(max_length=255, unique=True),
+        ),
+    ]
@@ -1,4 +1,7 @@
 from django.db import models
+from datetime import timedelta
+from django.db.models import F, Q, Value
+from django.db.models.functions import Concat, Substr
 from django.contrib.auth.models import User
 from django.utils import timezone
 
@@ -16,32 +19,148 @@ class UserProfile(models.Model):
 class FolderEntry(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='folders')
     folder_name = models.CharField(max_length=255)
-    drive_folder_id = models.CharField(max_length=255)
+    drive_folder_id = models.CharField(max_length=255, db_index=True)
     parent_folder = models.ForeignKey('self', on_delete=models.CASCADE, null=True, blank=True, related_name='subfolders')
+    # Materialized path of folder IDs from the root down to this folder, e.g. "/3/17/42/"
+    path = models.CharField(max_length=1024, blank=True, default='', db_index=True, editable=False)
+    depth = models.PositiveIntegerField(default=0, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     
     def __str__(self):
         return f"{self.folder_name} - {self.user.username}"
     
+    def _ensure_paths(self, *folders):
+        """Fill in paths of folders written without save(), e.g. by bulk_create."""
+        folders = [folder for folder in folders if folder is not None and folder.pk]
+        if all(folder.path for folder in folders):
+            return
+        FolderEntry.rebuild_paths(self.user_id)
+        for folder in folders:
+            folder.refresh_from_db(fields=['path', 'depth'])
+    
+    def _expected_path(self):
+        if not self.parent_folder_id:
+            return f"/{self.pk}/"
+        self._ensure_paths(self.parent_folder)
+        return f"{self.parent_folder.path}{self.pk}/"
+    
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        
+        # Keep the materialized path in step with parent_folder; a move
+        # rewrites the whole subtree in a single UPDATE
+        new_path = self._expected_path()
+        if self.path == new_path:
+            return
+        new_depth = new_path.count('/') - 2
+        if self.path:
+            FolderEntry.objects.filter(path__startswith=self.path).update(
+                path=Concat(Value(new_path), Substr('path', len(self.path) + 1)),
+                depth=F('depth') + (new_depth - self.depth)
+            )
+        else:
+            FolderEntry.objects.filter(pk=self.pk).update(path=new_path, depth=new_depth)
+        self.path = new_path
+        self.depth = new_depth
+    
+    def delete(self, *args, **kwargs):
+        """Delete the folder with its whole subtree and their files."""
+        if not self.path:
+            return super().delete(*args, **kwargs)
+        FileEntry.objects.filter(folder__path__startswith=self.path).delete()
+        return FolderEntry.objects.filter(path__startswith=self.path).delete()
+    
+    def move_to(self, new_parent):
+        """Move the folder (and its subtree) under new_parent, or to the root if None."""
+        self._ensure_paths(self, new_parent)
+        if new_parent is not None and new_parent.path.startswith(self.path):
+            raise ValueError("A folder cannot be moved into its own subtree.")
+        self.parent_folder = new_parent
+        self.save()
+    
+    def ancestor_ids(self):
+        """IDs of the folders above this one, root first."""
+        return [int(part) for part in self.path.strip('/').split('/')[:-1] if part]
+    
+    def get_ancestors(self):
+        """Folders above this one, root first, in one query."""
+        return FolderEntry.objects.filter(id__in=self.ancestor_ids()).order_by('depth')
+    
+    def get_breadcrumbs(self):
+        """Ancestors followed by this folder."""
+        return list(self.get_ancestors()) + [self]
+    
+    def get_descendants(self):
+        """Every folder below this one, in one query."""
+        return FolderEntry.objects.filter(path__startswith=self.path).exclude(pk=self.pk)
+    
     def get_path(self):
         """Get the full path of the folder."""
-        if self.parent_folder is None:
-            return self.folder_name
-        return f"{self.parent_folder.get_path()}/{self.folder_name}"
+        names = [folder.folder_name for folder in self.get_ancestors()]
+        names.append(self.folder_name)
+        return '/'.join(names)
+    
+    @classmethod
+    def display_paths(cls, user):
+        """(id, 'a/b/c') pairs for all of a user's folders, in one query."""
+        folders = list(cls.objects.filter(user=user).values_list('id', 'folder_name', 'path'))
+        names = {folder_id: name for folder_id, name, _ in folders}
+        return [
+            (folder_id, '/'.join(names.get(int(part), '?') for part in path.strip('/').split('/')) if path else name)
+            for folder_id, name, path in folders
+        ]
+    
+    @classmethod
+    def rebuild_paths(cls, user=None):
+        """Recompute path and depth for folders saved without save(), e.g. by bulk_create."""
+        folders = cls.objects.all() if user is None else cls.objects.filter(user=user)
+        by_id = {folder.pk: folder for folder in folders}
+        paths = {}
+        
+        for folder in by_id.values():
+            # Walk up to the nearest folder whose path is already known
+            chain = []
+            current = folder
+            while current is not None and current.pk not in paths:
+                chain.append(current)
+                current = by_id.get(current.parent_folder_id)
+            prefix = paths[current.pk] if current is not None else '/'
+            for item in reversed(chain):
+                prefix = f"{prefix}{item.pk}/"
+                paths[item.pk] = prefix
+        
+        changed = []
+        for folder in by_id.values():
+            if folder.path != paths[folder.pk]:
+                folder.path = paths[folder.pk]
+                folder.depth = folder.path.count('/') - 2
+                changed.append(folder)
+        cls.objects.bulk_update(changed, ['path', 'depth'], batch_size=1000)
+        return len(changed)
     
     class Meta:
         ordering = ['folder_name']
         verbose_name_plural = 'Folder entries'
+        indexes = [
+            models.Index(fields=['user', 'parent_folder', 'folder_name'], name='ftp_folder_user_parent_name'),
+        ]
 
 class FileEntry(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='files')
     file_name = models.CharField(max_length=255)
     file_size = models.BigIntegerField()
     file_type = models.CharField(max_length=100)
-    drive_file_id = models.CharField(max_length=255)
+    # Unique, so an upload and the Drive changes sync cannot both insert the same file
+    drive_file_id = models.CharField(max_length=255, unique=True)
     upload_date = models.DateTimeField(default=timezone.now)
     description = models.TextField(blank=True, null=True)
     folder = models.ForeignKey(FolderEntry, on_delete=models.CASCADE, null=True, blank=True, related_name='files')
+    # Hex MD5 of the content, hashed on upload or taken from Drive's md5Checksum;
+    # empty for Google Docs and files recorded before it was tracked
+    md5_checksum = models.CharField(max_length=32, blank=True, default='', editable=False)
+    
+    # Fields an upload writes over a row the Drive changes sync inserted first
+    UPLOAD_FIELDS = ['user', 'file_name', 'file_size', 'file_type', 'description', 'folder', 'md5_checksum']
     
     def __str__(self):
         return f"{self.file_name} - {self.user.username}"
@@ -53,4 +172,184 @@ class FileEntry(models.Model):
         return f"{self.folder.get_path()}/{self.file_name}"
     
     class Meta:
-        ordering = ['-upload_date']
\ No newline at end of file
+        ordering = ['-upload_date']
+        # Support keyset pagination of a folder listing by each sort key
+        indexes = [
+            models.Index(fields=['user', 'folder', 'upload_date', 'id'], name='ftp_file_user_folder_date'),
+            models.Index(fields=['user', 'folder', 'file_name', 'id'], name='ftp_file_user_folder_name'),
+            models.Index(fields=['user', 'folder', 'file_size', 'id'], name='ftp_file_user_folder_size'),
+            # Finding an existing copy of uploaded content
+            models.Index(fields=['md5_checksum', 'file_size'], name='ftp_file_md5_size'),
+        ]
+
+class DriveSyncState(models.Model):
+    """Position in the Drive Changes feed for one user's root folder."""
+    profile = models.OneToOneField(UserProfile, on_delete=models.CASCADE, related_name='sync_state')
+    root_folder_id = models.CharField(max_length=255)
+    page_token = models.CharField(max_length=255)
+    last_synced_at = models.DateTimeField(null=True, blank=True)
+    changes_applied = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f"Sync state for {self.profile.user.username}"
+
+class TransferJob(models.Model):
+    """A Drive operation queued by a view and run by the run_transfer_worker command.
+    
+    Workers claim jobs with a conditional UPDATE and hold them under a lease
+    that is renewed as the job reports progress. A job whose worker dies is
+    picked up again once its lease expires.
+    """
+    KIND_UPLOAD = 'upload'
+    KIND_DELETE_FOLDER = 'delete_folder'
+    KIND_CREATE_USER_FOLDER = 'create_user_folder'
+    KIND_UPDATE_SHARING = 'update_sharing'
+    KIND_CHOICES = [
+        (KIND_UPLOAD, 'Upload file'),
+        (KIND_DELETE_FOLDER, 'Delete folder'),
+        (KIND_CREATE_USER_FOLDER, 'Create user folder'),
+        (KIND_UPDATE_SHARING, 'Update sharing'),
+    ]
+    
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+    ]
+    
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='transfer_jobs')
+    kind = models.CharField(max_length=32, choices=KIND_CHOICES)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=QUEUED)
+    payload = models.JSONField(default=dict)
+    result = models.JSONField(null=True, blank=True)
+    progress = models.FloatField(default=0)
+    bytes_done = models.BigIntegerField(default=0)
+    bytes_total = models.BigIntegerField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    error = models.TextField(blank=True, default='')
+    lease_owner = models.CharField(max_length=255, blank=True, default='')
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    available_at = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    
+    def __str__(self):
+        return f"{self.get_kind_display()} #{self.pk} ({self.status})"
+    
+    @classmethod
+    def claim(cls, owner, lease_seconds, kinds=None):
+        """Claim the next runnable job for owner and return it, or None.
+        
+        Runnable means queued and due, or running under an expired lease.
+        Each candidate is taken with an UPDATE that only matches while the
+        job is still runnable, so concurrent workers never share a job.
+        """
+        now = timezone.now()
+        expired = Q(status=cls.RUNNING, lease_expires_at__lt=now)
+        
+        # Jobs whose worker died on their last allowed attempt
+        cls.objects.filter(expired, attempts__gte=F('max_attempts')).update(
+            status=cls.FAILED, error='Worker lease expired', lease_owner='', lease_expires_at=None, finished_at=now
+        )
+        
+        runnable = Q(status=cls.QUEUED, available_at__lte=now) | expired
+        candidates = cls.objects.filter(runnable)
+        if kinds:
+            candidates = candidates.filter(kind__in=kinds)
+        for job_id in candidates.order_by('available_at', 'pk').values_list('pk', flat=True)[:10]:
+            # The WHERE clause re-checks runnable, so only one worker's UPDATE matches
+            claimed = cls.objects.filter(runnable, pk=job_id).update(
+                status=cls.RUNNING,
+                lease_owner=owner,
+                lease_expires_at=now + timedelta(seconds=lease_seconds),
+                attempts=F('attempts') + 1,
+                updated_at=now
+            )
+            if claimed:
+                return cls.objects.get(pk=job_id)
+        return None
+    
+    def _owned(self):
+        return TransferJob.objects.filter(pk=self.pk, status=self.RUNNING, lease_owner=self.lease_owner)
+    
+    def heartbeat(self, lease_seconds, bytes_done=None, bytes_total=None):
+        """Renew the lease and record progress. Returns False if the lease was lost."""
+        now = timezone.now()
+        fields = {'lease_expires_at': now + timedelta(seconds=lease_seconds), 'updated_at': now}
+        if bytes_total:
+            self.bytes_total = fields['bytes_total'] = bytes_total
+        if bytes_done is not None:
+            self.bytes_done = fields['bytes_done'] = bytes_done
+            if self.bytes_total:
+                self.progress = fields['progress'] = min(bytes_done / self.bytes_total, 1.0)
+        return self._owned().update(**fields) == 1
+    
+    def succeed(self, result=None):
+        now = timezone.now()
+        return self._owned().update(
+            status=self.SUCCEEDED, result=result, progress=1.0, error='',
+            lease_owner='', lease_expires_at=None, finished_at=now, updated_at=now
+        ) == 1
+    
+    def fail(self, error, retry_delay=None):
+        """Record a failed attempt; requeue after retry_delay seconds if attempts remain."""
+        now = timezone.now()
+        if retry_delay is not None and self.attempts < self.max_attempts:
+            fields = {'status': self.QUEUED, 'available_at': now + timedelta(seconds=retry_delay)}
+        else:
+            fields = {'status': self.FAILED, 'finished_at': now}
+        return self._owned().update(
+            error=str(error), lease_owner='', lease_expires_at=None, updated_at=now, **fields
+        ) == 1
+    
+    def as_status(self):
+        """Progress fields reported by the job status endpoint."""
+        return {
+            'id': self.pk,
+            'kind': self.kind,
+            'status': self.status,
+            'progress': round(self.progress, 4),
+            'bytes_done': self.bytes_done,
+            'bytes_total': self.bytes_total,
+            'attempts': self.attempts,
+            'error': self.error,
+            'result': self.result,
+            'file_name': self.payload.get('file_name') or self.payload.get('folder_name'),
+        }
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'available_at'], name='ftp_job_status_available'),
+            models.Index(fields=['user', 'status'], name='ftp_job_user_status'),
+        ]
+
+class UploadSession(models.Model):
+    """A Drive resumable upload in progress, kept so a restarted worker can continue it.
+    
+    Drive keeps a session for about a week; rows past expires_at are discarded.
+    """
+    session_uri = models.TextField()
+    source_path = models.CharField(max_length=1024, db_index=True)
+    file_name = models.CharField(max_length=255)
+    parent_folder_id = models.CharField(max_length=255)
+    mime_type = models.CharField(max_length=255)
+    total_size = models.BigIntegerField()
+    bytes_confirmed = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    expires_at = models.DateTimeField(db_index=True)
+    
+    def __str__(self):
+        return f"Upload of {self.file_name} ({self.bytes_confirmed}/{self.total_size} bytes)"
+    
+    @classmethod
+    def purge_expired(cls):
+        return cls.objects.filter(expires_at__lt=timezone.now()).delete()[0]
\ No newline at end of file
@@ -0,0 +1,90 @@
+import json
+import base64
+from django.db.models import Q
+
+# Dashboard sort keys and the FileEntry columns they map to
+FILE_SORT_FIELDS = {
+    'date': 'upload_date',
+    'name': 'file_name',
+    'size': 'file_size',
+}
+
+DEFAULT_PAGE_SIZE = 50
+
+
+def encode_cursor(value, pk):
+    raw = json.dumps([value, pk], default=str).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, field):
+    """Return (value, pk) from a cursor, or None if it is malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        value, pk = json.loads(raw)
+        return field.to_python(value), int(pk)
+    except Exception:
+        return None
+
+
+class KeysetPage:
+    """One page of a keyset-paginated queryset."""
+
+    def __init__(self, items, next_cursor, previous_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+
+def keyset_paginate(queryset, field_name, descending=False, after=None, before=None, page_size=DEFAULT_PAGE_SIZE):
+    """Return a KeysetPage ordered by (field_name, pk).
+
+    Pages are located by seeking past the last row of the previous page
+    rather than by OFFSET, so each page costs one index range scan whatever
+    its position. after and before are cursors from a previous page.
+    """
+    field = queryset.model._meta.get_field(field_name)
+    backwards = before is not None and after is None
+    cursor = decode_cursor(before if backwards else after, field) if (after or before) else None
+
+    # Walking backwards flips the comparison and the ordering
+    seek_descending = descending != backwards
+    if cursor is not None:
+        value, pk = cursor
+        op = 'lt' if seek_descending else 'gt'
+        queryset = queryset.filter(
+            Q(**{f'{field_name}__{op}': value}) | Q(**{field_name: value, f'pk__{op}': pk})
+        )
+    prefix = '-' if seek_descending else ''
+    rows = list(queryset.order_by(f'{prefix}{field_name}', f'{prefix}pk')[:page_size + 1])
+
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if backwards:
+        rows.reverse()
+
+    def cursor_for(row):
+        value = getattr(row, field_name)
+        return encode_cursor(value.isoformat() if hasattr(value, 'isoformat') else value, row.pk)
+
+    next_cursor = previous_cursor = None
+    if rows:
+        if has_more or backwards:
+            next_cursor = cursor_for(rows[-1])
+        if (has_more and backwards) or (cursor is not None and not backwards):
+            previous_cursor = cursor_for(rows[0])
+    return KeysetPage(rows, next_cursor, previous_cursor)
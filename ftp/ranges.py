@@ -0,0 +1,116 @@
+import re
+from django.utils.http import http_date, parse_http_date_safe
+
+# Requests asking for more ranges than this are answered with the full body
+MAX_RANGES = 20
+
+RANGE_SPEC_RE = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+
+class RangeNotSatisfiable(Exception):
+    """Raised when none of the requested ranges overlap the file."""
+
+
+def parse_range_header(header, size):
+    """Parse a 'bytes=' Range header into a sorted list of (start, end) pairs.
+
+    End offsets are inclusive. Overlapping and adjacent ranges are merged.
+    Returns None when the header is missing, malformed or should be ignored,
+    in which case the full body is sent. Raises RangeNotSatisfiable when the
+    header is valid but no range overlaps the file.
+    """
+    if not header:
+        return None
+
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not specs:
+        return None
+
+    specs = specs.split(',')
+    if len(specs) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for spec in specs:
+        match = RANGE_SPEC_RE.match(spec)
+        if not match:
+            return None
+        first, last = match.groups()
+
+        if first == '' and last == '':
+            return None
+        if first == '':
+            # Suffix range: the last N bytes
+            length = int(last)
+            if length == 0:
+                continue
+            start, end = max(size - length, 0), size - 1
+        else:
+            start = int(first)
+            end = size - 1 if last == '' else min(int(last), size - 1)
+            if last != '' and int(last) < start:
+                return None
+
+        if start < size and start <= end:
+            ranges.append((start, end))
+
+    if not ranges:
+        raise RangeNotSatisfiable()
+
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        last_start, last_end = merged[-1]
+        if start <= last_end + 1:
+            merged[-1] = (last_start, max(last_end, end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def if_range_matches(header, etag, last_modified):
+    """Return True if an If-Range validator still matches the current file.
+
+    last_modified is a datetime. An absent header always matches.
+    """
+    if not header:
+        return True
+    header = header.strip()
+    if header.startswith('"') or header.startswith('W/'):
+        # Only strong ETags may be used with If-Range
+        return header == etag
+    since = parse_http_date_safe(header)
+    return since is not None and since == int(last_modified.timestamp())
+
+
+def content_range(start, end, size):
+    """Format a Content-Range header value."""
+    return f'bytes {start}-{end}/{size}'
+
+
+def multipart_part_header(boundary, content_type, start, end, size):
+    """Return the bytes that precede one part of a multipart/byteranges body."""
+    return (
+        f'\r\n--{boundary}\r\n'
+        f'Content-Type: {content_type}\r\n'
+        f'Content-Range: {content_range(start, end, size)}\r\n\r\n'
+    ).encode('ascii')
+
+
+def multipart_trailer(boundary):
+    """Return the closing delimiter of a multipart/byteranges body."""
+    return f'\r\n--{boundary}--\r\n'.encode('ascii')
+
+
+def multipart_length(boundary, content_type, ranges, size):
+    """Total Content-Length of a multipart/byteranges body for the given ranges."""
+    length = len(multipart_trailer(boundary))
+    for start, end in ranges:
+        length += len(multipart_part_header(boundary, content_type, start, end, size))
+        length += end - start + 1
+    return length
+
+
+def last_modified_header(value):
+    """Format a datetime as an HTTP date."""
+    return http_date(value.timestamp())
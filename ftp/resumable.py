@@ -0,0 +1,111 @@
+import os
+import time
+import logging
+import mimetypes
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+
+from .tuning import tuner, UPLOAD
+from .retry import backoff_delay, is_retryable, DEFAULT_MAX_RETRIES
+from .models import UploadSession
+
+logger = logging.getLogger(__name__)
+
+# Drive discards resumable sessions after about a week
+DEFAULT_SESSION_TTL = 6 * 24 * 60 * 60
+
+
+def _session_ttl():
+    return getattr(settings, 'GOOGLE_DRIVE_UPLOAD_SESSION_TTL', DEFAULT_SESSION_TTL)
+
+
+def _open_session(drive_service, source_path, file_name, parent_folder_id, mime_type, total_size):
+    """Return (session, offset, file_resource), resuming a saved session where possible."""
+    saved = UploadSession.objects.filter(
+        source_path=source_path,
+        file_name=file_name,
+        parent_folder_id=parent_folder_id,
+        total_size=total_size,
+        expires_at__gt=timezone.now()
+    ).order_by('-created_at').first()
+
+    if saved is not None:
+        state = drive_service.query_session_offset(saved.session_uri, total_size)
+        if state is not None:
+            offset, resource = state
+            logger.info(f"Resuming upload of {file_name} at byte {offset} of {total_size}")
+            return saved, offset, resource
+        saved.delete()
+
+    session_uri = drive_service.start_resumable_session(file_name, parent_folder_id, mime_type=mime_type, size=total_size)
+    if not session_uri:
+        return None, 0, None
+    session = UploadSession.objects.create(
+        session_uri=session_uri,
+        source_path=source_path,
+        file_name=file_name,
+        parent_folder_id=parent_folder_id,
+        mime_type=mime_type,
+        total_size=total_size,
+        expires_at=timezone.now() + timedelta(seconds=_session_ttl())
+    )
+    return session, 0, None
+
+
+def upload_path_resumable(drive_service, source_path, file_name, parent_folder_id, mime_type=None, progress_callback=None):
+    """Upload a file on disk through a resumable session saved in UploadSession.
+
+    If the process dies part-way, calling this again with the same file and
+    target asks Drive for the committed offset and sends only the rest.
+    Returns the created file's resource, or None if no session could be opened.
+    Raises on transfer errors, leaving the session saved for the next attempt.
+    """
+    if mime_type is None:
+        mime_type, _ = mimetypes.guess_type(file_name)
+    mime_type = mime_type or 'application/octet-stream'
+    total_size = os.path.getsize(source_path)
+
+    session, offset, resource = _open_session(drive_service, source_path, file_name, parent_folder_id, mime_type, total_size)
+    if session is None:
+        return None
+
+    max_retries = getattr(settings, 'GOOGLE_DRIVE_MAX_RETRIES', DEFAULT_MAX_RETRIES)
+    failures = 0
+    with open(source_path, 'rb') as source:
+        while resource is None:
+            source.seek(offset)
+            # Re-tuned every chunk, so long uploads settle on the link's best size
+            data = source.read(tuner.chunk_size(UPLOAD))
+            if not data and offset < total_size:
+                raise IOError(f"{source_path} is shorter than the {total_size} bytes being uploaded")
+            try:
+                offset, resource = drive_service.upload_session_chunk(session.session_uri, data, offset, total_size)
+                failures = 0
+            except Exception as e:
+                failures += 1
+                if failures > max_retries or not is_retryable(e):
+                    raise
+                delay = backoff_delay(failures, e)
+                logger.warning(f"Chunk of {file_name} at byte {offset} failed ({e}); resuming in {delay:.1f}s")
+                time.sleep(delay)
+                # Continue from whatever Drive actually committed
+                state = drive_service.query_session_offset(session.session_uri, total_size)
+                if state is None:
+                    raise
+                offset, resource = state
+                continue
+            if not data and resource is None:
+                raise IOError(f"Drive did not finish the upload of {file_name} after all {total_size} bytes were sent")
+            UploadSession.objects.filter(pk=session.pk).update(bytes_confirmed=offset, updated_at=timezone.now())
+            if progress_callback:
+                progress_callback(offset, total_size)
+
+    session.delete()
+    logger.info(f"Resumable upload of {file_name} complete: {resource.get('id')}")
+    return resource
+
+
+def discard_sessions(source_path):
+    """Forget saved sessions for a source file that will not be retried."""
+    UploadSession.objects.filter(source_path=source_path).delete()
@@ -0,0 +1,220 @@
+import ssl
+import json
+import time
+import asyncio
+import random
+import logging
+import http.client
+from email.utils import parsedate_to_datetime
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from googleapiclient.errors import HttpError
+
+from .tracing import traced
+
+try:
+    import httpx
+except ImportError:  # only needed by the async client
+    httpx = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BASE_DELAY = 1.0
+DEFAULT_MAX_DELAY = 64.0
+
+# Requests per second for the whole deployment; Drive's default quota is
+# 12,000 requests per minute (200/s) per project and per user
+DEFAULT_RATE_LIMIT = 150
+# Longest a caller waits for the rate limiter before going ahead anyway
+DEFAULT_MAX_THROTTLE_WAIT = 60.0
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+# 403s that mean "slow down" rather than "not allowed"
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+TRANSPORT_ERRORS = (TimeoutError, ConnectionError, http.client.HTTPException, ssl.SSLError)
+if httpx is not None:
+    TRANSPORT_ERRORS += (httpx.TransportError,)
+
+RATE_KEY_PREFIX = 'gdrive:rate:'
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def error_reason(error):
+    """The first 'reason' in a Drive error response, e.g. 'userRateLimitExceeded'."""
+    try:
+        content = error.content.decode('utf-8') if isinstance(error.content, bytes) else error.content
+        errors = json.loads(content).get('error', {}).get('errors', [])
+        return errors[0].get('reason') if errors else None
+    except (ValueError, AttributeError, TypeError):
+        return None
+
+
+def is_rate_limited(error):
+    """True if Drive refused the call for quota reasons (429, or 403 with a rate-limit reason)."""
+    if not isinstance(error, HttpError):
+        return False
+    status = error.resp.status
+    return status == 429 or (status == 403 and error_reason(error) in RATE_LIMIT_REASONS)
+
+
+def is_retryable(error):
+    """True for rate limiting, server errors and dropped connections."""
+    if isinstance(error, HttpError):
+        return error.resp.status in RETRYABLE_STATUSES or is_rate_limited(error)
+    return isinstance(error, TRANSPORT_ERRORS)
+
+
+def retry_after(error):
+    """Seconds the server asked us to wait in a Retry-After header, or None."""
+    value = getattr(getattr(error, 'resp', None), 'get', lambda key: None)('retry-after')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - timezone.now()).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, error=None):
+    """Seconds to wait before retry number attempt (starting at 1).
+
+    Exponential backoff with full jitter, but never sooner than Retry-After.
+    """
+    cap = min(_setting('GOOGLE_DRIVE_RETRY_MAX_DELAY', DEFAULT_MAX_DELAY),
+              _setting('GOOGLE_DRIVE_RETRY_BASE_DELAY', DEFAULT_BASE_DELAY) * 2 ** (attempt - 1))
+    delay = random.uniform(0, cap)
+    requested = retry_after(error) if error is not None else None
+    return max(delay, requested) if requested is not None else delay
+
+
+class RateLimiter:
+    """Fixed-window token allotment shared by every process through the Django cache.
+
+    Each one-second window hands out `rate` tokens, counted with an atomic
+    cache.incr on a per-window key. A caller that finds the window used up
+    sleeps until the next one. Sharing only works across processes when
+    CACHES points at a shared backend such as Redis or Memcached.
+    """
+
+    def __init__(self, name='drive', rate=None, window=1.0):
+        self.name = name
+        self._rate = rate
+        self.window = window
+
+    @property
+    def rate(self):
+        return self._rate if self._rate is not None else _setting('GOOGLE_DRIVE_RATE_LIMIT', DEFAULT_RATE_LIMIT)
+
+    def _take(self, tokens, now):
+        window_index = int(now // self.window)
+        key = f'{RATE_KEY_PREFIX}{self.name}:{window_index}'
+        timeout = int(self.window * 2) + 1
+        cache.add(key, 0, timeout)
+        try:
+            used = cache.incr(key, tokens)
+        except ValueError:
+            # Key expired between add and incr
+            cache.add(key, tokens, timeout)
+            used = tokens
+        return used <= self.rate, (window_index + 1) * self.window - now
+
+    def _next_pause(self, tokens, waited):
+        """Seconds to sleep before asking again, or None when the caller may go ahead."""
+        try:
+            allowed, until_next = self._take(tokens, time.time())
+        except Exception as e:
+            # A broken cache must not stop Drive traffic
+            logger.warning(f"Rate limiter unavailable: {e}")
+            return None
+        if allowed:
+            return None
+        if waited >= _setting('GOOGLE_DRIVE_MAX_THROTTLE_WAIT', DEFAULT_MAX_THROTTLE_WAIT):
+            logger.warning(f"Rate limiter {self.name} still saturated after {waited:.1f}s; sending anyway")
+            return None
+        # Spread the waiters across the next window
+        return until_next + random.uniform(0, self.window / 2)
+
+    def acquire(self, tokens=1):
+        """Block until tokens are available. Returns the seconds spent waiting."""
+        waited = 0.0
+        if not self.rate:
+            return waited
+        while (pause := self._next_pause(tokens, waited)) is not None:
+            time.sleep(pause)
+            waited += pause
+        return waited
+
+    async def aacquire(self, tokens=1):
+        """acquire() for coroutines: waits with asyncio.sleep instead of blocking the loop."""
+        waited = 0.0
+        if not self.rate:
+            return waited
+        while (pause := self._next_pause(tokens, waited)) is not None:
+            await asyncio.sleep(pause)
+            waited += pause
+        return waited
+
+
+limiter = RateLimiter()
+
+
+def call_with_retries(fn, label='Drive request', tokens=1, max_retries=None):
+    """Call fn() under the rate limiter, retrying retryable errors with backoff.
+
+    The call, with its retries, is recorded in the current request's Drive trace.
+    Non-retryable errors, and the last retryable one, are raised to the caller.
+    """
+    if max_retries is None:
+        max_retries = _setting('GOOGLE_DRIVE_MAX_RETRIES', DEFAULT_MAX_RETRIES)
+    attempt = 0
+    with traced(label) as call:
+        while True:
+            call.throttled += limiter.acquire(tokens)
+            try:
+                return fn()
+            except Exception as e:
+                attempt += 1
+                call.rate_limited += is_rate_limited(e)
+                if attempt > max_retries or not is_retryable(e):
+                    raise
+                call.retries = attempt
+                delay = backoff_delay(attempt, e)
+                logger.warning(f"{label} failed ({e}); retry {attempt}/{max_retries} in {delay:.1f}s")
+                time.sleep(delay)
+
+
+def execute(request, label=None, max_retries=None):
+    """request.execute() with rate limiting and retries."""
+    return call_with_retries(request.execute, label or f"Drive {getattr(request, 'methodId', 'request')}",
+                             max_retries=max_retries)
+
+
+async def acall_with_retries(fn, label='Drive request', tokens=1, max_retries=None):
+    """call_with_retries for coroutines: awaits fn() and backs off with asyncio.sleep."""
+    if max_retries is None:
+        max_retries = _setting('GOOGLE_DRIVE_MAX_RETRIES', DEFAULT_MAX_RETRIES)
+    attempt = 0
+    with traced(label) as call:
+        while True:
+            call.throttled += await limiter.aacquire(tokens)
+            try:
+                return await fn()
+            except Exception as e:
+                attempt += 1
+                call.rate_limited += is_rate_limited(e)
+                if attempt > max_retries or not is_retryable(e):
+                    raise
+                call.retries = attempt
+                delay = backoff_delay(attempt, e)
+                logger.warning(f"{label} failed ({e}); retry {attempt}/{max_retries} in {delay:.1f}s")
+                await asyncio.sleep(delay)
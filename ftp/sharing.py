@@ -0,0 +1,177 @@
+import time
+import logging
+from django.conf import settings
+
+from googleapiclient.errors import HttpError
+
+from .gdrive import GoogleDriveService
+from .models import FileEntry, FolderEntry, UserProfile
+from .retry import DEFAULT_MAX_RETRIES, backoff_delay, call_with_retries, is_retryable
+
+logger = logging.getLogger(__name__)
+
+# Drive accepts at most 100 calls in one batch request
+BATCH_LIMIT = 100
+
+
+class SharingError(Exception):
+    """Some items could not be shared or unshared; item_ids lists them."""
+
+    def __init__(self, message, item_ids):
+        super().__init__(message)
+        self.item_ids = item_ids
+
+
+def _check_failures(failed, action):
+    # An item deleted from Drive since it was recorded has nothing left to share
+    remaining = [item_id for item_id, exception in failed.items()
+                 if not (isinstance(exception, HttpError) and exception.resp.status == 404)]
+    if remaining:
+        raise SharingError(f"{action} failed for {len(remaining)} items", remaining)
+
+
+def _run_batches(drive_service, item_ids, build_request, failed=None, heartbeat=None):
+    """Send build_request(item_id) for every item in batches of BATCH_LIMIT.
+
+    Calls inside a batch that are rate limited or hit a server error are
+    sent again in a later batch after a backoff. Returns a dict of
+    item_id -> response, with None for failed calls. If failed is a dict,
+    the exception of every failed call is stored in it by item_id.
+    heartbeat() is called after every batch.
+    """
+    results = {}
+    retry = []
+    if failed is None:
+        failed = {}
+
+    def callback(request_id, response, exception):
+        if exception is not None:
+            if is_retryable(exception):
+                retry.append((request_id, exception))
+                return
+            logger.error(f"Batched Drive call for {request_id} failed: {exception}")
+            failed[request_id] = exception
+            response = None
+        results[request_id] = response
+
+    pending = list(dict.fromkeys(item_ids))
+    max_retries = getattr(settings, 'GOOGLE_DRIVE_MAX_RETRIES', DEFAULT_MAX_RETRIES)
+    attempt = 0
+    while pending:
+        for start in range(0, len(pending), BATCH_LIMIT):
+            chunk = pending[start:start + BATCH_LIMIT]
+            batch = drive_service.service.new_batch_http_request(callback=callback)
+            for item_id in chunk:
+                batch.add(build_request(item_id), request_id=item_id)
+            # Each call in a batch counts against the quota separately
+            call_with_retries(batch.execute, 'Drive batch request', tokens=len(chunk))
+            if heartbeat:
+                heartbeat()
+
+        attempt += 1
+        pending = [request_id for request_id, _ in retry]
+        if pending and attempt > max_retries:
+            for request_id, exception in retry:
+                logger.error(f"Batched Drive call for {request_id} failed: {exception}")
+                failed[request_id] = exception
+                results[request_id] = None
+            break
+        if pending:
+            delay = max(backoff_delay(attempt, exception) for _, exception in retry)
+            logger.warning(f"Retrying {len(pending)} rate-limited batch calls in {delay:.1f}s")
+            time.sleep(delay)
+        retry.clear()
+    return results
+
+
+def share_items(drive_service, item_ids, email, role='writer', strict=False, heartbeat=None):
+    """Give email access to many files and folders using batch requests.
+
+    Returns the number of items shared successfully. With strict=True a
+    SharingError is raised instead if any item that still exists failed.
+    """
+    if not drive_service.service or not email or not item_ids:
+        return 0
+
+    permission = {
+        'type': 'user',
+        'role': role,
+        'emailAddress': email
+    }
+    # Building the permissions resource is costly (every method is generated), so do it once
+    permissions = drive_service.service.permissions()
+    failed = {}
+    results = _run_batches(drive_service, item_ids, lambda item_id: permissions.create(
+        fileId=item_id,
+        body=permission,
+        fields='id',
+        sendNotificationEmail=False
+    ), failed, heartbeat)
+    shared = sum(1 for response in results.values() if response is not None)
+    logger.info(f"Shared {shared}/{len(results)} items with {email}")
+    if strict:
+        _check_failures(failed, f"Sharing with {email}")
+    return shared
+
+
+def unshare_items(drive_service, item_ids, email, strict=False, heartbeat=None):
+    """Remove email's permissions from many files and folders using batch requests.
+
+    Returns the number of permissions removed. With strict=True a
+    SharingError is raised instead if any item that still exists failed.
+    """
+    if not drive_service.service or not email or not item_ids:
+        return 0
+
+    permissions = drive_service.service.permissions()
+    failed = {}
+    listings = _run_batches(drive_service, item_ids, lambda item_id: permissions.list(
+        fileId=item_id,
+        fields='permissions(id,emailAddress)'
+    ), failed, heartbeat)
+    to_delete = {}
+    for item_id, listing in listings.items():
+        for permission in (listing or {}).get('permissions', []):
+            if (permission.get('emailAddress') or '').lower() == email.lower():
+                to_delete[item_id] = permission['id']
+
+    results = _run_batches(drive_service, to_delete, lambda item_id: permissions.delete(
+        fileId=item_id,
+        permissionId=to_delete[item_id]
+    ), failed, heartbeat)
+    # permissions().delete returns an empty body on success
+    removed = sum(1 for item_id in to_delete if item_id in results and results[item_id] is not None)
+    logger.info(f"Removed {email} from {removed}/{len(to_delete)} items")
+    if strict:
+        _check_failures(failed, f"Removing {email}")
+    return removed
+
+
+def user_drive_items(user):
+    """Drive IDs of everything a user owns: their root folder, folders and files."""
+    item_ids = []
+    profile = UserProfile.objects.filter(user=user).first()
+    if profile and profile.drive_folder_id:
+        item_ids.append(profile.drive_folder_id)
+    item_ids.extend(FolderEntry.objects.filter(user=user).values_list('drive_folder_id', flat=True))
+    item_ids.extend(FileEntry.objects.filter(user=user).values_list('drive_file_id', flat=True))
+    return item_ids
+
+
+def update_user_sharing(user, old_email, new_email, drive_service=None, heartbeat=None):
+    """Move a user's whole Drive tree from sharing with old_email to new_email.
+
+    Returns (unshared, shared) item counts. Raises SharingError if any
+    item still fails after retries, so a queued job is tried again. Running
+    it again is harmless for items that were already moved over.
+    heartbeat() is called between batches, e.g. to renew a job's lease.
+    """
+    drive_service = drive_service or GoogleDriveService()
+    item_ids = user_drive_items(user)
+    logger.info(f"Updating sharing for {len(item_ids)} items of {user.username}: {old_email} -> {new_email}")
+    unshared = shared = 0
+    if old_email and old_email != new_email:
+        unshared = unshare_items(drive_service, item_ids, old_email, strict=True, heartbeat=heartbeat)
+    if new_email and new_email != old_email:
+        shared = share_items(drive_service, item_ids, new_email, strict=True, heartbeat=heartbeat)
+    return unshared, shared
@@ -0,0 +1,230 @@
+import logging
+import traceback
+from collections import defaultdict
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .gdrive import GoogleDriveService, FOLDER_MIME_TYPE
+from .models import DriveSyncState, FileEntry, FolderEntry, UserProfile
+from .importer import import_subtrees
+
+logger = logging.getLogger(__name__)
+
+
+def _latest_changes(changes):
+    """Keep only the last change reported for each Drive item."""
+    latest = {}
+    for change in changes:
+        if change.get('changeType', 'file') == 'file' and change.get('fileId'):
+            latest[change['fileId']] = change
+    return list(latest.values())
+
+
+def _is_gone(change):
+    return change.get('removed') or not change.get('file') or change['file'].get('trashed')
+
+
+def apply_changes(user, root_folder_id, changes, drive_service=None):
+    """Apply Drive changes to one user's FileEntry and FolderEntry rows.
+
+    Only items inside the user's tree are considered. Database work is
+    proportional to the number of changes, not the size of the tree,
+    except that a folder new to the tree is listed and its contents
+    imported, since a folder moved in from elsewhere arrives as a single
+    change. Returns the number of rows created, updated or deleted.
+    """
+    changes = [change for change in _latest_changes(changes) if change['fileId'] != root_folder_id]
+    if not changes:
+        return 0
+
+    drive_ids = [change['fileId'] for change in changes]
+    parent_ids = {parent for change in changes if not _is_gone(change)
+                  for parent in change['file'].get('parents', [])}
+
+    folders = {folder.drive_folder_id: folder for folder in
+               FolderEntry.objects.filter(user=user, drive_folder_id__in=set(drive_ids) | parent_ids)}
+    files = {entry.drive_file_id: entry for entry in
+             FileEntry.objects.filter(user=user, drive_file_id__in=drive_ids)}
+    applied = 0
+    created_folders = []
+
+    with transaction.atomic():
+        # Trashed, deleted and unshared items
+        gone = [change['fileId'] for change in changes if _is_gone(change)]
+        gone_folders = [folders[drive_id] for drive_id in gone if drive_id in folders]
+        for folder in gone_folders:
+            folder.delete()
+        deleted, _ = FileEntry.objects.filter(user=user, drive_file_id__in=gone).delete()
+        applied += deleted + len(gone_folders)
+
+        def parent_of(item):
+            """(in_tree, FolderEntry or None) for the first of an item's parents inside the tree."""
+            for parent_id in item.get('parents') or []:
+                if parent_id == root_folder_id:
+                    return True, None
+                if parent_id in folders:
+                    return True, folders[parent_id]
+            return False, None
+
+        live = [change['file'] for change in changes if not _is_gone(change)]
+        folder_items = [item for item in live if item.get('mimeType') == FOLDER_MIME_TYPE]
+        file_items = [item for item in live if item.get('mimeType') != FOLDER_MIME_TYPE]
+
+        # Folders first, in rounds, so that new folders can parent each other
+        pending = folder_items
+        while pending:
+            pending_ids = {item['id'] for item in pending}
+            waiting = []
+            created = {}
+            moved = False
+            for item in pending:
+                in_tree, parent = parent_of(item)
+                existing = folders.get(item['id'])
+                if not in_tree:
+                    if pending_ids.intersection(item.get('parents', [])):
+                        # Parent is created or moved in a later round
+                        waiting.append(item)
+                    elif existing is not None:
+                        # Moved out of the user's tree
+                        existing.delete()
+                        del folders[item['id']]
+                        applied += 1
+                    continue
+                if existing is None:
+                    created[item['id']] = FolderEntry(
+                        user=user,
+                        folder_name=item['name'],
+                        drive_folder_id=item['id'],
+                        parent_folder=parent
+                    )
+                else:
+                    if existing.folder_name != item['name']:
+                        existing.folder_name = item['name']
+                        FolderEntry.objects.filter(pk=existing.pk).update(folder_name=item['name'])
+                        applied += 1
+                    if existing.parent_folder_id != (parent.pk if parent else None):
+                        existing.move_to(parent)
+                        moved = True
+                        applied += 1
+
+            if moved:
+                # A move rewrites the paths of the whole subtree
+                by_pk = {folder.pk: folder for folder in folders.values()}
+                for pk, path, depth in FolderEntry.objects.filter(pk__in=by_pk).values_list('pk', 'path', 'depth'):
+                    by_pk[pk].path, by_pk[pk].depth = path, depth
+
+            if created:
+                # bulk_create skips save(), so paths are filled in here
+                FolderEntry.objects.bulk_create(created.values())
+                new_folders = list(FolderEntry.objects.filter(user=user, drive_folder_id__in=created))
+                for folder in new_folders:
+                    parent = created[folder.drive_folder_id].parent_folder
+                    folder.path = f"{parent.path if parent else '/'}{folder.pk}/"
+                    folder.depth = folder.path.count('/') - 2
+                    folders[folder.drive_folder_id] = folder
+                FolderEntry.objects.bulk_update(new_folders, ['path', 'depth'])
+                created_folders.extend(new_folders)
+                applied += len(new_folders)
+
+            if len(waiting) == len(pending):
+                # Nothing left can be attached to the tree
+                break
+            pending = waiting
+
+        new_files = []
+        updated_files = []
+        for item in file_items:
+            in_tree, parent = parent_of(item)
+            existing = files.get(item['id'])
+            if not in_tree:
+                if existing is not None:
+                    existing.delete()
+                    applied += 1
+                continue
+            size = int(item.get('size') or 0)
+            md5_checksum = item.get('md5Checksum', '')
+            if existing is None:
+                new_files.append(FileEntry(
+                    user=user,
+                    file_name=item['name'],
+                    file_size=size,
+                    file_type=item.get('mimeType') or 'application/octet-stream',
+                    drive_file_id=item['id'],
+                    upload_date=parse_datetime(item['createdTime']) if item.get('createdTime') else timezone.now(),
+                    folder=parent,
+                    md5_checksum=md5_checksum
+                ))
+            elif ((existing.file_name, existing.file_size, existing.folder_id, existing.md5_checksum)
+                  != (item['name'], size, parent.pk if parent else None, md5_checksum)):
+                existing.file_name = item['name']
+                existing.file_size = size
+                existing.folder = parent
+                existing.md5_checksum = md5_checksum
+                updated_files.append(existing)
+
+        # An upload may record the same file between our read and this insert
+        FileEntry.objects.bulk_create(new_files, batch_size=1000, ignore_conflicts=True)
+        FileEntry.objects.bulk_update(updated_files, ['file_name', 'file_size', 'folder', 'md5_checksum'], batch_size=1000)
+        applied += len(new_files) + len(updated_files)
+
+    if created_folders:
+        # Contents of a folder moved into the tree are not reported as changes
+        created_pks = {folder.pk for folder in created_folders}
+        roots = [(folder.drive_folder_id, folder) for folder in created_folders if folder.parent_folder_id not in created_pks]
+        stats = import_subtrees(user, roots, drive_service=drive_service)
+        applied += stats['folders'] + stats['files']
+
+    logger.info(f"Applied {applied} Drive changes for {user.username}")
+    return applied
+
+
+def sync_users(profiles=None, drive_service=None):
+    """Bring FileEntry/FolderEntry rows up to date with Drive for the given profiles.
+
+    Users whose stored page tokens match share a single changes.list pass.
+    Profiles without a sync state are given the current start token; sync
+    tracks changes from that point on.
+    """
+    drive_service = drive_service or GoogleDriveService()
+    if profiles is None:
+        profiles = UserProfile.objects.filter(is_approved=True).exclude(drive_folder_id__isnull=True).exclude(drive_folder_id='')
+    profiles = list(profiles.select_related('user') if hasattr(profiles, 'select_related') else profiles)
+
+    states = {state.profile_id: state for state in DriveSyncState.objects.filter(profile__in=profiles)}
+    by_token = defaultdict(list)
+    for profile in profiles:
+        state = states.get(profile.pk)
+        if state is None or state.root_folder_id != profile.drive_folder_id:
+            token = drive_service.get_start_page_token()
+            if token:
+                DriveSyncState.objects.update_or_create(
+                    profile=profile,
+                    defaults={'root_folder_id': profile.drive_folder_id, 'page_token': token, 'last_synced_at': timezone.now()}
+                )
+                logger.info(f"Started change tracking for {profile.user.username} at token {token}")
+            continue
+        by_token[state.page_token].append((profile, state))
+
+    total = 0
+    for token, members in by_token.items():
+        try:
+            changes, new_token = drive_service.list_changes(token)
+        except Exception as e:
+            logger.error(f"Error listing Drive changes from token {token}: {e}")
+            logger.error(traceback.format_exc())
+            continue
+
+        for profile, state in members:
+            try:
+                applied = apply_changes(profile.user, profile.drive_folder_id, changes, drive_service=drive_service)
+            except Exception as e:
+                logger.error(f"Error applying Drive changes for {profile.user.username}: {e}")
+                logger.error(traceback.format_exc())
+                continue
+            state.page_token = new_token
+            state.last_synced_at = timezone.now()
+            state.changes_applied += applied
+            state.save(update_fields=['page_token', 'last_synced_at', 'changes_applied', 'updated_at'])
+            total += applied
+    return total
@@ -3,7 +3,10 @@ import sys
 import logging
 import tempfile
 from django.conf import settings
-from gdrive import GoogleDriveService
+
+# Allow running as `python ftp/test_drive.py` from the project root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ftp.gdrive import GoogleDriveService
 
 # Set up logging
 logging.basicConfig(
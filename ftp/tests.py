@@ -1,3 +1,1692 @@
-from django.test import TestCase
+import io
+import os
+import time
+import asyncio
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import httpx
+import httplib2
+from google.auth import _helpers
+from google.oauth2 import service_account
+from googleapiclient.errors import HttpError
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.uploadhandler import StopFutureHandlers
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.urls import include, path, reverse
+from django.utils import timezone
+from django.utils.http import http_date
+
+from .async_gdrive import AsyncDriveDownload, AsyncDriveService, transport
+from .dedup import find_copies, find_copy
+from .folder_cache import (
+    forget_folder, get_fallback_root, is_known_folder,
+    remember_folder, set_fallback_root,
+)
+from .gdrive import FOLDER_MIME_TYPE, STREAM_BLOCK_SIZE, DriveDownload, GoogleDriveService
+from .models import FileEntry, FolderEntry, TransferJob, UploadSession
+from .pagination import encode_cursor, keyset_paginate
+from .jobs import run_job
+from .media import CHUNK_ALIGNMENT
+from .ranges import MAX_RANGES, RangeNotSatisfiable, if_range_matches, parse_range_header
+from . import async_views, download_cache, token_cache, transfers
+from .retry import (
+    RateLimiter, acall_with_retries, backoff_delay, call_with_retries, is_rate_limited,
+    is_retryable, retry_after,
+)
+from .resumable import discard_sessions, upload_path_resumable
+from .sharing import SharingError, share_items, update_user_sharing
+from .sync import apply_changes
+from .token_cache import SharedTokenCredentials
+from .middleware import DriveTraceMiddleware
+from .tracing import (
+    DriveCall, DriveCallBudgetExceeded, DriveTrace, call_budget, drive_call_budget,
+    start_trace, traced,
+)
+from .transfers import run_drive_tasks
+from .tuning import DOWNLOAD, UPLOAD, TransferTuner
+from .upload_handlers import DriveStreamingUploadHandler
+
+MB = 1024 * 1024
+
+
+class ParseRangeHeaderTests(SimpleTestCase):
+    def test_missing_header(self):
+        self.assertIsNone(parse_range_header(None, 1000))
+        self.assertIsNone(parse_range_header('', 1000))
+
+    def test_single_ranges(self):
+        self.assertEqual(parse_range_header('bytes=0-99', 1000), [(0, 99)])
+        self.assertEqual(parse_range_header('bytes=990-', 1000), [(990, 999)])
+        self.assertEqual(parse_range_header('bytes=-100', 1000), [(900, 999)])
+
+    def test_end_is_clamped_to_the_file(self):
+        self.assertEqual(parse_range_header('bytes=990-5000', 1000), [(990, 999)])
+        self.assertEqual(parse_range_header('bytes=-5000', 1000), [(0, 999)])
+
+    def test_overlapping_and_adjacent_ranges_are_merged(self):
+        ranges = parse_range_header('bytes=500-599, 0-99, 100-199, 550-650', 1000)
+        self.assertEqual(ranges, [(0, 199), (500, 650)])
+
+    def test_disjoint_ranges_are_sorted(self):
+        self.assertEqual(parse_range_header('bytes=900-909,0-9', 1000), [(0, 9), (900, 909)])
+
+    def test_too_many_ranges_are_ignored(self):
+        specs = [f'{i * 10}-{i * 10}' for i in range(MAX_RANGES + 1)]
+        self.assertEqual(len(parse_range_header(f"bytes={','.join(specs[:MAX_RANGES])}", 1000)), MAX_RANGES)
+        self.assertIsNone(parse_range_header(f"bytes={','.join(specs)}", 1000))
+
+    def test_malformed_headers_are_ignored(self):
+        for header in ['bytes=abc', 'items=0-1', 'bytes=', 'bytes=-', 'bytes=5-1', 'bytes=0-1,x']:
+            with self.subTest(header=header):
+                self.assertIsNone(parse_range_header(header, 1000))
+
+    def test_unsatisfiable_ranges(self):
+        for header in ['bytes=1000-1100', 'bytes=-0', 'bytes=2000-,3000-3001']:
+            with self.subTest(header=header):
+                with self.assertRaises(RangeNotSatisfiable):
+                    parse_range_header(header, 1000)
+
+    def test_unsatisfiable_ranges_are_dropped_next_to_satisfiable_ones(self):
+        self.assertEqual(parse_range_header('bytes=1000-1100,0-9', 1000), [(0, 9)])
+
+    def test_empty_file(self):
+        with self.assertRaises(RangeNotSatisfiable):
+            parse_range_header('bytes=0-', 0)
+
+
+class IfRangeMatchesTests(SimpleTestCase):
+    etag = '"abc-10"'
+    last_modified = timezone.now().replace(microsecond=0)
+
+    def test_missing_header_matches(self):
+        self.assertTrue(if_range_matches(None, self.etag, self.last_modified))
+
+    def test_strong_etag(self):
+        self.assertTrue(if_range_matches('"abc-10"', self.etag, self.last_modified))
+        self.assertFalse(if_range_matches('"abc-11"', self.etag, self.last_modified))
+
+    def test_weak_etag_never_matches(self):
+        self.assertFalse(if_range_matches('W/"abc-10"', self.etag, self.last_modified))
+
+    def test_date(self):
+        self.assertTrue(if_range_matches(http_date(self.last_modified.timestamp()), self.etag, self.last_modified))
+        earlier = self.last_modified - timedelta(seconds=1)
+        self.assertFalse(if_range_matches(http_date(earlier.timestamp()), self.etag, self.last_modified))
+        self.assertFalse(if_range_matches('not a date', self.etag, self.last_modified))
+
+
+class KeysetPaginateTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice')
+        # Several files share a size, so pages must break ties on the primary key
+        for index, size in enumerate([30, 10, 20, 20, 20, 40, 20, 10, 50]):
+            FileEntry.objects.create(user=self.user, file_name=f'file{index}', file_size=size,
+                                     file_type='text/plain', drive_file_id=f'D{index}')
+        self.queryset = FileEntry.objects.filter(user=self.user)
+
+    def walk(self, descending):
+        pages = [keyset_paginate(self.queryset, 'file_size', descending=descending, page_size=2)]
+        while pages[-1].has_next:
+            pages.append(keyset_paginate(self.queryset, 'file_size', descending=descending,
+                                         after=pages[-1].next_cursor, page_size=2))
+        return pages
+
+    def test_pages_follow_the_full_ordering(self):
+        for descending in (False, True):
+            with self.subTest(descending=descending):
+                prefix = '-' if descending else ''
+                expected = list(self.queryset.order_by(f'{prefix}file_size', f'{prefix}pk').values_list('pk', flat=True))
+                pages = self.walk(descending)
+                self.assertEqual([entry.pk for page in pages for entry in page], expected)
+                self.assertEqual([len(page) for page in pages], [2, 2, 2, 2, 1])
+                self.assertFalse(pages[0].has_previous)
+                self.assertTrue(all(page.has_previous for page in pages[1:]))
+
+    def test_previous_cursor_returns_the_same_pages(self):
+        pages = self.walk(descending=False)
+        page = pages[-1]
+        for expected in reversed(pages[:-1]):
+            page = keyset_paginate(self.queryset, 'file_size', before=page.previous_cursor, page_size=2)
+            self.assertEqual([entry.pk for entry in page], [entry.pk for entry in expected])
+            self.assertTrue(page.has_next)
+        self.assertFalse(page.has_previous)
+
+    def test_cursor_in_the_middle_of_a_tie(self):
+        twenties = list(self.queryset.filter(file_size=20).order_by('pk'))
+        page = keyset_paginate(self.queryset, 'file_size', after=encode_cursor(20, twenties[1].pk), page_size=3)
+        self.assertEqual([entry.pk for entry in page], [twenties[2].pk, twenties[3].pk, self.queryset.get(file_size=30).pk])
+
+    def test_malformed_cursor_starts_from_the_beginning(self):
+        page = keyset_paginate(self.queryset, 'file_size', after='not-a-cursor', page_size=2)
+        self.assertEqual([entry.file_size for entry in page], [10, 10])
+
+    def test_date_cursor_round_trip(self):
+        pages = []
+        page = keyset_paginate(self.queryset, 'upload_date', descending=True, page_size=4)
+        pages.append(page)
+        while page.has_next:
+            page = keyset_paginate(self.queryset, 'upload_date', descending=True, after=page.next_cursor, page_size=4)
+            pages.append(page)
+        self.assertEqual(sorted(entry.pk for page in pages for entry in page),
+                         sorted(self.queryset.values_list('pk', flat=True)))
+
+
+class TransferJobTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('bob')
+
+    def create_job(self, **kwargs):
+        kwargs.setdefault('kind', TransferJob.KIND_UPLOAD)
+        return TransferJob.objects.create(user=self.user, **kwargs)
+
+    def expire(self, job):
+        TransferJob.objects.filter(pk=job.pk).update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+
+    def test_claim_takes_each_job_once_in_order(self):
+        first = self.create_job(available_at=timezone.now() - timedelta(seconds=10))
+        second = self.create_job()
+        claimed = TransferJob.claim('worker-1', 60)
+        self.assertEqual(claimed.pk, first.pk)
+        self.assertEqual((claimed.status, claimed.lease_owner, claimed.attempts), (TransferJob.RUNNING, 'worker-1', 1))
+        self.assertGreater(claimed.lease_expires_at, timezone.now())
+        self.assertEqual(TransferJob.claim('worker-2', 60).pk, second.pk)
+        self.assertIsNone(TransferJob.claim('worker-3', 60))
+
+    def test_claim_skips_jobs_that_are_not_due_or_of_another_kind(self):
+        self.create_job(available_at=timezone.now() + timedelta(minutes=5))
+        self.create_job(kind=TransferJob.KIND_DELETE_FOLDER)
+        self.assertIsNone(TransferJob.claim('worker', 60, kinds=[TransferJob.KIND_UPLOAD]))
+
+    def test_heartbeat_renews_the_lease_and_records_progress(self):
+        self.create_job(bytes_total=200)
+        job = TransferJob.claim('worker', 60)
+        self.assertTrue(job.heartbeat(600, bytes_done=50))
+        job.refresh_from_db()
+        self.assertEqual((job.bytes_done, job.progress), (50, 0.25))
+        self.assertGreater(job.lease_expires_at, timezone.now() + timedelta(seconds=500))
+
+    def test_expired_lease_is_taken_over(self):
+        self.create_job()
+        job = TransferJob.claim('worker-1', 60)
+        self.expire(job)
+        taken = TransferJob.claim('worker-2', 60)
+        self.assertEqual(taken.pk, job.pk)
+        self.assertEqual((taken.lease_owner, taken.attempts), ('worker-2', 2))
+        # The first worker finds out on its next heartbeat and can no longer finish the job
+        self.assertFalse(job.heartbeat(60, bytes_done=1))
+        self.assertFalse(job.succeed())
+        self.assertTrue(taken.heartbeat(60, bytes_done=1))
+        self.assertTrue(taken.succeed({'ok': True}))
+        taken.refresh_from_db()
+        self.assertEqual(taken.status, TransferJob.SUCCEEDED)
+
+    def test_unexpired_lease_is_not_taken_over(self):
+        self.create_job()
+        TransferJob.claim('worker-1', 60)
+        self.assertIsNone(TransferJob.claim('worker-2', 60))
+
+    def test_fail_requeues_until_attempts_run_out(self):
+        self.create_job(max_attempts=2)
+        job = TransferJob.claim('worker', 60)
+        self.assertTrue(job.fail(IOError('first'), retry_delay=0))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.error, job.lease_owner), (TransferJob.QUEUED, 'first', ''))
+
+        job = TransferJob.claim('worker', 60)
+        self.assertEqual(job.attempts, 2)
+        self.assertTrue(job.fail(IOError('second'), retry_delay=0))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.error), (TransferJob.FAILED, 'second'))
+        self.assertIsNotNone(job.finished_at)
+        self.assertIsNone(TransferJob.claim('worker', 60))
+
+    def test_fail_with_retry_delay_waits(self):
+        self.create_job()
+        job = TransferJob.claim('worker', 60)
+        job.fail(IOError('later'), retry_delay=60)
+        self.assertIsNone(TransferJob.claim('worker', 60))
+
+    def test_delete_folder_job_checks_its_lease_first(self):
+        folder = FolderEntry.objects.create(user=self.user, folder_name='old', drive_folder_id='F1')
+        self.create_job(kind=TransferJob.KIND_DELETE_FOLDER, payload={'folder_id': folder.pk})
+        job = TransferJob.claim('worker-1', 60)
+        drive = mock.Mock()
+        TransferJob.objects.filter(pk=job.pk).update(lease_owner='worker-2')
+        self.assertFalse(run_job(job, drive, 60))
+        drive.delete_folder.assert_not_called()
+
+        TransferJob.objects.filter(pk=job.pk).update(lease_owner='worker-1')
+        self.assertTrue(run_job(job, drive, 60))
+        drive.delete_folder.assert_called_once_with('F1')
+        self.assertFalse(FolderEntry.objects.filter(pk=folder.pk).exists())
+
+    def test_expired_lease_on_the_last_attempt_fails_the_job(self):
+        self.create_job(max_attempts=1)
+        job = TransferJob.claim('worker-1', 60)
+        self.expire(job)
+        self.assertIsNone(TransferJob.claim('worker-2', 60))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.error, job.attempts), (TransferJob.FAILED, 'Worker lease expired', 1))
+
+
+def _change(file_id, name=None, parents=(), mime_type='text/plain', **fields):
+    item = {'id': file_id, 'name': name or file_id, 'mimeType': mime_type, 'parents': list(parents)}
+    item.update(fields)
+    return {'changeType': 'file', 'fileId': file_id, 'file': item}
+
+
+class ApplyChangesTests(TestCase):
+    root = 'ROOT'
+
+    def setUp(self):
+        self.user = User.objects.create_user('carol')
+
+    def create_file(self, drive_file_id, folder=None, **fields):
+        return FileEntry.objects.create(user=self.user, file_name=drive_file_id, file_size=1, file_type='text/plain',
+                                        drive_file_id=drive_file_id, folder=folder, **fields)
+
+    def apply(self, changes, drive_service=None):
+        return apply_changes(self.user, self.root, changes, drive_service=drive_service)
+
+    def test_new_items_inside_the_tree_are_added(self):
+        applied = self.apply([
+            _change('F2', parents=['A'], size='5'),
+            _change('A', parents=[self.root], mime_type=FOLDER_MIME_TYPE),
+            _change('B', parents=['A'], mime_type=FOLDER_MIME_TYPE),
+            _change('F1', parents=[self.root], size='3', md5Checksum='abc'),
+            _change('OUT', parents=['elsewhere']),
+        ], drive_service=mock.Mock(iter_children=mock.Mock(return_value=[])))
+        self.assertEqual(applied, 4)
+        folder_a = FolderEntry.objects.get(drive_folder_id='A')
+        folder_b = FolderEntry.objects.get(drive_folder_id='B')
+        self.assertEqual((folder_a.path, folder_a.depth), (f'/{folder_a.pk}/', 0))
+        self.assertEqual((folder_b.path, folder_b.depth, folder_b.parent_folder_id), (f'/{folder_a.pk}/{folder_b.pk}/', 1, folder_a.pk))
+        self.assertEqual(FileEntry.objects.get(drive_file_id='F2').folder_id, folder_a.pk)
+        f1 = FileEntry.objects.get(drive_file_id='F1')
+        self.assertEqual((f1.folder_id, f1.file_size, f1.md5_checksum), (None, 3, 'abc'))
+        self.assertFalse(FileEntry.objects.filter(drive_file_id='OUT').exists())
+
+    def test_any_parent_inside_the_tree_counts(self):
+        self.apply([_change('F1', parents=['elsewhere', self.root])])
+        self.assertTrue(FileEntry.objects.filter(drive_file_id='F1').exists())
+
+    def test_removed_and_trashed_items_are_deleted(self):
+        folder = FolderEntry.objects.create(user=self.user, folder_name='A', drive_folder_id='A')
+        self.create_file('F1', folder=folder)
+        self.create_file('F2')
+        applied = self.apply([
+            {'changeType': 'file', 'fileId': 'A', 'removed': True},
+            _change('F2', parents=[self.root], trashed=True),
+        ])
+        self.assertEqual(applied, 2)
+        self.assertFalse(FolderEntry.objects.exists())
+        self.assertFalse(FileEntry.objects.exists())
+
+    def test_items_moved_out_of_the_tree_are_deleted(self):
+        FolderEntry.objects.create(user=self.user, folder_name='A', drive_folder_id='A')
+        self.create_file('F1')
+        self.apply([
+            _change('A', parents=['elsewhere'], mime_type=FOLDER_MIME_TYPE),
+            _change('F1', parents=['elsewhere']),
+        ])
+        self.assertFalse(FolderEntry.objects.exists())
+        self.assertFalse(FileEntry.objects.exists())
+
+    def test_last_change_for_an_item_wins(self):
+        self.apply([
+            _change('F1', name='old.txt', parents=[self.root]),
+            _change('F1', name='new.txt', parents=[self.root]),
+        ])
+        self.assertEqual(list(FileEntry.objects.values_list('file_name', flat=True)), ['new.txt'])
+
+    def test_existing_file_is_updated_in_place(self):
+        folder = FolderEntry.objects.create(user=self.user, folder_name='A', drive_folder_id='A')
+        entry = self.create_file('F1', description='uploaded')
+        self.assertEqual(self.apply([_change('F1', name='renamed.txt', parents=['A'], size='7')]), 1)
+        entry.refresh_from_db()
+        self.assertEqual((entry.file_name, entry.file_size, entry.folder_id, entry.description),
+                         ('renamed.txt', 7, folder.pk, 'uploaded'))
+        self.assertEqual(FileEntry.objects.count(), 1)
+        # Nothing changed, so nothing is written
+        self.assertEqual(self.apply([_change('F1', name='renamed.txt', parents=['A'], size='7')]), 0)
+
+    def test_folder_rename_and_move(self):
+        folder_a = FolderEntry.objects.create(user=self.user, folder_name='A', drive_folder_id='A')
+        folder_b = FolderEntry.objects.create(user=self.user, folder_name='B', drive_folder_id='B')
+        self.apply([_change('B', name='Renamed', parents=['A'], mime_type=FOLDER_MIME_TYPE)])
+        folder_b.refresh_from_db()
+        self.assertEqual((folder_b.folder_name, folder_b.parent_folder_id), ('Renamed', folder_a.pk))
+        self.assertEqual((folder_b.path, folder_b.depth), (f'/{folder_a.pk}/{folder_b.pk}/', 1))
+
+    def test_contents_of_a_folder_moved_in_are_imported(self):
+        listings = {
+            'MOVED': [
+                {'id': 'INNER', 'name': 'inner', 'mimeType': FOLDER_MIME_TYPE},
+                {'id': 'F1', 'name': 'one.txt', 'mimeType': 'text/plain', 'size': '4'},
+            ],
+            'INNER': [{'id': 'F2', 'name': 'two.txt', 'mimeType': 'text/plain', 'size': '2'}],
+        }
+        drive_service = mock.Mock()
+        drive_service.iter_children.side_effect = lambda folder_id, **kwargs: listings.get(folder_id, [])
+
+        applied = self.apply([_change('MOVED', parents=[self.root], mime_type=FOLDER_MIME_TYPE)], drive_service=drive_service)
+
+        self.assertEqual(applied, 4)
+        inner = FolderEntry.objects.get(drive_folder_id='INNER')
+        self.assertEqual(inner.parent_folder.drive_folder_id, 'MOVED')
+        self.assertEqual(inner.depth, 1)
+        self.assertEqual(FileEntry.objects.get(drive_file_id='F1').folder.drive_folder_id, 'MOVED')
+        self.assertEqual(FileEntry.objects.get(drive_file_id='F2').folder_id, inner.pk)
+
+    def test_changes_to_the_root_folder_are_ignored(self):
+        self.assertEqual(self.apply([_change(self.root, parents=['elsewhere'], mime_type=FOLDER_MIME_TYPE)]), 0)
+
+
+class _FakeDriveResponse:
+    """Just enough of a requests.Response for DriveDownload."""
+
+    def __init__(self, status_code, content=b'', headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+        self.url = 'https://drive.test/file'
+        self.bytes_read = 0
+        self.closed = False
+
+    def iter_content(self, block_size):
+        for offset in range(0, len(self.content), block_size):
+            block = self.content[offset:offset + block_size]
+            self.bytes_read += len(block)
+            yield block
+
+    def close(self):
+        self.closed = True
+
+
+class _FakeDriveSession:
+    """Serves one file, honouring Range headers unless ignore_ranges is set."""
+
+    def __init__(self, data, ignore_ranges=False):
+        self.data = data
+        self.ignore_ranges = ignore_ranges
+        self.responses = []
+
+    def get(self, uri, headers=None, stream=False, timeout=None):
+        first, _, last = headers['Range'].removeprefix('bytes=').partition('-')
+        first, last = int(first), min(int(last), len(self.data) - 1)
+        if self.ignore_ranges:
+            response = _FakeDriveResponse(200, self.data, {'content-length': str(len(self.data))})
+        elif first >= len(self.data):
+            response = _FakeDriveResponse(416)
+        else:
+            response = _FakeDriveResponse(206, self.data[first:last + 1],
+                                          {'content-range': f'bytes {first}-{last}/{len(self.data)}'})
+        self.responses.append(response)
+        return response
+
+
+class DriveDownloadTests(SimpleTestCase):
+    data = bytes(range(256)) * 400
+
+    def test_ranged_chunks(self):
+        session = _FakeDriveSession(self.data)
+        download = DriveDownload(session, 'uri', 0, None, 10000).open()
+        self.assertEqual(download.length, len(self.data))
+        self.assertEqual(b''.join(download), self.data)
+        self.assertEqual(len(session.responses), 11)
+
+    def test_byte_range(self):
+        session = _FakeDriveSession(self.data)
+        download = DriveDownload(session, 'uri', 1000, 25999, 10000).open()
+        self.assertEqual(b''.join(download), self.data[1000:26000])
+        self.assertEqual(len(session.responses), 3)
+
+    def test_empty_file(self):
+        download = DriveDownload(_FakeDriveSession(b''), 'uri', 0, None, 10000).open()
+        self.assertEqual(b''.join(download), b'')
+
+    def test_reply_ignoring_the_range_is_streamed_once(self):
+        session = _FakeDriveSession(self.data, ignore_ranges=True)
+        download = DriveDownload(session, 'uri', 5000, 60000, 1000).open()
+        response = session.responses[0]
+        # Only what was needed for the first chunk has been read so far
+        self.assertLess(response.bytes_read, 6000 + STREAM_BLOCK_SIZE)
+        self.assertEqual(download.length, 55001)
+        self.assertEqual(b''.join(download), self.data[5000:60001])
+        self.assertEqual(len(session.responses), 1)
+        self.assertTrue(response.closed)
+
+    def test_close_releases_the_reply(self):
+        session = _FakeDriveSession(self.data, ignore_ranges=True)
+        download = DriveDownload(session, 'uri', 0, None, 1000).open()
+        next(iter(download))
+        download.close()
+        self.assertTrue(session.responses[0].closed)
+
+
+class AsyncDriveDownloadTests(SimpleTestCase):
+    data = bytes(range(256)) * 400
+
+    def download(self, start, end, ignore_ranges=False):
+        requests = []
+
+        def handler(request):
+            requests.append(request)
+            if ignore_ranges:
+                return httpx.Response(200, content=self.data)
+            first, _, last = request.headers['range'].removeprefix('bytes=').partition('-')
+            first, last = int(first), min(int(last), len(self.data) - 1)
+            return httpx.Response(206, content=self.data[first:last + 1],
+                                  headers={'content-range': f'bytes {first}-{last}/{len(self.data)}'})
+
+        async def fetch():
+            async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+                with mock.patch.object(transport, 'client', return_value=client), \
+                        mock.patch.object(transport, 'auth_headers', mock.AsyncMock(return_value={})):
+                    download = await AsyncDriveDownload('https://drive.test/file', start, end, 1000).open()
+                    return download.length, b''.join([chunk async for chunk in download])
+
+        return asyncio.run(fetch()), requests
+
+    def test_ranged_chunks(self):
+        (length, body), requests = self.download(500, 4499)
+        self.assertEqual((length, body), (4000, self.data[500:4500]))
+        self.assertEqual(len(requests), 4)
+
+    def test_reply_ignoring_the_range_is_streamed_once(self):
+        (length, body), requests = self.download(5000, None, ignore_ranges=True)
+        self.assertEqual((length, body), (len(self.data) - 5000, self.data[5000:]))
+        self.assertEqual(len(requests), 1)
+
+
+class _FakeResumableDrive:
+    """Records what a DriveStreamingUploadHandler sends to a resumable session."""
+
+    def __init__(self, commit_limit=None, fail=False):
+        self.commit_limit = commit_limit
+        self.fail = fail
+        self.received = bytearray()
+        self.puts = []
+        self.deleted = []
+
+    def start_resumable_session(self, file_name, parent_folder_id, mime_type=None, size=None):
+        return 'https://drive.test/session'
+
+    def upload_session_chunk(self, session_uri, data, offset, total_size=None):
+        self.puts.append((offset, len(data), total_size))
+        if self.fail:
+            raise IOError('Drive went away')
+        # Drive may commit only part of a chunk
+        data = bytes(data[:self.commit_limit]) if self.commit_limit else bytes(data)
+        del self.received[offset:]
+        self.received.extend(data)
+        next_offset = offset + len(data)
+        if total_size is not None and next_offset == total_size:
+            return next_offset, {'id': 'STREAMED'}
+        return next_offset, None
+
+    def delete_file(self, file_id):
+        self.deleted.append(file_id)
+        return True
+
+
+class DriveStreamingUploadHandlerTests(SimpleTestCase):
+    data = b'abcdefghij'
+
+    def stream(self, drive_service, parts, parent_folder_id='ROOT'):
+        handler = DriveStreamingUploadHandler(None, parent_folder_id)
+        handler.drive_service = drive_service
+        handler.drive_chunk_size = 4
+        try:
+            handler.new_file('file', 'a.txt', 'text/plain', len(self.data))
+        except StopFutureHandlers:
+            pass
+        offset = 0
+        for part in parts:
+            self.assertIsNone(handler.receive_data_chunk(part, offset))
+            offset += len(part)
+        return handler.file_complete(offset)
+
+    def test_aligned_chunks_are_sent_as_they_arrive(self):
+        drive_service = _FakeResumableDrive()
+        uploaded = self.stream(drive_service, [b'abcdef', b'ghij'])
+        self.assertEqual(drive_service.puts, [(0, 4, None), (4, 4, None), (8, 2, 10)])
+        self.assertEqual(bytes(drive_service.received), self.data)
+        self.assertEqual((uploaded.drive_file_id, uploaded.drive_parent_id, uploaded.size), ('STREAMED', 'ROOT', 10))
+        self.assertEqual(uploaded.md5_checksum, hashlib.md5(self.data).hexdigest())
+
+    def test_uncommitted_bytes_are_sent_again(self):
+        drive_service = _FakeResumableDrive(commit_limit=3)
+        uploaded = self.stream(drive_service, [b'abcdef', b'ghij'])
+        self.assertEqual(uploaded.drive_file_id, 'STREAMED')
+        self.assertEqual(bytes(drive_service.received), self.data)
+
+    def test_failed_session_yields_no_file_id(self):
+        drive_service = _FakeResumableDrive(fail=True)
+        uploaded = self.stream(drive_service, [b'abcdef', b'ghij'])
+        self.assertIsNone(uploaded.drive_file_id)
+        self.assertEqual(uploaded.md5_checksum, '')
+        # Nothing more is sent after the first failure
+        self.assertEqual(len(drive_service.puts), 1)
+
+    def test_without_a_folder_parts_fall_through(self):
+        handler = DriveStreamingUploadHandler(None, None)
+        handler.new_file('file', 'a.txt', 'text/plain', len(self.data))
+        self.assertEqual(handler.receive_data_chunk(self.data, 0), self.data)
+        self.assertIsNone(handler.file_complete(len(self.data)))
+
+
+@override_settings(GOOGLE_DRIVE_STREAMING_UPLOADS=True, GOOGLE_DRIVE_BACKGROUND_TRANSFERS=False)
+class StreamingUploadViewTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('dana', password='secret')
+        self.user.profile.is_approved = True
+        self.user.profile.drive_folder_id = 'ROOT'
+        self.user.profile.save()
+        self.client.force_login(self.user)
+        self.drive_service = _FakeResumableDrive()
+        for target in ('ftp.upload_handlers.GoogleDriveService', 'ftp.views.GoogleDriveService'):
+            patcher = mock.patch(target, return_value=self.drive_service)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def post(self, **data):
+        upload = SimpleUploadedFile('a.txt', b'streamed content', content_type='text/plain')
+        return self.client.post(reverse('upload_file'), {'file': upload, **data})
+
+    def test_streamed_file_is_recorded(self):
+        response = self.post()
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(FileEntry.objects.get(user=self.user).drive_file_id, 'STREAMED')
+        self.assertEqual(self.drive_service.deleted, [])
+
+    def test_rejected_request_deletes_what_was_streamed(self):
+        response = self.post(parent_folder='999')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.drive_service.deleted, ['STREAMED'])
+        self.assertFalse(FileEntry.objects.exists())
+
+
+@mock.patch('ftp.transfers.GoogleDriveService', mock.Mock)
+class RunDriveTasksTests(SimpleTestCase):
+    def test_results_keep_task_order_and_failures_become_none(self):
+        def fail(drive_service):
+            raise IOError('boom')
+        tasks = [lambda drive_service, n=n: n * 10 for n in range(5)]
+        tasks.insert(2, fail)
+        self.assertEqual(run_drive_tasks(tasks, max_workers=3), [0, 10, None, 20, 30, 40])
+
+    def test_single_task_runs_inline_on_the_given_service(self):
+        drive_service = object()
+        results = run_drive_tasks([lambda service: (service, threading.get_ident())], drive_service=drive_service)
+        self.assertEqual(results, [(drive_service, threading.get_ident())])
+        results = run_drive_tasks([lambda service: threading.get_ident()] * 3, max_workers=1, drive_service=drive_service)
+        self.assertEqual(set(results), {threading.get_ident()})
+
+    def test_threads_are_reused_across_calls(self):
+        idents = set()
+        for _ in range(3):
+            idents.update(run_drive_tasks([lambda service: threading.get_ident()] * 8, max_workers=4))
+        self.assertLessEqual(len(idents), 4)
+        self.assertNotIn(threading.get_ident(), idents)
+        self.assertIs(transfers._executor(4), transfers._executor(4))
+
+    def test_concurrency_is_bounded_by_the_width(self):
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def task(drive_service):
+            with lock:
+                running[0] += 1
+                running[1] = max(running[1], running[0])
+            time.sleep(0.02)
+            with lock:
+                running[0] -= 1
+
+        run_drive_tasks([task] * 8, max_workers=2)
+        self.assertEqual(running[1], 2)
+
+    def test_forked_process_gets_new_executors(self):
+        executor = transfers._executor(3)
+        with mock.patch.object(transfers, '_executors_pid', -1):
+            self.assertIsNot(transfers._executor(3), executor)
+
+
+def _http_404():
+    return HttpError(httplib2.Response({'status': 404}), b'{"error": {"message": "File not found"}}')
+
+
+class FolderCacheTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch('ftp.gdrive.pool')
+        self.addCleanup(patcher.stop)
+        self.api = patcher.start().get_service.return_value
+        self.drive = GoogleDriveService()
+        self.drive._create_with_media = mock.Mock(return_value={'id': 'new-file'})
+        self.media = mock.Mock()
+
+    def test_known_parent_skips_the_existence_check(self):
+        remember_folder('folder-1')
+        self.assertEqual(self.drive._upload_media(self.media, 'a.txt', 'folder-1'), 'new-file')
+        self.api.files.return_value.get.assert_not_called()
+        self.assertEqual(self.drive._create_with_media.call_args.args[2], 'folder-1')
+
+    def test_unknown_parent_is_checked_and_remembered(self):
+        self.api.files.return_value.get.return_value.execute.return_value = {'id': 'folder-1', 'name': 'f'}
+        self.drive._upload_media(self.media, 'a.txt', 'folder-1')
+        self.api.files.return_value.get.assert_called_once_with(fileId='folder-1', fields='id,name')
+        self.assertTrue(is_known_folder('folder-1'))
+
+    def test_stale_cached_parent_is_forgotten_and_upload_retried(self):
+        remember_folder('folder-1')
+        set_fallback_root('fallback')
+        self.api.files.return_value.get.return_value.execute.side_effect = _http_404()
+        self.drive._create_with_media.side_effect = [_http_404(), {'id': 'new-file'}]
+
+        self.assertEqual(self.drive._upload_media(self.media, 'a.txt', 'folder-1'), 'new-file')
+
+        self.assertFalse(is_known_folder('folder-1'))
+        self.assertEqual([call.args[2] for call in self.drive._create_with_media.call_args_list], ['folder-1', 'fallback'])
+
+    def test_404_for_a_checked_parent_is_not_retried(self):
+        self.api.files.return_value.get.return_value.execute.return_value = {'id': 'folder-1', 'name': 'f'}
+        self.drive._create_with_media.side_effect = _http_404()
+        with self.assertRaises(HttpError):
+            self.drive._upload_media(self.media, 'a.txt', 'folder-1')
+        self.assertEqual(self.drive._create_with_media.call_count, 1)
+
+    def test_forgetting_the_fallback_root_clears_it(self):
+        set_fallback_root('fallback')
+        forget_folder('fallback')
+        self.assertIsNone(get_fallback_root())
+        self.assertFalse(is_known_folder('fallback'))
+
+    def test_deleting_a_folder_forgets_it(self):
+        remember_folder('folder-1')
+        self.assertTrue(self.drive.delete_folder('folder-1'))
+        self.assertFalse(is_known_folder('folder-1'))
+
+
+def _http_error(status, reason=None):
+    content = json.dumps({'error': {'errors': [{'reason': reason}] if reason else []}}).encode()
+    return HttpError(httplib2.Response({'status': status}), content)
+
+
+class _FakeBatchDrive:
+    """Drive service whose batch requests answer from a script of errors per item."""
+
+    def __init__(self, errors=None, permissions=None):
+        # item_id -> list of exceptions raised by successive calls; then success
+        self.errors = {item_id: list(queue) for item_id, queue in (errors or {}).items()}
+        self.listed = permissions or {}
+        self.batches = []
+        self.service = self
+
+    def permissions(self):
+        return self
+
+    def create(self, fileId, **kwargs):
+        return ('create', fileId)
+
+    def list(self, fileId, **kwargs):
+        return ('list', fileId)
+
+    def delete(self, fileId, permissionId):
+        return ('delete', fileId)
+
+    def new_batch_http_request(self, callback):
+        return _FakeBatch(self, callback)
+
+
+class _FakeBatch:
+    def __init__(self, drive, callback):
+        self.drive = drive
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request, request_id))
+
+    def execute(self):
+        self.drive.batches.append([request for request, _ in self.requests])
+        for (method, item_id), request_id in self.requests:
+            queue = self.drive.errors.get(item_id)
+            if queue:
+                self.callback(request_id, None, queue.pop(0))
+            elif method == 'list':
+                self.callback(request_id, {'permissions': self.drive.listed.get(item_id, [])}, None)
+            else:
+                self.callback(request_id, {'id': f'perm-{item_id}'} if method == 'create' else '', None)
+
+
+@mock.patch('ftp.sharing.backoff_delay', mock.Mock(return_value=0))
+class SharingTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('carol')
+        self.user.profile.drive_folder_id = 'root'
+        self.user.profile.save()
+        for index in range(3):
+            FileEntry.objects.create(user=self.user, file_name=f'file{index}', file_size=1,
+                                     file_type='text/plain', drive_file_id=f'D{index}')
+
+    def test_items_are_sent_in_batches_of_the_drive_limit(self):
+        drive = _FakeBatchDrive()
+        item_ids = [f'F{index}' for index in range(250)]
+        self.assertEqual(share_items(drive, item_ids, 'x@example.com'), 250)
+        self.assertEqual([len(batch) for batch in drive.batches], [100, 100, 50])
+
+    def test_rate_limited_calls_are_retried_in_a_later_batch(self):
+        drive = _FakeBatchDrive(errors={'F1': [_http_error(403, 'userRateLimitExceeded'), _http_error(503)]})
+        self.assertEqual(share_items(drive, ['F0', 'F1', 'F2'], 'x@example.com', strict=True), 3)
+        self.assertEqual([len(batch) for batch in drive.batches], [3, 1, 1])
+
+    def test_strict_sharing_raises_with_the_items_that_failed(self):
+        drive = _FakeBatchDrive(errors={'F1': [_http_error(403, 'insufficientFilePermissions')], 'F2': [_http_error(404)]})
+        # Lenient callers just get the count
+        self.assertEqual(share_items(drive, ['F0', 'F1', 'F2'], 'x@example.com'), 1)
+
+        drive = _FakeBatchDrive(errors={'F1': [_http_error(403, 'insufficientFilePermissions')], 'F2': [_http_error(404)]})
+        with self.assertRaises(SharingError) as raised:
+            share_items(drive, ['F0', 'F1', 'F2'], 'x@example.com', strict=True)
+        # Items deleted from Drive are not worth retrying
+        self.assertEqual(raised.exception.item_ids, ['F1'])
+
+    def test_retries_run_out(self):
+        drive = _FakeBatchDrive(errors={'F0': [_http_error(500)] * 10})
+        with self.settings(GOOGLE_DRIVE_MAX_RETRIES=2):
+            with self.assertRaises(SharingError):
+                share_items(drive, ['F0'], 'x@example.com', strict=True)
+        self.assertEqual(len(drive.batches), 3)
+
+    def test_update_moves_the_tree_to_the_new_email(self):
+        drive = _FakeBatchDrive(permissions={
+            'root': [{'id': 'p1', 'emailAddress': 'Old@example.com'}],
+            'D1': [{'id': 'p2', 'emailAddress': 'someone@example.com'}],
+        })
+        self.assertEqual(update_user_sharing(self.user, 'old@example.com', 'new@example.com', drive_service=drive), (1, 4))
+        self.assertEqual(drive.batches[1], [('delete', 'root')])
+
+    def test_failed_sharing_job_is_retried(self):
+        job = TransferJob.objects.create(user=self.user, kind=TransferJob.KIND_UPDATE_SHARING,
+                                         payload={'old_email': '', 'new_email': 'new@example.com'})
+        job = TransferJob.claim('worker', 60)
+        drive = _FakeBatchDrive(errors={'D2': [_http_error(403, 'insufficientFilePermissions')]})
+        self.assertFalse(run_job(job, drive, 60))
+        job.refresh_from_db()
+        self.assertEqual(job.status, TransferJob.QUEUED)
+        self.assertEqual(job.error, 'Sharing with new@example.com failed for 1 items')
+
+        TransferJob.objects.filter(pk=job.pk).update(available_at=timezone.now())
+        job = TransferJob.claim('worker', 60)
+        self.assertTrue(run_job(job, _FakeBatchDrive(), 60))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.result), (TransferJob.SUCCEEDED, {'unshared': 0, 'shared': 4}))
+
+    def test_heartbeat_runs_after_every_batch(self):
+        heartbeat = mock.Mock()
+        share_items(_FakeBatchDrive(), [f'F{index}' for index in range(250)], 'x@example.com', heartbeat=heartbeat)
+        self.assertEqual(heartbeat.call_count, 3)
+
+    def test_sharing_job_stops_when_its_lease_is_lost(self):
+        TransferJob.objects.create(user=self.user, kind=TransferJob.KIND_UPDATE_SHARING,
+                                   payload={'old_email': 'old@example.com', 'new_email': 'new@example.com'})
+        job = TransferJob.claim('worker-1', 60)
+        TransferJob.objects.filter(pk=job.pk).update(lease_owner='worker-2')
+        drive = _FakeBatchDrive()
+        self.assertFalse(run_job(job, drive, 60))
+        # The permissions were listed, but nothing was changed
+        self.assertEqual(len(drive.batches), 1)
+        self.assertEqual({method for method, _ in drive.batches[0]}, {'list'})
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.lease_owner), (TransferJob.RUNNING, 'worker-2'))
+
+
+class _FakeSessionDrive(_FakeResumableDrive):
+    """A resumable session that can break after some chunks and be queried for its offset."""
+
+    def __init__(self, fail_after=None, error=ConnectionError, **kwargs):
+        super().__init__(**kwargs)
+        self.fail_after = fail_after
+        self.error = error
+        self.sessions = []
+        self.expired = False
+
+    def start_resumable_session(self, file_name, parent_folder_id, mime_type=None, size=None):
+        self.sessions.append(f'https://drive.test/session/{len(self.sessions)}')
+        del self.received[:]
+        return self.sessions[-1]
+
+    def upload_session_chunk(self, session_uri, data, offset, total_size=None):
+        if self.fail_after is not None and len(self.puts) >= self.fail_after:
+            self.fail_after = None
+            raise self.error('connection reset')
+        return super().upload_session_chunk(session_uri, data, offset, total_size)
+
+    def query_session_offset(self, session_uri, total_size):
+        if self.expired:
+            return None
+        return len(self.received), ({'id': 'STREAMED'} if len(self.received) == total_size else None)
+
+
+@override_settings(GOOGLE_DRIVE_ADAPTIVE_CHUNKS=False, GOOGLE_DRIVE_UPLOAD_CHUNK_SIZE=256 * 1024)
+@mock.patch('ftp.resumable.backoff_delay', mock.Mock(return_value=0))
+class ResumableUploadTests(TestCase):
+    def setUp(self):
+        self.data = os.urandom(700 * 1024)
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.data)
+        self.addCleanup(os.remove, self.path)
+
+    def upload(self, drive, **kwargs):
+        return upload_path_resumable(drive, self.path, 'big.bin', 'folder-1', **kwargs)
+
+    def test_upload_sends_every_chunk_and_forgets_the_session(self):
+        drive = _FakeSessionDrive()
+        progress = mock.Mock()
+        self.assertEqual(self.upload(drive, progress_callback=progress), {'id': 'STREAMED'})
+        self.assertEqual(bytes(drive.received), self.data)
+        self.assertEqual([put[0] for put in drive.puts], [0, 262144, 524288])
+        self.assertEqual(progress.call_args_list[-1], mock.call(len(self.data), len(self.data)))
+        self.assertFalse(UploadSession.objects.exists())
+
+    def test_interrupted_upload_resumes_at_the_committed_offset(self):
+        drive = _FakeSessionDrive(fail_after=1, error=ValueError)
+        with self.assertRaises(ValueError):
+            self.upload(drive)
+        session = UploadSession.objects.get()
+        self.assertEqual((session.session_uri, session.bytes_confirmed), (drive.sessions[0], 262144))
+
+        # A second attempt, e.g. by another worker, sends only what is missing
+        self.assertEqual(self.upload(drive), {'id': 'STREAMED'})
+        self.assertEqual(len(drive.sessions), 1)
+        self.assertEqual([put[0] for put in drive.puts[1:]], [262144, 524288])
+        self.assertEqual(bytes(drive.received), self.data)
+        self.assertFalse(UploadSession.objects.exists())
+
+    def test_transient_error_asks_drive_where_to_continue(self):
+        drive = _FakeSessionDrive(fail_after=1, commit_limit=100 * 1024)
+        self.assertEqual(self.upload(drive), {'id': 'STREAMED'})
+        self.assertEqual(bytes(drive.received), self.data)
+        self.assertEqual(len(drive.sessions), 1)
+
+    def test_expired_session_starts_over(self):
+        drive = _FakeSessionDrive(fail_after=1, error=ValueError)
+        with self.assertRaises(ValueError):
+            self.upload(drive)
+        drive.expired = True
+        self.assertEqual(self.upload(drive), {'id': 'STREAMED'})
+        self.assertEqual(len(drive.sessions), 2)
+        self.assertEqual(bytes(drive.received), self.data)
+
+    def test_saved_session_for_another_target_is_not_reused(self):
+        drive = _FakeSessionDrive(fail_after=1, error=ValueError)
+        with self.assertRaises(ValueError):
+            self.upload(drive)
+        upload_path_resumable(drive, self.path, 'big.bin', 'folder-2')
+        self.assertEqual(len(drive.sessions), 2)
+
+    def test_expired_and_discarded_sessions_are_removed(self):
+        drive = _FakeSessionDrive(fail_after=1, error=ValueError)
+        with self.assertRaises(ValueError):
+            self.upload(drive)
+        UploadSession.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(UploadSession.purge_expired(), 1)
+
+        with self.assertRaises(ValueError):
+            self.upload(_FakeSessionDrive(fail_after=1, error=ValueError))
+        discard_sessions(self.path)
+        self.assertFalse(UploadSession.objects.exists())
+
+
+@override_settings(GOOGLE_DRIVE_ADAPTIVE_CHUNKS=True, GOOGLE_DRIVE_UPLOAD_CHUNK_SIZE=8 * MB,
+                   GOOGLE_DRIVE_DOWNLOAD_CHUNK_SIZE=4 * MB, GOOGLE_DRIVE_TARGET_CHUNK_SECONDS=2.0,
+                   GOOGLE_DRIVE_MAX_CHUNK_SIZE=64 * MB, GOOGLE_DRIVE_SIMPLE_UPLOAD_MAX=5 * MB)
+class TransferTunerTests(SimpleTestCase):
+    def setUp(self):
+        self.tuner = TransferTuner()
+
+    def test_configured_sizes_until_measured(self):
+        self.assertEqual(self.tuner.chunk_size(UPLOAD), 8 * MB)
+        self.assertEqual(self.tuner.chunk_size(DOWNLOAD), 4 * MB)
+
+    def test_chunk_takes_the_target_time_at_the_measured_rate(self):
+        self.tuner.record_transfer(UPLOAD, 10 * MB, 1.0)
+        self.assertEqual(self.tuner.chunk_size(UPLOAD), 20 * MB)
+        # Directions are tuned separately
+        self.assertEqual(self.tuner.chunk_size(DOWNLOAD), 4 * MB)
+
+    def test_chunk_sizes_are_aligned_and_capped(self):
+        self.tuner.record_transfer(UPLOAD, 1000 * 1000, 1.0)
+        self.assertEqual(self.tuner.chunk_size(UPLOAD) % CHUNK_ALIGNMENT, 0)
+        self.tuner.record_transfer(DOWNLOAD, 1, 10.0)
+        self.assertEqual(self.tuner.chunk_size(DOWNLOAD), CHUNK_ALIGNMENT)
+        self.tuner.reset()
+        self.tuner.record_transfer(UPLOAD, 1000 * MB, 1.0)
+        self.assertEqual(self.tuner.chunk_size(UPLOAD), 64 * MB)
+
+    def test_round_trip_time_sets_a_longer_target_and_is_taken_out_of_throughput(self):
+        self.tuner.record_rtt(0.5)
+        # 1.5 of the 2 seconds were spent transferring
+        self.tuner.record_transfer(UPLOAD, 3 * MB, 2.0)
+        self.assertEqual(self.tuner.snapshot()['upload_bytes_per_second'], 2 * MB)
+        # A chunk should take ten round trips, 5 seconds
+        self.assertEqual(self.tuner.chunk_size(UPLOAD), 10 * MB)
+
+    def test_measurements_are_smoothed(self):
+        self.tuner.record_transfer(UPLOAD, 10 * MB, 1.0)
+        self.tuner.record_transfer(UPLOAD, 20 * MB, 1.0)
+        self.assertEqual(self.tuner.snapshot()['upload_bytes_per_second'], 13 * MB)
+        self.assertEqual(self.tuner.snapshot()['upload_samples'], 2)
+
+    @override_settings(GOOGLE_DRIVE_ADAPTIVE_CHUNKS=False)
+    def test_disabled_tuning_keeps_the_configured_size(self):
+        self.tuner.record_transfer(UPLOAD, 10 * MB, 1.0)
+        self.assertEqual(self.tuner.chunk_size(UPLOAD), 8 * MB)
+
+    def test_upload_mode(self):
+        self.assertFalse(self.tuner.use_resumable(5 * MB))
+        self.assertEqual(self.tuner.snapshot()['last_upload'], {'size': 5 * MB, 'mode': 'multipart'})
+        self.assertTrue(self.tuner.use_resumable(5 * MB + 1))
+        self.tuner.note_unknown_size()
+        self.assertEqual(self.tuner.snapshot()['last_upload'], {'size': None, 'mode': 'resumable'})
+
+    def test_timed_block_records_the_transfer(self):
+        with mock.patch('ftp.tuning.time.monotonic', side_effect=[100.0, 101.0]):
+            with self.tuner.timed(DOWNLOAD) as timing:
+                timing.nbytes = 3 * MB
+        self.assertEqual(self.tuner.snapshot()['download_bytes_per_second'], 3 * MB)
+
+
+class _Flaky:
+    """Callable that raises the given errors in turn, then returns 'done'."""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'done'
+
+
+@override_settings(GOOGLE_DRIVE_RATE_LIMIT=None, GOOGLE_DRIVE_MAX_RETRIES=3,
+                   GOOGLE_DRIVE_RETRY_BASE_DELAY=1.0, GOOGLE_DRIVE_RETRY_MAX_DELAY=8.0)
+class RetryTests(SimpleTestCase):
+    def test_error_classification(self):
+        self.assertTrue(is_rate_limited(_http_error(429)))
+        self.assertTrue(is_rate_limited(_http_error(403, 'userRateLimitExceeded')))
+        self.assertFalse(is_rate_limited(_http_error(403, 'insufficientFilePermissions')))
+        self.assertFalse(is_rate_limited(ConnectionError()))
+        self.assertTrue(is_retryable(_http_error(503)))
+        self.assertTrue(is_retryable(_http_error(403, 'rateLimitExceeded')))
+        self.assertFalse(is_retryable(_http_error(404)))
+        self.assertTrue(is_retryable(ConnectionResetError()))
+        self.assertTrue(is_retryable(httpx.ConnectTimeout('slow')))
+        self.assertFalse(is_retryable(ValueError()))
+
+    def test_backoff_grows_to_the_cap_and_honours_retry_after(self):
+        with mock.patch('ftp.retry.random.uniform', side_effect=lambda low, high: high):
+            self.assertEqual([backoff_delay(attempt) for attempt in range(1, 6)], [1.0, 2.0, 4.0, 8.0, 8.0])
+            error = HttpError(httplib2.Response({'status': 429, 'retry-after': '20'}), b'')
+            self.assertEqual(retry_after(error), 20.0)
+            self.assertEqual(backoff_delay(1, error), 20.0)
+
+    @mock.patch('ftp.retry.time.sleep')
+    def test_retryable_errors_are_retried_within_one_traced_call(self, sleep):
+        fn = _Flaky(_http_error(429), ConnectionResetError())
+        with start_trace() as trace:
+            self.assertEqual(call_with_retries(fn, 'Drive files.get'), 'done')
+        self.assertEqual((fn.calls, sleep.call_count), (3, 2))
+        self.assertEqual(len(trace), 1)
+        self.assertEqual((trace.calls[0].retries, trace.calls[0].rate_limited), (2, 1))
+
+    @mock.patch('ftp.retry.time.sleep')
+    def test_other_errors_and_the_last_retry_are_raised(self, sleep):
+        fn = _Flaky(_http_error(404))
+        with self.assertRaises(HttpError):
+            call_with_retries(fn)
+        self.assertEqual(fn.calls, 1)
+
+        fn = _Flaky(*[_http_error(500)] * 10)
+        with self.assertRaises(HttpError):
+            call_with_retries(fn)
+        self.assertEqual(fn.calls, 4)
+        self.assertEqual(sleep.call_count, 3)
+
+    @mock.patch('ftp.retry.asyncio.sleep', new_callable=mock.AsyncMock)
+    def test_async_retries(self, sleep):
+        flaky = _Flaky(_http_error(502))
+
+        async def fn():
+            return flaky()
+
+        self.assertEqual(asyncio.run(acall_with_retries(fn)), 'done')
+        self.assertEqual((flaky.calls, sleep.await_count), (2, 1))
+
+
+@override_settings(GOOGLE_DRIVE_MAX_THROTTLE_WAIT=60.0)
+class RateLimiterTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.limiter = RateLimiter('test', rate=2)
+
+    @mock.patch('ftp.retry.random.uniform', mock.Mock(return_value=0))
+    @mock.patch('ftp.retry.time.time', mock.Mock(return_value=1000.25))
+    @mock.patch('ftp.retry.time.sleep')
+    def test_callers_over_the_rate_wait_for_the_next_window(self, sleep):
+        self.assertEqual(self.limiter.acquire(), 0)
+        self.assertEqual(self.limiter.acquire(), 0)
+        # The clock is frozen, so the third caller keeps waiting until it gives up
+        self.assertEqual(self.limiter.acquire(), 60.0)
+        self.assertEqual(sleep.call_args_list[0], mock.call(0.75))
+
+    def test_batches_take_one_token_per_call(self):
+        with mock.patch('ftp.retry.time.time', return_value=2000.0):
+            self.assertIsNone(self.limiter._next_pause(2, 0))
+            self.assertIsNotNone(self.limiter._next_pause(1, 0))
+
+    def test_unlimited_and_broken_cache_do_not_block(self):
+        self.assertEqual(RateLimiter('off', rate=0).acquire(), 0)
+        with mock.patch('ftp.retry.cache.add', side_effect=ConnectionError('cache down')):
+            self.assertEqual(self.limiter.acquire(), 0)
+
+    @mock.patch('ftp.retry.random.uniform', mock.Mock(return_value=0))
+    @mock.patch('ftp.retry.time.time', mock.Mock(return_value=3000.5))
+    @mock.patch('ftp.retry.time.sleep')
+    @mock.patch('ftp.retry.asyncio.sleep', new_callable=mock.AsyncMock)
+    def test_async_acquire_waits_without_blocking(self, async_sleep, sleep):
+        async def take(count):
+            return [await self.limiter.aacquire() for _ in range(count)]
+
+        with self.settings(GOOGLE_DRIVE_MAX_THROTTLE_WAIT=1.0):
+            self.assertEqual(asyncio.run(take(3)), [0, 0, 1.0])
+        self.assertEqual(async_sleep.await_args_list, [mock.call(0.5), mock.call(0.5)])
+        sleep.assert_not_called()
+
+
+class _SlowDownload:
+    """A DriveDownload stand-in that yields its bytes in small, slow chunks."""
+
+    def __init__(self, data, start, end, delay):
+        self.data = data[start:None if end is None else end + 1]
+        self.start = start
+        self.end = end
+        self.length = len(self.data)
+        self.delay = delay
+        self.closed = False
+
+    def __iter__(self):
+        for offset in range(0, len(self.data), 16 * 1024):
+            time.sleep(self.delay)
+            yield self.data[offset:offset + 16 * 1024]
+
+    def close(self):
+        self.closed = True
+
+
+class _CountingDriveService:
+    """Serves one file's metadata and downloads, counting the downloads."""
+
+    def __init__(self, data, delay=0.0, md5=None):
+        self.data = data
+        self.delay = delay
+        self.md5 = md5 or hashlib.md5(data).hexdigest()
+        self.downloads = []
+        self.lock = threading.Lock()
+
+    def get_file_metadata(self, file_id, fields=None):
+        return {'id': file_id, 'size': str(len(self.data)), 'md5Checksum': self.md5}
+
+    def download_stream(self, file_id, start=0, end=None, chunk_size=None):
+        with self.lock:
+            self.downloads.append((start, end))
+        return _SlowDownload(self.data, start, end, self.delay)
+
+
+def _cached_or_streamed(drive_service, file_id):
+    """What the download view sends for a whole-file request, as bytes."""
+    cached = download_cache.open_cached(drive_service, file_id)
+    if cached is not None:
+        with cached:
+            return cached.read()
+    return b''.join(download_cache.stream_to_cache(drive_service, file_id))
+
+
+class DownloadCacheTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        overrides = override_settings(GOOGLE_DRIVE_DOWNLOAD_CACHE_DIR=self.cache_dir,
+                                      GOOGLE_DRIVE_DOWNLOAD_CACHE_BYTES=10 * MB,
+                                      GOOGLE_DRIVE_DOWNLOAD_CACHE_FOLLOW_TIMEOUT=30)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.data = os.urandom(200 * 1024)
+
+    def files_on_disk(self):
+        return sorted(name for _, _, names in os.walk(self.cache_dir) for name in names)
+
+    def test_fill_is_renamed_into_place_once_complete(self):
+        drive = _CountingDriveService(self.data)
+        fill = download_cache.stream_to_cache(drive, 'FILE1')
+        self.assertIsInstance(fill, download_cache.CacheFill)
+        chunks = iter(fill)
+        next(chunks)
+        self.assertEqual(self.files_on_disk(), [f'.tmp-FILE1-{drive.md5}'])
+        b''.join(chunks)
+        self.assertEqual(self.files_on_disk(), [f'FILE1-{drive.md5}'])
+        self.assertEqual(_cached_or_streamed(drive, 'FILE1'), self.data)
+        self.assertEqual(len(drive.downloads), 1)
+        self.assertEqual(cache.get(download_cache.TOTAL_KEY), len(self.data))
+
+    def test_unfinished_or_corrupt_fill_is_not_cached(self):
+        drive = _CountingDriveService(self.data)
+        chunks = iter(download_cache.stream_to_cache(drive, 'FILE1'))
+        next(chunks)
+        # The client went away
+        chunks.close()
+        self.assertEqual(self.files_on_disk(), [])
+
+        drive = _CountingDriveService(self.data, md5='0' * 32)
+        self.assertEqual(b''.join(download_cache.stream_to_cache(drive, 'FILE2')), self.data)
+        self.assertEqual(self.files_on_disk(), [])
+
+    def test_concurrent_misses_download_once(self):
+        drive = _CountingDriveService(self.data, delay=0.005)
+        barrier = threading.Barrier(50)
+
+        def fetch(drive_service):
+            barrier.wait()
+            return _cached_or_streamed(drive_service, 'FILE1')
+
+        with ThreadPoolExecutor(max_workers=50) as executor:
+            results = list(executor.map(fetch, [drive] * 50))
+        self.assertEqual(results, [self.data] * 50)
+        self.assertEqual(drive.downloads, [(0, None)])
+        self.assertEqual(self.files_on_disk(), [f'FILE1-{drive.md5}'])
+
+    def test_follower_of_an_abandoned_fill_finishes_from_drive(self):
+        drive = _CountingDriveService(self.data)
+        chunks = iter(download_cache.stream_to_cache(drive, 'FILE1'))
+        first = next(chunks)
+        follower = download_cache.stream_to_cache(drive, 'FILE1')
+        self.assertIsInstance(follower, download_cache.CacheFollower)
+        self.assertEqual(follower.read_available(), first)
+        self.assertEqual(follower.read_available(), b'')
+        chunks.close()
+        self.assertEqual(first + b''.join(follower), self.data)
+        self.assertEqual(drive.downloads, [(0, None), (len(first), len(self.data) - 1)])
+
+    def test_follower_of_a_stalled_fill_goes_to_drive(self):
+        drive = _CountingDriveService(self.data)
+        chunks = iter(download_cache.stream_to_cache(drive, 'FILE1'))
+        next(chunks)
+        temp_path = os.path.join(self.cache_dir, 'FI', f'.tmp-FILE1-{drive.md5}')
+        os.utime(temp_path, (time.time() - 60, time.time() - 60))
+        self.assertEqual(b''.join(download_cache.stream_to_cache(drive, 'FILE1')), self.data)
+        self.assertEqual(len(drive.downloads), 2)
+        chunks.close()
+
+    def test_eviction_drops_least_recently_used_files(self):
+        directory = os.path.join(self.cache_dir, 'ab')
+        os.makedirs(directory)
+        for age, name in enumerate(['newest', 'middle', 'oldest']):
+            path = os.path.join(directory, f'abc-{name}')
+            with open(path, 'wb') as f:
+                f.write(b'x' * 100)
+            os.utime(path, (time.time() - age * 10, time.time() - age * 10))
+        stale = os.path.join(directory, '.tmp-abc-dead')
+        open(stale, 'wb').close()
+        os.utime(stale, (0, 0))
+
+        self.assertEqual(download_cache.evict(budget=250), 1)
+        self.assertEqual(self.files_on_disk(), ['abc-middle', 'abc-newest'])
+        self.assertEqual(cache.get(download_cache.TOTAL_KEY), 200)
+
+        download_cache.discard('abc')
+        self.assertEqual(self.files_on_disk(), [])
+        self.assertEqual(cache.get(download_cache.TOTAL_KEY), 0)
+
+    @override_settings(GOOGLE_DRIVE_DOWNLOAD_CACHE_BYTES=300 * 1024, GOOGLE_DRIVE_DOWNLOAD_CACHE_MAX_FILE=300 * 1024)
+    def test_fills_over_budget_evict(self):
+        b''.join(download_cache.stream_to_cache(_CountingDriveService(self.data), 'FILE1'))
+        time.sleep(0.01)
+        b''.join(download_cache.stream_to_cache(_CountingDriveService(self.data[::-1]), 'FILE2'))
+        self.assertEqual(len(self.files_on_disk()), 1)
+        self.assertTrue(self.files_on_disk()[0].startswith('FILE2-'))
+
+
+@override_settings(GOOGLE_DRIVE_STREAMING_UPLOADS=False, GOOGLE_DRIVE_BACKGROUND_TRANSFERS=False,
+                   GOOGLE_DRIVE_DEDUPLICATE_UPLOADS=True, GOOGLE_DRIVE_DEDUP_ACROSS_USERS=False)
+class DeduplicationTests(TestCase):
+    content = b'the same bytes again'
+
+    def setUp(self):
+        self.user = User.objects.create_user('erin', password='secret')
+        self.user.profile.is_approved = True
+        self.user.profile.drive_folder_id = 'ROOT'
+        self.user.profile.save()
+        self.md5 = hashlib.md5(self.content).hexdigest()
+        self.drive_service = mock.Mock()
+        self.drive_service.copy_file.return_value = 'COPY'
+        self.drive_service.upload_fileobj.return_value = 'NEW'
+        patcher = mock.patch('ftp.views.GoogleDriveService', return_value=self.drive_service)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client.force_login(self.user)
+
+    def add_entry(self, drive_file_id, user=None, size=None, **fields):
+        return FileEntry.objects.create(user=user or self.user, file_name=drive_file_id, file_size=size or len(self.content),
+                                        file_type='text/plain', drive_file_id=drive_file_id, md5_checksum=self.md5, **fields)
+
+    def post(self):
+        upload = SimpleUploadedFile('again.txt', self.content, content_type='text/plain')
+        return self.client.post(reverse('upload_file'), {'file': upload})
+
+    def test_find_copies_matches_md5_and_size_newest_first(self):
+        self.add_entry('OLD', upload_date=timezone.now() - timedelta(days=1))
+        self.add_entry('LATEST')
+        self.add_entry('OTHER-SIZE', size=1)
+        key = (self.md5, len(self.content))
+        self.assertEqual(find_copies(self.user, [key, None]), {key: 'LATEST'})
+        self.assertEqual(find_copy(self.user, self.md5, len(self.content)), 'LATEST')
+        self.assertIsNone(find_copy(self.user, '', len(self.content)))
+
+    def test_other_users_files_only_count_when_allowed(self):
+        self.add_entry('THEIRS', user=User.objects.create_user('frank'))
+        self.assertIsNone(find_copy(self.user, self.md5, len(self.content)))
+        with self.settings(GOOGLE_DRIVE_DEDUP_ACROSS_USERS=True):
+            self.assertEqual(find_copy(self.user, self.md5, len(self.content)), 'THEIRS')
+        with self.settings(GOOGLE_DRIVE_DEDUP_ACROSS_USERS=True, GOOGLE_DRIVE_DEDUPLICATE_UPLOADS=False):
+            self.assertIsNone(find_copy(self.user, self.md5, len(self.content)))
+
+    def test_upload_of_known_content_is_copied(self):
+        self.add_entry('ORIGINAL')
+        self.assertEqual(self.post().status_code, 302)
+        self.drive_service.copy_file.assert_called_once_with('ORIGINAL', 'again.txt', 'ROOT')
+        self.drive_service.upload_fileobj.assert_not_called()
+        self.assertEqual(FileEntry.objects.get(drive_file_id='COPY').md5_checksum, self.md5)
+
+    def test_new_content_is_uploaded_and_hashed(self):
+        self.post()
+        self.drive_service.copy_file.assert_not_called()
+        self.drive_service.upload_fileobj.assert_called_once()
+        self.assertEqual(FileEntry.objects.get(drive_file_id='NEW').md5_checksum, self.md5)
+
+    def test_failed_copy_falls_back_to_uploading(self):
+        self.add_entry('GONE')
+        self.drive_service.copy_file.return_value = None
+        self.post()
+        self.drive_service.upload_fileobj.assert_called_once()
+        self.assertTrue(FileEntry.objects.filter(drive_file_id='NEW').exists())
+
+    def test_queued_upload_of_known_content_is_copied(self):
+        self.add_entry('ORIGINAL')
+        spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_dir)
+        with self.settings(GOOGLE_DRIVE_BACKGROUND_TRANSFERS=True, TRANSFER_SPOOL_DIR=spool_dir), \
+                mock.patch('ftp.jobs.upload_path_resumable') as upload:
+            self.post()
+            job = TransferJob.claim('worker', 60)
+            self.assertTrue(run_job(job, self.drive_service, 60))
+        upload.assert_not_called()
+        job.refresh_from_db()
+        self.assertEqual((job.result['drive_file_id'], job.result['copied_from']), ('COPY', 'ORIGINAL'))
+        self.assertFalse(os.path.exists(job.payload['spool_path']))
+
+
+class _FakeAsyncDrive:
+    """httpx handler playing the Drive endpoints the async client uses for uploads."""
+
+    def __init__(self):
+        self.requests = []
+        self.received = bytearray()
+
+    def __call__(self, request):
+        self.requests.append(request)
+        path = request.url.path
+        if request.method == 'GET' and path.startswith('/drive/v3/files/'):
+            return httpx.Response(200, json={'id': path.rsplit('/', 1)[1], 'name': 'folder'})
+        if request.url.params.get('uploadType') == 'multipart':
+            return httpx.Response(200, json={'id': 'MULTIPART'})
+        if request.url.params.get('uploadType') == 'resumable':
+            return httpx.Response(200, headers={'location': 'https://drive.test/session'})
+        if request.method == 'PUT':
+            span, _, total = request.headers['content-range'].removeprefix('bytes ').partition('/')
+            self.received.extend(request.content)
+            if total != '*' and len(self.received) == int(total):
+                return httpx.Response(200, json={'id': 'RESUMABLE'})
+            return httpx.Response(308, headers={'range': f'bytes=0-{len(self.received) - 1}'})
+        return httpx.Response(404)
+
+
+@override_settings(GOOGLE_DRIVE_RATE_LIMIT=None, GOOGLE_DRIVE_ADAPTIVE_CHUNKS=False,
+                   GOOGLE_DRIVE_UPLOAD_CHUNK_SIZE=256 * 1024, GOOGLE_DRIVE_SIMPLE_UPLOAD_MAX=100 * 1024)
+class AsyncDriveServiceTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.drive = _FakeAsyncDrive()
+
+    def upload(self, source):
+        async def run():
+            async with httpx.AsyncClient(transport=httpx.MockTransport(self.drive)) as client:
+                with mock.patch.object(transport, 'client', return_value=client), \
+                        mock.patch.object(transport, 'root_url', return_value='https://drive.test/'), \
+                        mock.patch.object(transport, 'auth_headers', mock.AsyncMock(return_value={'Authorization': 'Bearer t'})):
+                    return await AsyncDriveService().upload_fileobj(source, 'a.bin', 'FOLDER')
+        return asyncio.run(run())
+
+    def test_small_file_goes_in_one_multipart_request(self):
+        self.assertEqual(self.upload(io.BytesIO(b'small file')), 'MULTIPART')
+        check, upload = self.drive.requests
+        self.assertEqual(check.url.path, '/drive/v3/files/FOLDER')
+        self.assertIn(b'small file', upload.content)
+        self.assertEqual(upload.headers['authorization'], 'Bearer t')
+        self.assertTrue(is_known_folder('FOLDER'))
+
+    def test_chunk_stream_goes_through_a_resumable_session(self):
+        data = os.urandom(600 * 1024)
+
+        async def chunks():
+            for offset in range(0, len(data), 100 * 1024):
+                yield data[offset:offset + 100 * 1024]
+
+        remember_folder('FOLDER')
+        self.assertEqual(self.upload(chunks()), 'RESUMABLE')
+        self.assertEqual(bytes(self.drive.received), data)
+        puts = [request.headers['content-range'] for request in self.drive.requests if request.method == 'PUT']
+        self.assertEqual(puts, ['bytes 0-262143/*', 'bytes 262144-524287/*', 'bytes 524288-614399/614400'])
+
+
+# The async views are only routed when GOOGLE_DRIVE_ASYNC_VIEWS is set at start-up
+urlpatterns = [
+    path('async/upload/', async_views.upload_file),
+    path('async/download/<int:file_id>/', async_views.download_file),
+    path('', include('gdriveftp.urls')),
+]
+
+
+@override_settings(ROOT_URLCONF='ftp.tests', GOOGLE_DRIVE_BACKGROUND_TRANSFERS=False)
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('gina', password='secret')
+        self.user.profile.is_approved = True
+        self.user.profile.drive_folder_id = 'ROOT'
+        self.user.profile.share_email = 'gina@example.com'
+        self.user.profile.save()
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+
+    async def test_concurrent_downloads_share_one_drive_fetch(self):
+        data = os.urandom(300 * 1024)
+        entry = await FileEntry.objects.acreate(user=self.user, file_name='big.bin', file_size=len(data),
+                                                file_type='application/octet-stream', drive_file_id='FILE1')
+        drive = _CountingDriveService(data, delay=0.002)
+        await self.async_client.aforce_login(self.user)
+
+        async def download():
+            response = await self.async_client.get(f'/async/download/{entry.pk}/')
+            return b''.join([chunk async for chunk in response.streaming_content])
+
+        with self.settings(GOOGLE_DRIVE_DOWNLOAD_CACHE_DIR=self.cache_dir, GOOGLE_DRIVE_DOWNLOAD_CACHE_BYTES=10 * MB), \
+                mock.patch('ftp.async_views.GoogleDriveService', return_value=drive):
+            self.assertEqual(await asyncio.gather(*[download() for _ in range(10)]), [data] * 10)
+            self.assertEqual(drive.downloads, [(0, None)])
+            # Later requests are served from the cache
+            response = await self.async_client.get(f'/async/download/{entry.pk}/', headers={'range': 'bytes=10-19'})
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(b''.join(response.streaming_content), data[10:20])
+        self.assertEqual(len(drive.downloads), 1)
+
+    async def test_upload_sends_files_concurrently_and_shares_them_in_one_batch(self):
+        drive = mock.Mock()
+        drive.upload_fileobj = mock.AsyncMock(side_effect=lambda source, name, *args, **kwargs: f'ID-{name}')
+        await self.async_client.aforce_login(self.user)
+        files = [SimpleUploadedFile(name, b'content ' + name.encode()) for name in ('a.txt', 'b.txt')]
+        with mock.patch('ftp.async_views.AsyncDriveService', return_value=drive), \
+                mock.patch('ftp.async_views.GoogleDriveService'), \
+                mock.patch('ftp.async_views.share_items', return_value=2) as share:
+            response = await self.async_client.post('/async/upload/', {'file': files})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(drive.upload_fileobj.await_count, 2)
+        share.assert_called_once_with(mock.ANY, ['ID-a.txt', 'ID-b.txt'], 'gina@example.com')
+        self.assertEqual(sorted([entry.drive_file_id async for entry in FileEntry.objects.filter(user=self.user)]),
+                         ['ID-a.txt', 'ID-b.txt'])
+
+
+def _call(label, seconds, retries=0):
+    call = DriveCall(label)
+    call.seconds = seconds
+    call.retries = retries
+    return call
+
+
+def _drive_calls(count, label='Drive files.get'):
+    for _ in range(count):
+        with traced(label):
+            pass
+
+
+class ServerTimingTests(SimpleTestCase):
+    def test_header_has_drive_total_then_each_call_type_slowest_first(self):
+        trace = DriveTrace()
+        trace.add(_call('Drive files.get', 0.010))
+        trace.add(_call('Drive files.get', 0.015, retries=1))
+        trace.add(_call('Drive files.create (resumable)', 0.100))
+        self.assertEqual(trace.server_timing(), ', '.join([
+            'drive;dur=125.0;desc="3 Drive calls"',
+            'drive-files-create-resumable;dur=100.0;desc="1x"',
+            'drive-files-get;dur=25.0;desc="2x, 1 retries"',
+        ]))
+
+    def test_middleware_adds_header_only_when_drive_was_called(self):
+        def view(request):
+            _drive_calls(int(request.GET.get('calls', 0)))
+            return HttpResponse('ok')
+
+        middleware = DriveTraceMiddleware(view)
+        factory = RequestFactory()
+        self.assertNotIn('Server-Timing', middleware(factory.get('/')))
+        response = middleware(factory.get('/', {'calls': 2}))
+        self.assertTrue(response['Server-Timing'].startswith('drive;dur='))
+        self.assertIn('desc="2 Drive calls"', response['Server-Timing'])
+        self.assertIn('drive-files-get;', response['Server-Timing'])
+        with self.settings(GOOGLE_DRIVE_SERVER_TIMING=False):
+            self.assertNotIn('Server-Timing', middleware(factory.get('/', {'calls': 2})))
+
+    def test_async_middleware_traces_calls_made_in_the_view(self):
+        async def view(request):
+            _drive_calls(1)
+            return HttpResponse('ok')
+
+        response = asyncio.run(DriveTraceMiddleware(view)(RequestFactory().get('/')))
+        self.assertIn('desc="1 Drive calls"', response['Server-Timing'])
+
+
+class CallBudgetTests(SimpleTestCase):
+    @override_settings(GOOGLE_DRIVE_ENFORCE_CALL_BUDGETS=True)
+    def test_enforced_budget_raises_with_the_calls_made(self):
+        with call_budget(2, 'Listing'):
+            _drive_calls(2)
+        with self.assertRaisesMessage(DriveCallBudgetExceeded, 'Listing made 3 Drive calls, over its budget of 2 (Drive files.get x3)'):
+            with call_budget(2, 'Listing'):
+                _drive_calls(3)
+
+    def test_unenforced_budget_only_warns(self):
+        with self.assertLogs('ftp.tracing', 'WARNING') as logs:
+            with call_budget(0, 'Listing'):
+                _drive_calls(1)
+        self.assertIn('Listing made 1 Drive calls, over its budget of 0', logs.output[0])
+
+    @override_settings(GOOGLE_DRIVE_ENFORCE_CALL_BUDGETS=True)
+    def test_budget_only_counts_calls_made_inside_the_block(self):
+        with start_trace() as trace:
+            _drive_calls(3)
+            with call_budget(1):
+                _drive_calls(1)
+        self.assertEqual(len(trace), 4)
+
+    @override_settings(GOOGLE_DRIVE_ENFORCE_CALL_BUDGETS=True)
+    def test_decorator_wraps_sync_and_async_views(self):
+        @drive_call_budget(1)
+        def view(request, calls):
+            _drive_calls(calls)
+            return HttpResponse('ok')
+
+        @drive_call_budget(1)
+        async def async_view(request, calls):
+            _drive_calls(calls)
+            return HttpResponse('ok')
+
+        request = RequestFactory().get('/')
+        self.assertEqual(view.drive_call_budget, 1)
+        self.assertEqual(view(request, 1).status_code, 200)
+        with self.assertRaisesMessage(DriveCallBudgetExceeded, 'view made 2 Drive calls'):
+            view(request, 2)
+        self.assertEqual(asyncio.run(async_view(request, 1)).status_code, 200)
+        with self.assertRaisesMessage(DriveCallBudgetExceeded, 'async_view made 2 Drive calls'):
+            asyncio.run(async_view(request, 2))
+
+
+@override_settings(GOOGLE_DRIVE_ENFORCE_CALL_BUDGETS=True)
+class ViewCallBudgetTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('hal', password='secret')
+        self.user.profile.is_approved = True
+        self.user.profile.drive_folder_id = 'ROOT'
+        self.user.profile.save()
+        self.client.force_login(self.user)
+        self.entry = FileEntry.objects.create(user=self.user, file_name='a.txt', file_size=1,
+                                              file_type='text/plain', drive_file_id='FILE1')
+
+    def test_dashboard_makes_no_drive_calls(self):
+        with mock.patch('ftp.views.GoogleDriveService') as drive:
+            response = self.client.get(reverse('dashboard'))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Server-Timing', response)
+        drive.assert_not_called()
+
+    def test_delete_file_stays_within_its_budget_and_reports_timing(self):
+        def delete_file(file_id):
+            _drive_calls(1, 'Drive files.delete')
+            return True
+
+        with mock.patch('ftp.views.GoogleDriveService') as drive:
+            drive.return_value.delete_file.side_effect = delete_file
+            response = self.client.post(reverse('delete_file', args=[self.entry.pk]))
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('drive-files-delete;', response['Server-Timing'])
+        self.assertFalse(FileEntry.objects.filter(pk=self.entry.pk).exists())
+
+
+def _credentials(subject=None):
+    return SharedTokenCredentials(mock.Mock(), 'drive@example.iam.gserviceaccount.com',
+                                  'https://oauth2.googleapis.com/token', scopes=['drive'], subject=subject)
+
+
+class SharedTokenCredentialsTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.minted = []
+
+        def mint(credentials, request):
+            time.sleep(0.01)
+            self.minted.append(credentials)
+            credentials.token = f'token-{len(self.minted)}'
+            credentials.expiry = _helpers.utcnow() + timedelta(hours=1)
+
+        patcher = mock.patch.object(service_account.Credentials, 'refresh', autospec=True, side_effect=mint)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _share(self, credentials, token, expires_in):
+        cache.set(f'{token_cache.TOKEN_KEY_PREFIX}{credentials._cache_key()}', (token, time.time() + expires_in))
+
+    def _lock(self, credentials):
+        return f'{token_cache.LOCK_KEY_PREFIX}{credentials._cache_key()}'
+
+    def test_concurrent_refreshes_mint_one_token(self):
+        workers = [_credentials() for _ in range(20)]
+        with ThreadPoolExecutor(20) as pool:
+            list(pool.map(lambda credentials: credentials.refresh(None), workers))
+        self.assertEqual(len(self.minted), 1)
+        self.assertEqual({credentials.token for credentials in workers}, {'token-1'})
+        self.assertIsNone(cache.get(self._lock(workers[0])))
+
+    def test_fresh_shared_token_is_used_and_refreshed_within_the_margin(self):
+        credentials = _credentials()
+        self._share(credentials, 'shared', 3600)
+        credentials.refresh(None)
+        self.assertEqual((credentials.token, self.minted), ('shared', []))
+        # google-auth sees the token expire GOOGLE_DRIVE_TOKEN_REFRESH_MARGIN early
+        early = timedelta(seconds=token_cache.DEFAULT_REFRESH_MARGIN) - _helpers.REFRESH_THRESHOLD
+        expected = _helpers.utcnow() + timedelta(hours=1) - early
+        self.assertAlmostEqual(credentials.expiry, expected, delta=timedelta(seconds=5))
+
+    def test_credentials_for_other_users_do_not_share_tokens(self):
+        self._share(_credentials(), 'shared', 3600)
+        delegated = _credentials(subject='someone@example.com')
+        delegated.refresh(None)
+        self.assertEqual(delegated.token, 'token-1')
+
+    def test_old_token_is_kept_while_another_process_refreshes(self):
+        credentials = _credentials()
+        self._share(credentials, 'old', 120)
+        cache.add(self._lock(credentials), 1)
+        credentials.refresh(None)
+        self.assertEqual((credentials.token, self.minted), ('old', []))
+
+    @mock.patch('ftp.token_cache.WAIT_INTERVAL', 0.01)
+    def test_waits_for_another_process_when_there_is_no_usable_token(self):
+        credentials = _credentials()
+        cache.add(self._lock(credentials), 1)
+
+        def finish():
+            self._share(credentials, 'theirs', 3600)
+            cache.delete(self._lock(credentials))
+
+        timer = threading.Timer(0.1, finish)
+        timer.start()
+        self.addCleanup(timer.cancel)
+        credentials.refresh(None)
+        self.assertEqual((credentials.token, self.minted), ('theirs', []))
+
+    @mock.patch('ftp.token_cache.WAIT_INTERVAL', 0.01)
+    @mock.patch('ftp.token_cache.REFRESH_LOCK_TIMEOUT', 0.05)
+    def test_mints_itself_if_the_other_process_never_finishes(self):
+        credentials = _credentials()
+        cache.add(self._lock(credentials), 1)
+        with self.assertLogs('ftp.token_cache', 'WARNING'):
+            credentials.refresh(None)
+        self.assertEqual(credentials.token, 'token-1')
+
+    def test_broken_cache_falls_back_to_minting_locally(self):
+        credentials = _credentials()
+        with mock.patch('ftp.token_cache.cache') as broken, self.assertLogs('ftp.token_cache', 'WARNING'):
+            broken.get.side_effect = broken.add.side_effect = broken.set.side_effect = ConnectionError('down')
+            credentials.refresh(None)
+        self.assertEqual(credentials.token, 'token-1')
+
+    @override_settings(GOOGLE_DRIVE_SHARED_TOKEN_CACHE=False)
+    def test_unshared_credentials_refresh_directly(self):
+        first, second = _credentials(), _credentials()
+        first.refresh(None)
+        second.refresh(None)
+        self.assertEqual((first.token, second.token), ('token-1', 'token-2'))
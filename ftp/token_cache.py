@@ -0,0 +1,133 @@
+import time
+import hashlib
+import logging
+import datetime
+import threading
+from django.conf import settings
+from django.core.cache import cache
+
+from google.auth import _helpers
+from google.oauth2 import service_account
+
+from .metrics import record_token_refresh
+
+logger = logging.getLogger(__name__)
+
+TOKEN_KEY_PREFIX = 'gdrive:token:'
+LOCK_KEY_PREFIX = 'gdrive:token-lock:'
+
+DEFAULT_REFRESH_MARGIN = 5 * 60
+# Seconds the refreshing process may hold the lock before others give up waiting
+REFRESH_LOCK_TIMEOUT = 30
+# A token this close to expiry is not handed out while another process refreshes it
+MIN_REMAINING = 30
+WAIT_INTERVAL = 0.1
+
+# Threads of one process share a credentials object; one of them refreshes at a time
+_refresh_lock = threading.Lock()
+
+
+def _refresh_margin():
+    margin = getattr(settings, 'GOOGLE_DRIVE_TOKEN_REFRESH_MARGIN', DEFAULT_REFRESH_MARGIN)
+    # google-auth treats a token as invalid this long before it expires; a
+    # smaller margin would make every request ask the cache for a new one
+    return max(margin, _helpers.REFRESH_THRESHOLD.total_seconds())
+
+
+def _shared():
+    return getattr(settings, 'GOOGLE_DRIVE_SHARED_TOKEN_CACHE', True)
+
+
+class SharedTokenCredentials(service_account.Credentials):
+    """Service account credentials that share their access token through the Django cache.
+
+    refresh() takes a token another process already minted if it is not
+    within GOOGLE_DRIVE_TOKEN_REFRESH_MARGIN of expiring. Otherwise the one
+    process that wins a cache.add lock asks Google for a new token, while the
+    others keep using the old one or, if there is none, wait for the winner.
+    Sharing only works across processes when CACHES points at a shared
+    backend such as Redis or Memcached.
+    """
+
+    def _cache_key(self):
+        # Credentials delegated to different users get different tokens
+        identity = f"{self.service_account_email}|{self._subject or ''}|{self._token_uri}|{' '.join(sorted(self.scopes or ()))}"
+        return hashlib.sha256(identity.encode()).hexdigest()[:32]
+
+    def _cached_token(self, key):
+        """The shared (token, expires_at) pair, or None."""
+        try:
+            return cache.get(f'{TOKEN_KEY_PREFIX}{key}')
+        except Exception as e:
+            logger.warning(f"Shared token cache unavailable: {e}")
+            return None
+
+    def _set_expiry(self, expires_at):
+        # google-auth refreshes REFRESH_THRESHOLD before expiry; moving expiry
+        # forward makes that happen once the token is within the margin instead
+        early = _refresh_margin() - _helpers.REFRESH_THRESHOLD.total_seconds()
+        # google-auth keeps expiry as a naive UTC datetime
+        self.expiry = datetime.datetime.fromtimestamp(expires_at - early, datetime.timezone.utc).replace(tzinfo=None)
+
+    def _use(self, cached, source='shared'):
+        self.token, expires_at = cached
+        self._set_expiry(expires_at)
+        if source:
+            record_token_refresh(source)
+
+    def _mint(self, request, key):
+        super().refresh(request)
+        record_token_refresh('minted')
+        expires_at = self.expiry.replace(tzinfo=datetime.timezone.utc).timestamp()
+        try:
+            cache.set(f'{TOKEN_KEY_PREFIX}{key}', (self.token, expires_at), max(1, int(expires_at - time.time())))
+        except Exception as e:
+            logger.warning(f"Could not share the new access token: {e}")
+        logger.info(f"Minted a Drive access token valid until {self.expiry.isoformat()}Z")
+        self._set_expiry(expires_at)
+
+    def _acquire(self, lock_key):
+        try:
+            return cache.add(lock_key, 1, REFRESH_LOCK_TIMEOUT)
+        except Exception as e:
+            # A broken cache must not stop Drive traffic; refresh locally
+            logger.warning(f"Shared token lock unavailable: {e}")
+            return True
+
+    def _release(self, lock_key):
+        try:
+            cache.delete(lock_key)
+        except Exception as e:
+            logger.warning(f"Could not release the shared token lock: {e}")
+
+    def refresh(self, request):
+        if not _shared():
+            return super().refresh(request)
+
+        key = self._cache_key()
+        lock_key = f'{LOCK_KEY_PREFIX}{key}'
+        with _refresh_lock:
+            deadline = time.monotonic() + REFRESH_LOCK_TIMEOUT
+            while True:
+                cached = self._cached_token(key)
+                remaining = cached[1] - time.time() if cached else 0
+                if remaining > _refresh_margin():
+                    return self._use(cached)
+
+                if self._acquire(lock_key):
+                    try:
+                        # Another process may have finished refreshing since we looked
+                        cached = self._cached_token(key)
+                        if cached and cached[1] - time.time() > _refresh_margin():
+                            return self._use(cached)
+                        return self._mint(request, key)
+                    finally:
+                        self._release(lock_key)
+
+                if remaining > MIN_REMAINING:
+                    # Someone else is refreshing; the current token still works
+                    return self._use(cached, source=None)
+                if time.monotonic() >= deadline:
+                    logger.warning(f"Gave up waiting {REFRESH_LOCK_TIMEOUT}s for another process to refresh the Drive token")
+                    return self._mint(request, key)
+                time.sleep(WAIT_INTERVAL)
@@ -0,0 +1,201 @@
+import re
+import time
+import logging
+import threading
+import contextvars
+from functools import wraps
+from contextlib import contextmanager
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+
+from .metrics import record_drive_call
+
+logger = logging.getLogger(__name__)
+
+# The trace for the request being handled, if any
+_current_trace = contextvars.ContextVar('gdrive_trace', default=None)
+# The Drive call in progress, so transfers inside it can add their bytes
+_current_call = contextvars.ContextVar('gdrive_call', default=None)
+
+
+class DriveCallBudgetExceeded(AssertionError):
+    """A view made more Drive calls than its budget allows."""
+
+
+class DriveCall:
+    """One logical Drive request: its retries count as part of the same call.
+
+    rate_limited counts the attempts Drive refused for quota reasons, and
+    throttled the seconds spent waiting for the local rate limiter.
+    """
+
+    __slots__ = ('label', 'started', 'seconds', 'nbytes', 'retries', 'rate_limited', 'throttled', 'error')
+
+    def __init__(self, label):
+        self.label = label
+        self.started = time.monotonic()
+        self.seconds = 0.0
+        self.nbytes = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.throttled = 0.0
+        self.error = None
+
+
+class DriveTrace:
+    """Drive calls made while handling one request, possibly from several threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = []
+
+    def add(self, call):
+        with self._lock:
+            self.calls.append(call)
+
+    def __len__(self):
+        return len(self.calls)
+
+    def summary(self):
+        """Per-label totals, slowest first: [(label, count, seconds, bytes, retries)]."""
+        totals = {}
+        with self._lock:
+            for call in self.calls:
+                count, seconds, nbytes, retries = totals.get(call.label, (0, 0.0, 0, 0))
+                totals[call.label] = (count + 1, seconds + call.seconds, nbytes + call.nbytes, retries + call.retries)
+        return sorted(((label, *values) for label, values in totals.items()), key=lambda row: -row[2])
+
+    @property
+    def seconds(self):
+        return sum(call.seconds for call in self.calls)
+
+    @property
+    def nbytes(self):
+        return sum(call.nbytes for call in self.calls)
+
+    @property
+    def retries(self):
+        return sum(call.retries for call in self.calls)
+
+    @property
+    def rate_limited(self):
+        return sum(call.rate_limited for call in self.calls)
+
+    @property
+    def throttled(self):
+        return sum(call.throttled for call in self.calls)
+
+    @property
+    def errors(self):
+        return sum(1 for call in self.calls if call.error is not None)
+
+    def server_timing(self):
+        """A Server-Timing header value: the overall Drive total, then each call type."""
+        entries = [f'drive;dur={self.seconds * 1000:.1f};desc="{len(self)} Drive calls"']
+        for label, count, seconds, nbytes, retries in self.summary():
+            name = re.sub(r'[^A-Za-z0-9_-]+', '-', label.removeprefix('Drive ')).strip('-').lower()
+            desc = f'{count}x' + (f', {retries} retries' if retries else '')
+            entries.append(f'drive-{name};dur={seconds * 1000:.1f};desc="{desc}"')
+        return ', '.join(entries)
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+@contextmanager
+def start_trace():
+    """Collect Drive calls made in this context (and threads/tasks it starts) into a new DriveTrace."""
+    trace = DriveTrace()
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+@contextmanager
+def traced(label):
+    """Time one Drive call, record it in the metrics and add it to the current trace. Set .retries/.nbytes on the yielded call.
+
+    A call made inside another one (e.g. the chunk PUT of a status query) is
+    counted as part of the outer call.
+    """
+    parent = _current_call.get()
+    if parent is not None:
+        yield parent
+        return
+    call = DriveCall(label)
+    token = _current_call.set(call)
+    try:
+        yield call
+    except Exception as e:
+        call.error = e
+        raise
+    finally:
+        _current_call.reset(token)
+        call.seconds = time.monotonic() - call.started
+        record_drive_call(call)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(call)
+
+
+def add_bytes(nbytes):
+    """Count bytes moved by the Drive call in progress."""
+    call = _current_call.get()
+    if call is not None:
+        call.nbytes += nbytes
+
+
+def _enforce_budgets():
+    return getattr(settings, 'GOOGLE_DRIVE_ENFORCE_CALL_BUDGETS', False)
+
+
+def _check_budget(name, trace, start, limit):
+    used = len(trace) - start
+    if used <= limit:
+        return
+    labels = ', '.join(f'{label} x{count}' for label, count, *_ in trace.summary())
+    message = f"{name} made {used} Drive calls, over its budget of {limit} ({labels})"
+    if _enforce_budgets():
+        raise DriveCallBudgetExceeded(message)
+    logger.warning(message)
+
+
+@contextmanager
+def call_budget(limit, name='Block'):
+    """Fail (or warn, unless GOOGLE_DRIVE_ENFORCE_CALL_BUDGETS is set) if the block makes more than limit Drive calls."""
+    trace = current_trace()
+    if trace is None:
+        with start_trace() as trace:
+            yield trace
+            _check_budget(name, trace, 0, limit)
+        return
+    start = len(trace)
+    yield trace
+    _check_budget(name, trace, start, limit)
+
+
+def drive_call_budget(limit):
+    """View decorator: the view may make at most limit Drive calls per request.
+
+    Over-budget requests log a warning, or raise DriveCallBudgetExceeded when
+    GOOGLE_DRIVE_ENFORCE_CALL_BUDGETS is set (as in tests), so changes that
+    add round trips are caught. Calls made while a streaming response is
+    being sent are not counted.
+    """
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def wrapped(request, *args, **kwargs):
+                with call_budget(limit, view.__name__):
+                    return await view(request, *args, **kwargs)
+        else:
+            @wraps(view)
+            def wrapped(request, *args, **kwargs):
+                with call_budget(limit, view.__name__):
+                    return view(request, *args, **kwargs)
+        wrapped.drive_call_budget = limit
+        return wrapped
+    return decorator
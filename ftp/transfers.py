@@ -0,0 +1,81 @@
+import os
+import logging
+import threading
+import traceback
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+
+from .gdrive import GoogleDriveService
+
+logger = logging.getLogger(__name__)
+
+# Default number of Drive transfers run at once for a single request
+DEFAULT_CONCURRENCY = 4
+
+# Long-lived executors by width, so worker threads, and the HTTP transport
+# and service each one gets from the client pool, are reused across requests
+_executors = {}
+_executors_lock = threading.Lock()
+_executors_pid = None
+
+
+def _executor(max_workers):
+    global _executors_pid
+    with _executors_lock:
+        # Threads do not survive a fork; a pre-forked worker starts its own
+        if _executors_pid != os.getpid():
+            _executors_pid = os.getpid()
+            _executors.clear()
+        executor = _executors.get(max_workers)
+        if executor is None:
+            executor = _executors[max_workers] = ThreadPoolExecutor(
+                max_workers=max_workers,
+                thread_name_prefix=f'gdrive-transfer-{max_workers}'
+            )
+        return executor
+
+
+def _run_task(task):
+    # Each worker thread gets its own service object and HTTP transport
+    # from the shared client pool.
+    try:
+        return task(GoogleDriveService())
+    except Exception as e:
+        logger.error(f"Drive task failed: {e}")
+        logger.error(traceback.format_exc())
+        return None
+
+
+def run_drive_tasks(tasks, max_workers=None, drive_service=None):
+    """Run callables of the form task(drive_service) on a shared, bounded thread pool.
+
+    Calls with the same max_workers share one long-lived pool, so at most
+    that many of their tasks run at once in this process.
+
+    Returns the results in task order. A task that raises yields None.
+    A single task, or a width of 1, runs inline on drive_service.
+    """
+    tasks = list(tasks)
+    if max_workers is None:
+        max_workers = getattr(settings, 'GOOGLE_DRIVE_UPLOAD_CONCURRENCY', DEFAULT_CONCURRENCY)
+    max_workers = max(1, max_workers)
+
+    if max_workers == 1 or len(tasks) <= 1:
+        drive_service = drive_service or GoogleDriveService()
+        results = []
+        for task in tasks:
+            try:
+                results.append(task(drive_service))
+            except Exception as e:
+                logger.error(f"Drive task failed: {e}")
+                logger.error(traceback.format_exc())
+                results.append(None)
+        return results
+
+    logger.info(f"Running {len(tasks)} Drive tasks on {min(max_workers, len(tasks))} workers")
+    executor = _executor(max_workers)
+    # Run each task in a copy of the caller's context so its Drive calls
+    # are traced as part of the current request
+    futures = [executor.submit(contextvars.copy_context().run, _run_task, task) for task in tasks]
+    return [future.result() for future in futures]
@@ -0,0 +1,154 @@
+import time
+import logging
+import threading
+from django.conf import settings
+
+from .media import CHUNK_ALIGNMENT
+from .tracing import add_bytes
+from .metrics import record_transfer
+
+logger = logging.getLogger(__name__)
+
+UPLOAD = 'upload'
+DOWNLOAD = 'download'
+
+# Drive recommends a single multipart request for files up to 5 MB
+SIMPLE_UPLOAD_MAX = 5 * 1024 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+
+# A chunk should take about this long to send...
+TARGET_CHUNK_SECONDS = 2.0
+# ...and at least this many round trips' worth of time, so per-chunk
+# latency stays a small fraction of the transfer
+RTT_MULTIPLE = 10
+
+# Weight given to each new sample in the moving averages
+SMOOTHING = 0.3
+
+
+def _align_down(size):
+    return max(CHUNK_ALIGNMENT, size - size % CHUNK_ALIGNMENT)
+
+
+class TransferTuner:
+    """Chooses upload mode and chunk sizes from measured throughput and round-trip time.
+
+    Every chunk sent to or fetched from Drive is timed. Throughput and RTT
+    are kept as exponentially weighted moving averages per direction, and
+    chunk sizes are picked so one chunk takes TARGET_CHUNK_SECONDS and
+    dwarfs the round trip. Until there are measurements the configured
+    GOOGLE_DRIVE_*_CHUNK_SIZE settings are used. Shared by all threads in
+    a process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._throughput = {}
+        self._samples = {}
+        self._rtt = None
+        self._decisions = {}
+
+    def _default_chunk_size(self, direction):
+        from .gdrive import DOWNLOAD_CHUNK_SIZE, UPLOAD_CHUNK_SIZE
+        if direction == UPLOAD:
+            return getattr(settings, 'GOOGLE_DRIVE_UPLOAD_CHUNK_SIZE', UPLOAD_CHUNK_SIZE)
+        return getattr(settings, 'GOOGLE_DRIVE_DOWNLOAD_CHUNK_SIZE', DOWNLOAD_CHUNK_SIZE)
+
+    def enabled(self):
+        return getattr(settings, 'GOOGLE_DRIVE_ADAPTIVE_CHUNKS', True)
+
+    def record_rtt(self, seconds):
+        """Record the duration of a request that carries (almost) no payload."""
+        with self._lock:
+            self._rtt = seconds if self._rtt is None else (1 - SMOOTHING) * self._rtt + SMOOTHING * seconds
+
+    def record_transfer(self, direction, nbytes, seconds):
+        """Record a chunk of nbytes that took seconds to send or receive."""
+        if nbytes <= 0 or seconds <= 0:
+            return
+        with self._lock:
+            # Take the round trip out so throughput reflects the link, not latency
+            transfer_seconds = seconds - (self._rtt or 0)
+            if transfer_seconds <= seconds * 0.1:
+                transfer_seconds = seconds
+            rate = nbytes / transfer_seconds
+            current = self._throughput.get(direction)
+            self._throughput[direction] = rate if current is None else (1 - SMOOTHING) * current + SMOOTHING * rate
+            self._samples[direction] = self._samples.get(direction, 0) + 1
+
+    def timed(self, direction):
+        """Context manager that records a transfer; set .nbytes inside the block."""
+        return _TimedTransfer(self, direction)
+
+    def chunk_size(self, direction):
+        """Chunk size in bytes for the next transfer, a multiple of 256 KiB."""
+        default = _align_down(self._default_chunk_size(direction))
+        with self._lock:
+            throughput = self._throughput.get(direction)
+            rtt = self._rtt or 0
+        if not self.enabled() or throughput is None:
+            size = default
+        else:
+            target_seconds = max(getattr(settings, 'GOOGLE_DRIVE_TARGET_CHUNK_SECONDS', TARGET_CHUNK_SECONDS), rtt * RTT_MULTIPLE)
+            size = _align_down(min(int(throughput * target_seconds), getattr(settings, 'GOOGLE_DRIVE_MAX_CHUNK_SIZE', MAX_CHUNK_SIZE)))
+        with self._lock:
+            self._decisions[f'{direction}_chunk_size'] = size
+        return size
+
+    def use_resumable(self, size):
+        """False if an upload of size bytes should go as one multipart request."""
+        threshold = getattr(settings, 'GOOGLE_DRIVE_SIMPLE_UPLOAD_MAX', SIMPLE_UPLOAD_MAX)
+        resumable = size is None or size > threshold
+        self._note_upload(size, resumable)
+        return resumable
+
+    def note_unknown_size(self):
+        """Record that an upload of unknown length, e.g. a chunk stream, went resumable."""
+        self._note_upload(None, True)
+
+    def _note_upload(self, size, resumable):
+        with self._lock:
+            self._decisions['last_upload'] = {'size': size, 'mode': 'resumable' if resumable else 'multipart'}
+
+    def snapshot(self):
+        """Current measurements and decisions, for logs and the tuning endpoint."""
+        with self._lock:
+            return {
+                'adaptive': self.enabled(),
+                'rtt_seconds': self._rtt,
+                'upload_bytes_per_second': self._throughput.get(UPLOAD),
+                'download_bytes_per_second': self._throughput.get(DOWNLOAD),
+                'upload_samples': self._samples.get(UPLOAD, 0),
+                'download_samples': self._samples.get(DOWNLOAD, 0),
+                'simple_upload_max': getattr(settings, 'GOOGLE_DRIVE_SIMPLE_UPLOAD_MAX', SIMPLE_UPLOAD_MAX),
+                **self._decisions,
+            }
+
+    def reset(self):
+        with self._lock:
+            self._throughput.clear()
+            self._samples.clear()
+            self._rtt = None
+            self._decisions.clear()
+
+
+class _TimedTransfer:
+    def __init__(self, tuner, direction):
+        self.tuner = tuner
+        self.direction = direction
+        self.nbytes = 0
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            seconds = time.monotonic() - self.started
+            self.tuner.record_transfer(self.direction, self.nbytes, seconds)
+            record_transfer(self.direction, self.nbytes, seconds)
+            add_bytes(self.nbytes)
+        return False
+
+
+tuner = TransferTuner()
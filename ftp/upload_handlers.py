@@ -0,0 +1,159 @@
+import io
+import hashlib
+import logging
+import traceback
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import (
+    FileUploadHandler, MemoryFileUploadHandler, StopFutureHandlers, TemporaryFileUploadHandler,
+)
+
+from . import dedup
+from .gdrive import GoogleDriveService
+from .tuning import tuner, UPLOAD
+
+logger = logging.getLogger(__name__)
+
+
+class DriveUploadedFile(UploadedFile):
+    """An uploaded file whose bytes already live in Google Drive.
+
+    drive_file_id is None if forwarding to Drive failed part-way.
+    """
+
+    def __init__(self, name, content_type, size, charset, drive_file_id, drive_parent_id, content_type_extra=None, md5_checksum=''):
+        super().__init__(io.BytesIO(), name, content_type, size, charset, content_type_extra)
+        self.drive_file_id = drive_file_id
+        self.drive_parent_id = drive_parent_id
+        self.md5_checksum = md5_checksum
+
+
+class HashingUploadMixin:
+    """Hash file parts as they arrive and set md5_checksum on the finished file.
+
+    The hash is computed from the chunks this handler keeps, so it costs no
+    extra pass over the file after the request has been received. Nothing is
+    hashed while GOOGLE_DRIVE_DEDUPLICATE_UPLOADS is off.
+    """
+
+    def new_file(self, *args, **kwargs):
+        self.md5 = hashlib.md5() if dedup.enabled() else None
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        remaining = super().receive_data_chunk(raw_data, start)
+        if remaining is None and self.md5:
+            # This handler kept the chunk, so it is part of its file
+            self.md5.update(raw_data)
+        return remaining
+
+    def file_complete(self, file_size):
+        uploaded_file = super().file_complete(file_size)
+        if uploaded_file is not None and self.md5:
+            uploaded_file.md5_checksum = self.md5.hexdigest()
+        return uploaded_file
+
+
+class HashingMemoryFileUploadHandler(HashingUploadMixin, MemoryFileUploadHandler):
+    pass
+
+
+class HashingTemporaryFileUploadHandler(HashingUploadMixin, TemporaryFileUploadHandler):
+    pass
+
+
+class DriveStreamingUploadHandler(FileUploadHandler):
+    """Forward file parts to a Drive resumable session while the request is still arriving.
+
+    A session is opened in the user's Drive folder when a file part starts,
+    256 KiB-aligned chunks are sent as soon as they are buffered, and the
+    session is finished when the part ends. If no session can be opened the
+    part falls through to Django's default handlers.
+    """
+
+    def __init__(self, request=None, parent_folder_id=None):
+        super().__init__(request)
+        self.parent_folder_id = parent_folder_id
+        self.drive_chunk_size = tuner.chunk_size(UPLOAD)
+        self.drive_service = None
+        self.session_uri = None
+
+    def new_file(self, field_name, file_name, content_type, content_length, charset=None, content_type_extra=None):
+        super().new_file(field_name, file_name, content_type, content_length, charset, content_type_extra)
+        self.session_uri = None
+        self.buffer = bytearray()
+        self.offset = 0
+        self.response = None
+        self.failed = False
+        self.md5 = hashlib.md5() if dedup.enabled() else None
+
+        if not self.parent_folder_id:
+            return
+
+        if self.drive_service is None:
+            self.drive_service = GoogleDriveService()
+        self.session_uri = self.drive_service.start_resumable_session(
+            file_name,
+            self.parent_folder_id,
+            mime_type=content_type
+        )
+        if self.session_uri:
+            raise StopFutureHandlers()
+
+    def _send(self, data, total_size=None):
+        try:
+            self.offset, self.response = self.drive_service.upload_session_chunk(
+                self.session_uri, data, self.offset, total_size
+            )
+        except Exception as e:
+            logger.error(f"Error streaming {self.file_name} to Google Drive: {e}")
+            logger.error(traceback.format_exc())
+            self.failed = True
+
+    def receive_data_chunk(self, raw_data, start):
+        if not self.session_uri:
+            return raw_data
+        if self.failed:
+            return None
+
+        if self.md5:
+            self.md5.update(raw_data)
+        self.buffer.extend(raw_data)
+        sendable = len(self.buffer) - len(self.buffer) % self.drive_chunk_size
+        if sendable:
+            sent_from = self.offset
+            self._send(self.buffer[:sendable])
+            # Drive may commit fewer bytes than were sent; keep the rest
+            if self.failed:
+                self.buffer.clear()
+            else:
+                del self.buffer[:self.offset - sent_from]
+        return None
+
+    def file_complete(self, file_size):
+        if not self.session_uri:
+            return None
+
+        # The final chunk may be any size, and may need several attempts if
+        # Drive commits only part of it.
+        while not self.failed and self.response is None:
+            sent_from = self.offset
+            self._send(self.buffer, total_size=file_size)
+            if self.offset == sent_from and self.response is None:
+                logger.error(f"Google Drive made no progress on the last chunk of {self.file_name}")
+                self.failed = True
+            del self.buffer[:self.offset - sent_from]
+
+        drive_file_id = None if self.failed else self.response.get('id')
+        if drive_file_id:
+            logger.info(f"Streamed {self.file_name} ({file_size} bytes) to Drive as {drive_file_id}")
+
+        return DriveUploadedFile(
+            name=self.file_name,
+            content_type=self.content_type,
+            size=file_size,
+            charset=self.charset,
+            drive_file_id=drive_file_id,
+            drive_parent_id=self.parent_folder_id,
+            content_type_extra=self.content_type_extra,
+            md5_checksum=self.md5.hexdigest() if drive_file_id and self.md5 else ''
+        )
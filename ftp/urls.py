@@ -1,8 +1,15 @@
 from django.urls import path
+from django.conf import settings
 from django.contrib.auth import views as auth_views
 from . import views
 from .forms import UserLoginForm
 
+# Under ASGI the transfer-heavy pages can run as coroutines on the async Drive client
+if getattr(settings, 'GOOGLE_DRIVE_ASYNC_VIEWS', False):
+    from . import async_views as transfer_views
+else:
+    transfer_views = views
+
 urlpatterns = [
     path('', views.home, name='home'),
     path('register/', views.register, name='register'),
@@ -13,16 +20,24 @@ urlpatterns = [
     path('logout/', auth_views.LogoutView.as_view(), name='logout'),
     
     # User dashboard and file management
-    path('dashboard/', views.dashboard, name='dashboard'),
-    path('folder/<int:folder_id>/', views.dashboard, name='folder_view'),
-    path('upload/', views.upload_file, name='upload_file'),
-    path('download/<int:file_id>/', views.download_file, name='download_file'),
+    path('dashboard/', transfer_views.dashboard, name='dashboard'),
+    path('folder/<int:folder_id>/', transfer_views.dashboard, name='folder_view'),
+    path('upload/', transfer_views.upload_file, name='upload_file'),
+    path('download/<int:file_id>/', transfer_views.download_file, name='download_file'),
     path('delete/file/<int:file_id>/', views.delete_file, name='delete_file'),
     path('delete/folder/<int:folder_id>/', views.delete_folder, name='delete_folder'),
     path('settings/', views.user_settings, name='user_settings'),
     
+    # Background transfer progress
+    path('jobs/', views.job_list, name='job_list'),
+    path('jobs/<int:job_id>/status/', views.job_status, name='job_status'),
+    
     # Admin views
     path('admin-dashboard/', views.admin_dashboard, name='admin_dashboard'),
+    path('admin-dashboard/transfer-tuning/', views.transfer_tuning, name='transfer_tuning'),
     path('approve-user/<int:user_id>/', views.approve_user, name='approve_user'),
     path('revoke-user/<int:user_id>/', views.revoke_user, name='revoke_user'),
+    
+    # Prometheus scrape endpoint
+    path('metrics', views.metrics, name='metrics'),
 ]
\ No newline at end of file
@@ -1,18 +1,39 @@
 import os
-import tempfile
+import hmac
+import uuid
+import logging
+from functools import partial
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import login, authenticate
 from django.contrib import messages
-from django.http import HttpResponse, Http404
+from django.http import FileResponse, HttpResponse, Http404, JsonResponse, StreamingHttpResponse
 from django.utils.text import slugify
 from django.conf import settings
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.models import User
+from django.db.models import Count
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
 
-from .forms import UserRegisterForm, FileUploadForm
-from .models import UserProfile, FileEntry, FolderEntry
+from .forms import UserRegisterForm, FileUploadForm, SettingsForm
+from .models import UserProfile, FileEntry, FolderEntry, TransferJob
 from .gdrive import GoogleDriveService
+from .upload_handlers import DriveUploadedFile, DriveStreamingUploadHandler
+from .transfers import run_drive_tasks
+from .sharing import share_items, update_user_sharing
+from .pagination import FILE_SORT_FIELDS, DEFAULT_PAGE_SIZE, keyset_paginate
+from .jobs import (
+    background_transfers_enabled, enqueue_upload, enqueue_delete_folder, enqueue_create_user_folder,
+    enqueue_update_sharing,
+)
+from .tuning import tuner
+from .tracing import drive_call_budget
+from .metrics import registry as metrics_registry
+from .dedup import content_key, find_copies
+from . import download_cache
+from . import ranges as ranges_util
+
+logger = logging.getLogger(__name__)
 
 def home(request):
     """Home page view."""
@@ -36,6 +57,7 @@ def register(request):
     return render(request, 'ftp/register.html', {'form': form})
 
 @login_required
+@drive_call_budget(0)
 def dashboard(request, folder_id=None):
     """User dashboard view."""
     user_profile = UserProfile.objects.get(user=request.user)
@@ -51,33 +73,109 @@ def dashboard(request, folder_id=None):
         try:
             current_folder = FolderEntry.objects.get(id=folder_id, user=request.user)
             
-            # Build breadcrumbs
-            temp_folder = current_folder
-            while temp_folder:
-                breadcrumbs.insert(0, temp_folder)
-                temp_folder = temp_folder.parent_folder
-                
-            # Get files and folders in the current folder
-            files = FileEntry.objects.filter(user=request.user, folder=current_folder)
-            folders = FolderEntry.objects.filter(user=request.user, parent_folder=current_folder)
+            # Build breadcrumbs from the materialized path in one query
+            breadcrumbs = current_folder.get_breadcrumbs()
         except FolderEntry.DoesNotExist:
             messages.error(request, 'Folder not found.')
             return redirect('dashboard')
-    else:
-        # Root level - show files and folders with no parent
-        files = FileEntry.objects.filter(user=request.user, folder=None)
-        folders = FolderEntry.objects.filter(user=request.user, parent_folder=None)
+    
+    # Files are paginated by cursor so a page costs the same in any folder size
+    sort = request.GET.get('sort', 'date')
+    if sort not in FILE_SORT_FIELDS:
+        sort = 'date'
+    order = request.GET.get('order', 'desc' if sort == 'date' else 'asc')
+    after = request.GET.get('after')
+    before = request.GET.get('before')
+    
+    files = keyset_paginate(
+        FileEntry.objects.filter(user=request.user, folder=current_folder),
+        FILE_SORT_FIELDS[sort],
+        descending=(order == 'desc'),
+        after=after,
+        before=before,
+        page_size=getattr(settings, 'DASHBOARD_PAGE_SIZE', DEFAULT_PAGE_SIZE)
+    )
+    
+    # Folders are listed on the first page only
+    folders = []
+    if not (after or before):
+        folders = FolderEntry.objects.filter(user=request.user, parent_folder=current_folder)
+    
+    active_jobs = TransferJob.objects.filter(
+        user=request.user,
+        status__in=[TransferJob.QUEUED, TransferJob.RUNNING]
+    ).order_by('created_at')[:100]
     
     return render(request, 'ftp/dashboard.html', {
         'files': files,
         'folders': folders,
         'current_folder': current_folder,
-        'breadcrumbs': breadcrumbs
+        'breadcrumbs': breadcrumbs,
+        'sort': sort,
+        'order': order,
+        'active_jobs': active_jobs,
     })
 
+def _send_to_drive(drive_service, uploaded_file, folder_id, copy_from=None):
+    """Put one uploaded file into a Drive folder.
+    
+    copy_from is the Drive ID of a file with the same content; it is copied
+    server-side instead of uploading the bytes again.
+    Returns (file_id, in_target_folder); file_id is None on failure.
+    """
+    if isinstance(uploaded_file, DriveUploadedFile):
+        # Already streamed into the user's root folder by the upload handler
+        file_id = uploaded_file.drive_file_id
+        in_target_folder = True
+        if file_id and folder_id != uploaded_file.drive_parent_id:
+            in_target_folder = drive_service.move_file(file_id, folder_id, uploaded_file.drive_parent_id)
+        return file_id, in_target_folder
+    
+    if copy_from:
+        file_id = drive_service.copy_file(copy_from, uploaded_file.name, folder_id)
+        if file_id:
+            return file_id, True
+        # The original may have been removed from Drive; upload after all
+    
+    # Upload straight from Django's upload object; no extra temp copy
+    file_id = drive_service.upload_fileobj(
+        uploaded_file,
+        uploaded_file.name,
+        folder_id,
+        mime_type=uploaded_file.content_type
+    )
+    return file_id, True
+
+@csrf_exempt
 @login_required
 def upload_file(request):
-    """File upload view."""
+    """File upload view.
+    
+    With GOOGLE_DRIVE_STREAMING_UPLOADS enabled, file parts are forwarded to
+    Drive while the request body is still arriving.
+    """
+    streaming = False
+    if request.method == 'POST' and getattr(settings, 'GOOGLE_DRIVE_STREAMING_UPLOADS', False):
+        user_profile = UserProfile.objects.filter(user=request.user).first()
+        if user_profile and user_profile.is_approved and user_profile.drive_folder_id:
+            # Must be installed before anything reads request.POST or request.FILES
+            request.upload_handlers.insert(0, DriveStreamingUploadHandler(request, user_profile.drive_folder_id))
+            streaming = True
+    
+    response = _upload_file(request)
+    
+    if streaming and response.status_code != 302:
+        # The request was rejected (CSRF or form errors) after its files had
+        # already reached Drive; don't leave them behind
+        drive_service = GoogleDriveService()
+        for uploaded_file in request.FILES.getlist('file'):
+            if getattr(uploaded_file, 'drive_file_id', None):
+                drive_service.delete_file(uploaded_file.drive_file_id)
+    return response
+
+@csrf_protect
+def _upload_file(request):
+    """Upload form handling for upload_file."""
     user_profile = UserProfile.objects.get(user=request.user)
     
     if not user_profile.is_approved:
@@ -87,9 +185,7 @@ def upload_file(request):
     # Get all folders for the user to populate the dropdown
     user_folders = []
     try:
-        folders = FolderEntry.objects.filter(user=request.user)
-        for folder in folders:
-            user_folders.append((folder.id, folder.get_path()))
+        user_folders = FolderEntry.display_paths(request.user)
     except Exception as e:
         print(f"Error fetching folders: {e}")
     
@@ -168,41 +264,65 @@ def upload_file(request):
                 
                 description = form.cleaned_data.get('description', '')
                 
-                for uploaded_file in files:
-                    # Save file temporarily
-                    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-                        for chunk in uploaded_file.chunks():
-                            temp_file.write(chunk)
-                        temp_file_path = temp_file.name
-                    
+                if background_transfers_enabled():
+                    # Hand files over to the transfer workers; ones the streaming
+                    # handler already put in Drive are finished below as usual
+                    queued = [f for f in files if not isinstance(f, DriveUploadedFile)]
+                    for uploaded_file in queued:
+                        enqueue_upload(request.user, uploaded_file, db_folder, description)
+                    if queued:
+                        messages.info(request, f'Queued {len(queued)} file(s) for upload.')
+                    files = [f for f in files if isinstance(f, DriveUploadedFile)]
+                
+                # Content the user already has in Drive is copied rather than re-sent
+                copies = find_copies(request.user, [
+                    content_key(f) for f in files if not isinstance(f, DriveUploadedFile)
+                ])
+                tasks = [
+                    partial(
+                        _send_to_drive,
+                        uploaded_file=uploaded_file,
+                        folder_id=upload_folder_id,
+                        copy_from=copies.get(content_key(uploaded_file))
+                    )
+                    for uploaded_file in files
+                ]
+                results = run_drive_tasks(tasks, drive_service=drive_service)
+                
+                # Share every new file in one batch request rather than one call each.
+                # The files are in Drive either way, so their entries are still saved.
+                if user_profile.share_email:
                     try:
-                        # Upload file to Google Drive
-                        file_id = drive_service.upload_file(
-                            temp_file_path,
-                            uploaded_file.name,
-                            upload_folder_id,
-                            share_with_email=user_profile.share_email if user_profile.share_email else None
-                        )
-                        
-                        if file_id:
-                            # Save file entry to database
-                            file_entry = FileEntry(
-                                user=request.user,
-                                file_name=uploaded_file.name,
-                                file_size=uploaded_file.size,
-                                file_type=uploaded_file.content_type,
-                                drive_file_id=file_id,
-                                description=description,
-                                folder=db_folder
-                            )
-                            file_entry.save()
-                            success_count += 1
-                        else:
-                            error_count += 1
-                    finally:
-                        # Delete temporary file
-                        if os.path.exists(temp_file_path):
-                            os.unlink(temp_file_path)
+                        share_items(drive_service, [result[0] for result in results if result and result[0]], user_profile.share_email)
+                    except Exception as e:
+                        logger.error(f"Error sharing uploaded files with {user_profile.share_email}: {e}")
+                        messages.warning(request, f'Uploaded files could not be shared with {user_profile.share_email}.')
+                
+                file_entries = []
+                for uploaded_file, result in zip(files, results):
+                    file_id, in_target_folder = result or (None, False)
+                    if file_id:
+                        if not in_target_folder:
+                            messages.warning(request, f'{uploaded_file.name} was uploaded to your root folder.')
+                        file_entries.append(FileEntry(
+                            user=request.user,
+                            file_name=uploaded_file.name,
+                            file_size=uploaded_file.size,
+                            file_type=uploaded_file.content_type,
+                            drive_file_id=file_id,
+                            description=description,
+                            folder=db_folder if in_target_folder else None,
+                            md5_checksum=getattr(uploaded_file, 'md5_checksum', '')
+                        ))
+                        success_count += 1
+                    else:
+                        error_count += 1
+                FileEntry.objects.bulk_create(
+                    file_entries,
+                    update_conflicts=True,
+                    unique_fields=['drive_file_id'],
+                    update_fields=FileEntry.UPLOAD_FIELDS
+                )
                 
                 if success_count > 0:
                     messages.success(request, f'Successfully uploaded {success_count} file(s).')
@@ -215,26 +335,119 @@ def upload_file(request):
     
     return render(request, 'ftp/upload_file.html', {'form': form})
 
+def _multipart_byteranges(ranges, boundary, content_type, size, read_part):
+    """Yield a multipart/byteranges body; read_part(index, start, end) supplies each part's bytes."""
+    for index, (start, end) in enumerate(ranges):
+        yield ranges_util.multipart_part_header(boundary, content_type, start, end, size)
+        yield from read_part(index, start, end)
+    yield ranges_util.multipart_trailer(boundary)
+
+def _closing(chunks, file):
+    """Yield from chunks and close file when the response is finished."""
+    try:
+        yield from chunks
+    finally:
+        file.close()
+
+def _cached_download_response(cached, ranges, content_type, size):
+    """Serve a download from the local disk cache."""
+    if ranges and len(ranges) > 1:
+        boundary = uuid.uuid4().hex
+        response = StreamingHttpResponse(
+            _closing(_multipart_byteranges(ranges, boundary, content_type, size,
+                                           lambda index, start, end: download_cache.iter_file_range(cached, start, end)), cached),
+            status=206,
+            content_type=f'multipart/byteranges; boundary={boundary}'
+        )
+        response['Content-Length'] = ranges_util.multipart_length(boundary, content_type, ranges, size)
+    elif ranges:
+        start, end = ranges[0]
+        response = StreamingHttpResponse(_closing(download_cache.iter_file_range(cached, start, end), cached),
+                                         status=206, content_type=content_type)
+        response['Content-Range'] = ranges_util.content_range(start, end, size)
+        response['Content-Length'] = end - start + 1
+    else:
+        # FileResponse lets the server use sendfile (wsgi.file_wrapper)
+        response = FileResponse(cached, content_type=content_type)
+    return response
+
+def _drive_download_response(drive_service, drive_file_id, ranges, content_type, size, download=None):
+    """Stream a download from Google Drive, or return None if it cannot be started.
+    
+    download may be an already opened stream of the first range (or the whole file).
+    """
+    if download is None and ranges:
+        download = drive_service.download_stream(drive_file_id, ranges[0][0], ranges[0][1])
+    elif download is None:
+        download = drive_service.download_stream(drive_file_id)
+    if not download:
+        return None
+    
+    def read_part(index, start, end):
+        part = download if index == 0 else drive_service.download_stream(drive_file_id, start, end)
+        if part is None:
+            raise IOError(f"Could not fetch bytes {start}-{end} of {drive_file_id} from Google Drive")
+        return part
+    
+    if ranges and len(ranges) > 1:
+        boundary = uuid.uuid4().hex
+        response = StreamingHttpResponse(
+            _multipart_byteranges(ranges, boundary, content_type, size, read_part),
+            status=206,
+            content_type=f'multipart/byteranges; boundary={boundary}'
+        )
+        response['Content-Length'] = ranges_util.multipart_length(boundary, content_type, ranges, size)
+    elif ranges:
+        response = StreamingHttpResponse(download, status=206, content_type=content_type)
+        response['Content-Range'] = ranges_util.content_range(ranges[0][0], ranges[0][1], size)
+        response['Content-Length'] = download.length
+    else:
+        response = StreamingHttpResponse(download, content_type=content_type)
+        if download.length is not None:
+            response['Content-Length'] = download.length
+    return response
+
 @login_required
 def download_file(request, file_id):
-    """File download view."""
+    """File download view. Supports Range and If-Range requests."""
     file_entry = get_object_or_404(FileEntry, id=file_id, user=request.user)
+    content_type = file_entry.file_type or 'application/octet-stream'
+    size = file_entry.file_size
+    etag = f'"{file_entry.drive_file_id}-{size}"'
     
-    drive_service = GoogleDriveService()
-    file_content = drive_service.download_file(file_entry.drive_file_id)
+    # Work out which byte ranges to send; None means the whole file
+    ranges = None
+    if ranges_util.if_range_matches(request.headers.get('If-Range'), etag, file_entry.upload_date):
+        try:
+            ranges = ranges_util.parse_range_header(request.headers.get('Range'), size)
+        except ranges_util.RangeNotSatisfiable:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
     
-    if file_content:
-        response = HttpResponse(
-            file_content.getvalue(),
-            content_type=file_entry.file_type or 'application/octet-stream'
-        )
-        response['Content-Disposition'] = f'attachment; filename="{file_entry.file_name}"'
-        return response
+    drive_service = GoogleDriveService()
+    cached = download_cache.open_cached(drive_service, file_entry.drive_file_id, size)
+    if cached is not None:
+        response = _cached_download_response(cached, ranges, content_type, size)
     else:
+        download = None
+        if not ranges or ranges == [(0, size - 1)]:
+            # The whole file goes out anyway, so the cache keeps a copy on the way through
+            download = download_cache.stream_to_cache(drive_service, file_entry.drive_file_id, size)
+        response = _drive_download_response(drive_service, file_entry.drive_file_id, ranges, content_type, size, download)
+    
+    if response is None:
         messages.error(request, 'Error downloading file from Google Drive.')
         return redirect('dashboard')
+    
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = ranges_util.last_modified_header(file_entry.upload_date)
+    response['Content-Disposition'] = f'attachment; filename="{file_entry.file_name}"'
+    return response
 
 @login_required
+@drive_call_budget(1)
 def delete_file(request, file_id):
     """File deletion view."""
     file_entry = get_object_or_404(FileEntry, id=file_id, user=request.user)
@@ -242,6 +455,7 @@ def delete_file(request, file_id):
     if request.method == 'POST':
         drive_service = GoogleDriveService()
         if drive_service.delete_file(file_entry.drive_file_id):
+            download_cache.discard(file_entry.drive_file_id)
             file_entry.delete()
             messages.success(request, f'File {file_entry.file_name} deleted successfully!')
         else:
@@ -263,6 +477,45 @@ def admin_dashboard(request):
     })
 
 @staff_member_required
+def transfer_tuning(request):
+    """Measured Drive throughput and RTT, and the chunk sizes chosen from them."""
+    return JsonResponse(tuner.snapshot())
+
+def _metrics_authorized(request):
+    token = getattr(settings, 'GOOGLE_DRIVE_METRICS_TOKEN', '')
+    if token:
+        return hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')
+    return request.user.is_active and request.user.is_staff
+
+@drive_call_budget(0)
+def metrics(request):
+    """Prometheus metrics, summed over every process sharing GOOGLE_DRIVE_METRICS_DIR.
+
+    Scrapers authenticate with GOOGLE_DRIVE_METRICS_TOKEN as a bearer token;
+    without one configured, only staff users may read them.
+    """
+    if not _metrics_authorized(request):
+        return HttpResponse(status=403)
+
+    # Queue depth comes straight from the job table, so it is already global
+    depth = {
+        (('kind', kind), ('status', status)): 0
+        for kind, _ in TransferJob.KIND_CHOICES
+        for status in (TransferJob.QUEUED, TransferJob.RUNNING)
+    }
+    counts = TransferJob.objects.filter(
+        status__in=[TransferJob.QUEUED, TransferJob.RUNNING]
+    ).order_by().values_list('kind', 'status').annotate(count=Count('id'))
+    for kind, status, count in counts:
+        depth[(('kind', kind), ('status', status))] = count
+
+    body = metrics_registry.render(gauges=[
+        ('gdriveftp_transfer_jobs', 'Background transfer jobs waiting or running', depth),
+    ])
+    return HttpResponse(body, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@staff_member_required
+@drive_call_budget(1)
 def approve_user(request, user_id):
     """Approve a user."""
     user_profile = get_object_or_404(UserProfile, user_id=user_id)
@@ -271,6 +524,11 @@ def approve_user(request, user_id):
         user_profile.is_approved = True
         user_profile.save()
         
+        if background_transfers_enabled() and not user_profile.drive_folder_id:
+            enqueue_create_user_folder(user_profile)
+            messages.success(request, f'User {user_profile.user.username} approved; their Google Drive folder is being created.')
+            return redirect('admin_dashboard')
+        
         # Create Google Drive folder for the user
         drive_service = GoogleDriveService()
         folder_id = drive_service.create_user_folder(f"gdriveftp_{user_profile.user.username}")
@@ -300,12 +558,20 @@ def revoke_user(request, user_id):
     return render(request, 'ftp/revoke_user.html', {'user_profile': user_profile})
 
 @login_required
+@drive_call_budget(1)
 def delete_folder(request, folder_id):
     """Delete folder and its contents."""
     folder = get_object_or_404(FolderEntry, id=folder_id, user=request.user)
     parent_id = folder.parent_folder.id if folder.parent_folder else None
     
     if request.method == 'POST':
+        if background_transfers_enabled():
+            enqueue_delete_folder(folder)
+            messages.info(request, f'Folder {folder.folder_name} is being deleted.')
+            if parent_id:
+                return redirect('folder_view', folder_id=parent_id)
+            return redirect('dashboard')
+        
         drive_service = GoogleDriveService()
         
         # Delete folder in Google Drive
@@ -328,12 +594,46 @@ def user_settings(request):
     user_profile = UserProfile.objects.get(user=request.user)
     
     if request.method == 'POST':
+        old_email = user_profile.share_email
         form = SettingsForm(request.POST, instance=user_profile)
         if form.is_valid():
-            form.save()
+            user_profile = form.save()
+            if (old_email or None) != (user_profile.share_email or None):
+                if background_transfers_enabled():
+                    # A worker re-shares existing files and folders, retrying on failure
+                    enqueue_update_sharing(request.user, old_email, user_profile.share_email)
+                else:
+                    try:
+                        update_user_sharing(request.user, old_email, user_profile.share_email)
+                    except Exception as e:
+                        logger.error(f"Error updating sharing for {request.user.username}: {e}")
+                        messages.warning(request, 'Some files could not be re-shared with the new email address.')
             messages.success(request, 'Your settings have been updated successfully!')
             return redirect('dashboard')
     else:
         form = SettingsForm(instance=user_profile)
     
-    return render(request, 'ftp/settings.html', {'form': form})
\ No newline at end of file
+    return render(request, 'ftp/settings.html', {'form': form})
+
+def _visible_jobs(request):
+    # Staff can follow jobs they queued on behalf of other users
+    if request.user.is_staff:
+        return TransferJob.objects.all()
+    return TransferJob.objects.filter(user=request.user)
+
+@login_required
+@drive_call_budget(0)
+def job_status(request, job_id):
+    """Progress of one transfer job as JSON."""
+    job = get_object_or_404(_visible_jobs(request), id=job_id)
+    return JsonResponse(job.as_status())
+
+@login_required
+@drive_call_budget(0)
+def job_list(request):
+    """The user's unfinished transfer jobs as JSON."""
+    jobs = TransferJob.objects.filter(
+        user=request.user,
+        status__in=[TransferJob.QUEUED, TransferJob.RUNNING]
+    ).order_by('created_at')[:100]
+    return JsonResponse({'jobs': [job.as_status() for job in jobs]})
\ No newline at end of file
@@ -49,6 +49,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'ftp.middleware.DriveTraceMiddleware',
 ]
 
 ROOT_URLCONF = 'gdriveftp.urls'
@@ -127,6 +128,138 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
 # Google Drive settings
 GOOGLE_DRIVE_STORAGE_JSON_KEY_FILE = os.path.join(BASE_DIR, 'credentials.json')
+# Send Drive API calls somewhere other than https://www.googleapis.com/,
+# e.g. the local stand-in the benchmarks run against
+GOOGLE_DRIVE_API_ROOT_URL = os.environ.get('GOOGLE_DRIVE_API_ROOT_URL') or None
+
+# Load credentials and build the shared Drive client when the app starts.
+# The probe makes one files().list call to check connectivity.
+GOOGLE_DRIVE_WARM_UP = os.environ.get('GOOGLE_DRIVE_WARM_UP', '') == '1'
+GOOGLE_DRIVE_WARM_UP_PROBE = False
+GOOGLE_DRIVE_HTTP_TIMEOUT = 60
+
+# Keep the Drive access token in the Django cache so processes share one
+# token instead of each minting their own; one process refreshes it this
+# many seconds before it expires while the others keep using it. Only
+# shared between processes when CACHES uses a shared backend (see below).
+GOOGLE_DRIVE_SHARED_TOKEN_CACHE = True
+GOOGLE_DRIVE_TOKEN_REFRESH_MARGIN = 5 * 60
+
+# Bytes fetched per ranged GET when streaming downloads to the client
+GOOGLE_DRIVE_DOWNLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Local disk cache for downloads, keyed by Drive file ID and md5Checksum
+# or version. Least recently used files are evicted to stay within the
+# byte budget; 0 disables the cache. Files larger than the max file size
+# (a quarter of the budget unless set) are always streamed from Drive.
+GOOGLE_DRIVE_DOWNLOAD_CACHE_BYTES = int(os.environ.get('GOOGLE_DRIVE_DOWNLOAD_CACHE_BYTES', '0'))
+GOOGLE_DRIVE_DOWNLOAD_CACHE_DIR = os.path.join(BASE_DIR, 'download_cache')
+# Seconds a file's md5/version is trusted before Drive is asked again
+GOOGLE_DRIVE_DOWNLOAD_CACHE_CHECK_TTL = 60
+# Requests for a file that another request is caching read its bytes as they
+# are written; if none arrive for this many seconds they go to Drive instead
+GOOGLE_DRIVE_DOWNLOAD_CACHE_FOLLOW_TIMEOUT = 30
+
+# Resumable upload chunk size (rounded up to a multiple of 256 KiB)
+GOOGLE_DRIVE_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Size upload and download chunks from measured throughput and RTT; the
+# chunk sizes above are used until there are measurements. Uploads up to
+# GOOGLE_DRIVE_SIMPLE_UPLOAD_MAX bytes go in a single multipart request.
+GOOGLE_DRIVE_ADAPTIVE_CHUNKS = True
+GOOGLE_DRIVE_SIMPLE_UPLOAD_MAX = 5 * 1024 * 1024
+GOOGLE_DRIVE_MAX_CHUNK_SIZE = 64 * 1024 * 1024
+GOOGLE_DRIVE_TARGET_CHUNK_SECONDS = 2.0
+
+# Forward uploaded file parts to Drive while the request body is still
+# arriving, instead of after Django has received the whole request
+GOOGLE_DRIVE_STREAMING_UPLOADS = os.environ.get('GOOGLE_DRIVE_STREAMING_UPLOADS', '') == '1'
+
+# Hash uploads as they arrive (stored as FileEntry.md5_checksum) so
+# content already in Drive is copied server-side instead of re-sent.
+# The handlers skip hashing while deduplication is turned off.
+FILE_UPLOAD_HANDLERS = [
+    'ftp.upload_handlers.HashingMemoryFileUploadHandler',
+    'ftp.upload_handlers.HashingTemporaryFileUploadHandler',
+]
+GOOGLE_DRIVE_DEDUPLICATE_UPLOADS = True
+# Also reuse content uploaded by other users (all files belong to the
+# service account, so a copy works across users)
+GOOGLE_DRIVE_DEDUP_ACROSS_USERS = False
+
+# Serve the dashboard, upload and download pages from async views that
+# call Drive through the httpx-based async client (needs httpx and an
+# ASGI server such as uvicorn running gdriveftp.asgi)
+GOOGLE_DRIVE_ASYNC_VIEWS = os.environ.get('GOOGLE_DRIVE_ASYNC_VIEWS', '') == '1'
+# Open connections to Drive per event loop for the async client
+GOOGLE_DRIVE_ASYNC_MAX_CONNECTIONS = 100
+
+# Report each request's Drive calls in a Server-Timing response header
+# (they are always summarised in the log)
+GOOGLE_DRIVE_SERVER_TIMING = True
+# Raise instead of warning when a view exceeds its @drive_call_budget;
+# meant for tests
+GOOGLE_DRIVE_ENFORCE_CALL_BUDGETS = False
+
+# Directory shared by all processes (web and transfer workers) where each
+# writes its metrics for /metrics to sum; unset, /metrics only reports the
+# process that serves it. Empty it when deploying.
+GOOGLE_DRIVE_METRICS_DIR = os.environ.get('GOOGLE_DRIVE_METRICS_DIR') or None
+GOOGLE_DRIVE_METRICS_FLUSH_INTERVAL = 1.0
+# Bearer token Prometheus sends to /metrics; without one only staff can read it
+GOOGLE_DRIVE_METRICS_TOKEN = os.environ.get('GOOGLE_DRIVE_METRICS_TOKEN', '')
+
+# Seconds a Drive folder stays trusted after we created or checked it,
+# so uploads into it skip the parent files().get call
+GOOGLE_DRIVE_FOLDER_CACHE_TTL = 60 * 60
+
+# Read back every created file and folder (debugging aid, one extra call each)
+GOOGLE_DRIVE_VERIFY_WRITES = False
+
+# Retries for rate-limited (429, rate-limit 403) and failed (5xx) Drive
+# calls, with exponential backoff and jitter; Retry-After is honoured
+GOOGLE_DRIVE_MAX_RETRIES = 5
+GOOGLE_DRIVE_RETRY_BASE_DELAY = 1.0
+GOOGLE_DRIVE_RETRY_MAX_DELAY = 64.0
+
+# Drive requests per second for the whole deployment (None to disable).
+# The count is kept in the Django cache, so it is only shared between
+# processes when CACHES uses a shared backend (see below).
+GOOGLE_DRIVE_RATE_LIMIT = 150
+GOOGLE_DRIVE_MAX_THROTTLE_WAIT = 60.0
+
+# Set REDIS_URL to share the Drive rate limiter and folder cache across
+# processes and servers (needs the redis package)
+if os.environ.get('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['REDIS_URL'],
+        }
+    }
+
+# Items requested per files().list page (Drive allows up to 1000)
+GOOGLE_DRIVE_LIST_PAGE_SIZE = 1000
+
+# Number of files uploaded to Drive at once from a single form post
+GOOGLE_DRIVE_UPLOAD_CONCURRENCY = 4
+
+# Number of Drive folders listed at once by the import_drive_tree command
+GOOGLE_DRIVE_IMPORT_CONCURRENCY = 8
+
+# Queue uploads, folder deletion and user folder creation as TransferJobs
+# for `manage.py run_transfer_worker` instead of calling Drive in the request
+GOOGLE_DRIVE_BACKGROUND_TRANSFERS = os.environ.get('GOOGLE_DRIVE_BACKGROUND_TRANSFERS', '') == '1'
+TRANSFER_SPOOL_DIR = os.path.join(BASE_DIR, 'spool')
+TRANSFER_LEASE_SECONDS = 300
+TRANSFER_POLL_INTERVAL = 2
+TRANSFER_RETRY_DELAY = 30
+
+# Seconds a saved resumable upload session is reused (Drive keeps them about a week)
+GOOGLE_DRIVE_UPLOAD_SESSION_TTL = 6 * 24 * 60 * 60
+
+# Files shown per dashboard page
+DASHBOARD_PAGE_SIZE = 50
 
 # Login URL
 LOGIN_URL = '/login/'